@@ -25,4 +25,66 @@ SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 FINCODE_PREFIX = os.getenv("FINCODE_PREFIX")
 FINCODE_SECRET_KEY = os.getenv("FINCODE_SECRET_KEY")
-FINCODE_ENDPOINT_URL = os.getenv("FINCODE_ENDPOINT_URL")
\ No newline at end of file
+FINCODE_ENDPOINT_URL = os.getenv("FINCODE_ENDPOINT_URL")
+
+# --- Tool 03 (二重価格画像作成) ---
+# (フォント, サイズ) 単位で保持するフォントの上限。全テンプレートのテキストボックスを線形スキャンで
+# 埋めるのに最大 343 個 (NotoSansJP-Black / ShipporiMinchoB1-Bold 各 142 サイズ + NotoSansJP-Bold 50 + 固定サイズ 9) 必要なため余裕を見て 512。
+# 日本語フォントは 1 個あたり約 65KB のため、上限まで埋まると描画プロセス毎に約 33MB
+TOOL03_FONT_CACHE_SIZE = int(os.getenv("TOOL03_FONT_CACHE_SIZE", 512))
+# 0 の場合はイベントループ上で 1 行ずつ描画、1 以上でプロセスプールで並列描画
+TOOL03_RENDER_WORKERS = int(os.getenv("TOOL03_RENDER_WORKERS", 0))
+# 共通レイヤー (日時・セール文言など) を共有して描画する 1 バッチの最大行数
+TOOL03_RENDER_BATCH_SIZE = int(os.getenv("TOOL03_RENDER_BATCH_SIZE", 32))
+# ジョブをまたいで生成済み画像を再利用するキャッシュの上限サイズ (0 で無効)
+TOOL03_RENDER_CACHE_MAX_BYTES = int(os.getenv("TOOL03_RENDER_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# ジョブ状態の保存先 (memory: プロセス内 / sqlite: SQLite ファイル / database: MariaDB)。uvicorn を複数ワーカーで動かす場合は sqlite か database
+TOOL03_JOB_STORE = os.getenv("TOOL03_JOB_STORE", "memory")
+TOOL03_JOB_STORE_SQLITE_PATH = os.getenv("TOOL03_JOB_STORE_SQLITE_PATH", "storage/tool03_jobs.sqlite3")
+# 行毎の状態更新をまとめて書き込む間隔 (秒) と件数
+TOOL03_JOB_STORE_FLUSH_INTERVAL = float(os.getenv("TOOL03_JOB_STORE_FLUSH_INTERVAL", 0.5))
+TOOL03_JOB_STORE_FLUSH_ROWS = int(os.getenv("TOOL03_JOB_STORE_FLUSH_ROWS", 200))
+# SSE (/jobs/{job_id}/events): ハートビート間隔、他ワーカーの更新を確認する間隔、イベント送信の最小間隔 (秒)
+TOOL03_SSE_HEARTBEAT_INTERVAL = float(os.getenv("TOOL03_SSE_HEARTBEAT_INTERVAL", 15))
+TOOL03_SSE_POLL_INTERVAL = float(os.getenv("TOOL03_SSE_POLL_INTERVAL", 1.0))
+TOOL03_SSE_MIN_INTERVAL = float(os.getenv("TOOL03_SSE_MIN_INTERVAL", 0.2))
+# ジョブ完了・FTP アップロード完了コールバック (callbackUrl): 署名用シークレット、同時送信数、最大試行回数、タイムアウト (秒)、再送間隔の基準 (秒)
+TOOL03_WEBHOOK_SECRET = os.getenv("TOOL03_WEBHOOK_SECRET", "")
+TOOL03_WEBHOOK_CONCURRENCY = int(os.getenv("TOOL03_WEBHOOK_CONCURRENCY", 4))
+TOOL03_WEBHOOK_MAX_ATTEMPTS = int(os.getenv("TOOL03_WEBHOOK_MAX_ATTEMPTS", 5))
+TOOL03_WEBHOOK_TIMEOUT = float(os.getenv("TOOL03_WEBHOOK_TIMEOUT", 10))
+TOOL03_WEBHOOK_BACKOFF = float(os.getenv("TOOL03_WEBHOOK_BACKOFF", 1.0))
+# コールバックの送信先として許可するホスト (カンマ区切り、"*.example.com" 形式可)。
+# 空の場合は任意のホストに送信できますが、ループバック・プライベート・リンクローカルのアドレスに解決されるホストは拒否します
+TOOL03_WEBHOOK_ALLOWED_HOSTS = os.getenv("TOOL03_WEBHOOK_ALLOWED_HOSTS", "")
+# ジョブキュー (memory: プロセス内 / sqlite: SQLite ファイル / database: MariaDB)。sqlite / database の場合は再起動後も未完了のジョブを再開
+TOOL03_JOB_QUEUE = os.getenv("TOOL03_JOB_QUEUE", "memory")
+TOOL03_JOB_QUEUE_SQLITE_PATH = os.getenv("TOOL03_JOB_QUEUE_SQLITE_PATH", "storage/tool03_queue.sqlite3")
+# 1 プロセスで同時に実行するジョブ数、他ワーカーの登録を確認する間隔 (秒)
+TOOL03_JOB_QUEUE_WORKERS = int(os.getenv("TOOL03_JOB_QUEUE_WORKERS", 2))
+TOOL03_JOB_QUEUE_POLL_INTERVAL = float(os.getenv("TOOL03_JOB_QUEUE_POLL_INTERVAL", 1.0))
+# 実行中のジョブのリース (秒、ワーカーが停止した場合はこの時間の後に再実行) と最大試行回数
+TOOL03_JOB_QUEUE_LEASE_SECONDS = float(os.getenv("TOOL03_JOB_QUEUE_LEASE_SECONDS", 60))
+TOOL03_JOB_QUEUE_MAX_ATTEMPTS = int(os.getenv("TOOL03_JOB_QUEUE_MAX_ATTEMPTS", 3))
+# この行数以下のジョブはプレビューとして高優先レーンで実行 (PATCH の再生成は常に高優先)
+TOOL03_JOB_QUEUE_PRIORITY_MAX_ROWS = int(os.getenv("TOOL03_JOB_QUEUE_PRIORITY_MAX_ROWS", 20))
+# 流入制限 (0 で無制限): 1 ジョブの最大行数、会社毎のキュー内 (待機中・実行中) の最大行数、全体のキュー内の最大行数
+TOOL03_MAX_ROWS_PER_JOB = int(os.getenv("TOOL03_MAX_ROWS_PER_JOB", 10000))
+TOOL03_MAX_QUEUED_ROWS_PER_COMPANY = int(os.getenv("TOOL03_MAX_QUEUED_ROWS_PER_COMPANY", 20000))
+TOOL03_MAX_INFLIGHT_ROWS = int(os.getenv("TOOL03_MAX_INFLIGHT_ROWS", 100000))
+# ETA・Retry-After 計算用の 1 ワーカーあたりの処理速度 (行/秒) の初期値 (以降は実測値で更新)
+TOOL03_JOB_QUEUE_ROWS_PER_SECOND = float(os.getenv("TOOL03_JOB_QUEUE_ROWS_PER_SECOND", 10))
+# 描画ループ・FTP アップロードが一時停止・キャンセルの要求を確認する間隔 (秒)
+TOOL03_JOB_CONTROL_INTERVAL = float(os.getenv("TOOL03_JOB_CONTROL_INTERVAL", 0.5))
+# 描画ジョブの入力と行毎の進捗を保存するディレクトリ (再起動時に未完了のジョブを続きから再開、空の場合は無効)
+TOOL03_JOB_CHECKPOINT_DIR = os.getenv("TOOL03_JOB_CHECKPOINT_DIR", "storage/tool03_checkpoints")
+# 完了したジョブのダウンロード用 Zip アーカイブのキャッシュの最大サイズ (バイト、0 で無効 = 毎回その場でストリーム)
+TOOL03_ZIP_CACHE_MAX_BYTES = int(os.getenv("TOOL03_ZIP_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+# 画像・Zip の送信方法: app (アプリが送信) / x-accel-redirect (nginx) / x-sendfile (Apache mod_xsendfile・lighttpd)
+TOOL03_FILE_SERVING = os.getenv("TOOL03_FILE_SERVING", "app").lower()
+# x-accel-redirect: storage ディレクトリに対応する nginx の internal location の URI (空の場合は /_tool03_storage)
+# x-sendfile: プロキシから見た storage ディレクトリのパス (空の場合はアプリから見た絶対パス)
+TOOL03_FILE_SERVING_PREFIX = os.getenv("TOOL03_FILE_SERVING_PREFIX", "")
+# 描画直後の画像 (エンコード済みのバイト列) を保持するメモリキャッシュの最大サイズ (バイト、プロセス毎、0 で無効)
+# TOOL03_FILE_SERVING が app 以外の場合はプロキシがファイルを送信するため使用しません
+TOOL03_IMAGE_MEMORY_CACHE_MAX_BYTES = int(os.getenv("TOOL03_IMAGE_MEMORY_CACHE_MAX_BYTES", 128 * 1024 * 1024))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import uuid
+import shutil
+import logging
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, IO, List, Optional
+
+INPUT_FILENAME = "input.json"
+PROGRESS_FILENAME = "progress.jsonl"
+
+
+@dataclass
+class JobCheckpoint:
+    """チェックポイントから読み出したジョブの入力と進捗。"""
+    job_id: str
+    input: Dict[str, Any]
+    results: Dict[str, Dict[str, Any]] = field(default_factory=dict)       # row.id -> 最後に記録された結果
+    fingerprints: Dict[str, Optional[str]] = field(default_factory=dict)   # row.id -> 入力ハッシュ
+    control: Optional[str] = None                                          # 最後に記録された一時停止・キャンセルの要求
+
+
+class JobCheckpointStore:
+    """
+    描画ジョブの入力 (input.json) と行毎の完了結果 (progress.jsonl、1 行 1 レコードの追記のみ) をディスクに保存し、
+    プロセスが再起動した場合に未完了のジョブを完了済みの行の続きから再開できるようにします。
+    ジョブストア・ジョブキューがプロセス内 (memory) の場合でも再開できるよう、どちらとも独立して保存します。
+    progress.jsonl は行毎に flush するため、プロセスが異常終了しても書き込み済みの行は失われません
+    (書き込み途中の最終行は読み出し時に無視します)。
+    """
+
+    def __init__(self, base_dir: Optional[Path]):
+        self.base_dir = Path(base_dir) if base_dir else None
+        self._lock = threading.Lock()
+        self._files: Dict[str, IO[str]] = {}
+        if self.enabled:
+            self.base_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.base_dir is not None
+
+    def _dir(self, job_id: str) -> Path:
+        return self.base_dir / job_id
+
+    def save_input(self, job_id: str, job_input: Dict[str, Any]):
+        """ジョブの入力を保存し、進捗を空にします (一時ファイル経由で置き換え)。"""
+        if not self.enabled:
+            return
+        self._close(job_id)
+        job_dir = self._dir(job_id)
+        job_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = job_dir / f".{INPUT_FILENAME}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job_input, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, job_dir / INPUT_FILENAME)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        (job_dir / PROGRESS_FILENAME).unlink(missing_ok=True)
+
+    def record_row(self, job_id: str, row_id: str, result: Dict[str, Any], fingerprint: Optional[str]):
+        """完了した行の結果を追記します。"""
+        self._append(job_id, {"row": row_id, "result": result, "fp": fingerprint})
+
+    def record_control(self, job_id: str, control: Optional[str]):
+        """一時停止・再開の要求を追記します (再起動後も一時停止中のジョブは再開されるまで実行しない)。"""
+        self._append(job_id, {"control": control})
+
+    def _append(self, job_id: str, record: Dict[str, Any]):
+        if not self.enabled:
+            return
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            f = self._files.get(job_id)
+            if f is None:
+                if not (self._dir(job_id) / INPUT_FILENAME).is_file():
+                    return  # 入力の無いジョブ (チェックポイント導入前のジョブなど) は記録しない
+                f = self._files[job_id] = open(self._dir(job_id) / PROGRESS_FILENAME, "a", encoding="utf-8")
+            f.write(line)
+            f.flush()
+
+    def load(self, job_id: str) -> Optional[JobCheckpoint]:
+        """チェックポイントを読み出します。入力が無い・壊れている場合は None。"""
+        if not self.enabled:
+            return None
+        job_dir = self._dir(job_id)
+        try:
+            with open(job_dir / INPUT_FILENAME, encoding="utf-8") as f:
+                checkpoint = JobCheckpoint(job_id, json.load(f))
+        except (OSError, ValueError) as e:
+            logging.error(f"[Job {job_id}] チェックポイントの入力を読み込めません: {e}")
+            return None
+        try:
+            with open(job_dir / PROGRESS_FILENAME, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"[Job {job_id}] チェックポイントの不完全な行を無視します。")
+                        continue
+                    if "row" in record:
+                        checkpoint.results[record["row"]] = record["result"]
+                        checkpoint.fingerprints[record["row"]] = record.get("fp")
+                    elif "control" in record:
+                        checkpoint.control = record["control"]
+        except FileNotFoundError:
+            pass
+        return checkpoint
+
+    def job_ids(self) -> List[str]:
+        """チェックポイントが残っている (未完了の) ジョブ ID。"""
+        if not self.enabled:
+            return []
+        return sorted(path.parent.name for path in self.base_dir.glob(f"*/{INPUT_FILENAME}"))
+
+    def exists(self, job_id: str) -> bool:
+        return self.enabled and (self._dir(job_id) / INPUT_FILENAME).is_file()
+
+    def remove(self, job_id: str):
+        """ジョブが終了した (再開する必要が無くなった) 場合にチェックポイントを削除します。"""
+        if not self.enabled:
+            return
+        self._close(job_id)
+        shutil.rmtree(self._dir(job_id), ignore_errors=True)
+
+    def _close(self, job_id: str):
+        with self._lock:
+            f = self._files.pop(job_id, None)
+        if f is not None:
+            f.close()
+
+    def close(self):
+        with self._lock:
+            files, self._files = list(self._files.values()), {}
+        for f in files:
+            f.close()
@@ -1,50 +1,133 @@
 # -*- coding: utf-8 -*-
 import uuid
 from fastapi import BackgroundTasks, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+from pathlib import Path
 from typing import List, Optional, Dict
 import os
 import shutil
+import hashlib
 import logging 
 
 # Đồng thời directory (.) import schemas và service
 from . import schemas
 from . import service as tool03_service
+from .encoder import is_format_supported
+from .job_queue import QueueFullError
+from .webhooks import CallbackUrlError
 
 # --- start_image_generation_job function ---
 def start_image_generation_job(
     product_rows: List[schemas.Tool03ProductRowInput],
-    background_tasks: BackgroundTasks
+    encoder: Optional[schemas.Tool03EncoderOptions] = None,
+    callback_url: Optional[str] = None,
+    company_id: Optional[str] = None
 ) -> schemas.Tool03CreateJobResponse:
     if not product_rows:
         raise HTTPException(status_code=400, detail="商品リストを空にすることはできません")
+    # Kiểm tra định dạng đầu ra (WebP cần Pillow được build với libwebp)
+    if encoder and not is_format_supported(encoder):
+        raise HTTPException(status_code=400, detail=f"出力形式 {encoder.format} はサーバーでサポートされていません。")
+    # Kiểm tra callbackUrl (không cho phép gửi đến địa chỉ nội bộ: loopback / private / link-local)
+    if callback_url:
+        try:
+            tool03_service.validate_callback_url(callback_url)
+        except CallbackUrlError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    # Giới hạn số dòng của 1 job (job lớn hơn giới hạn hàng đợi thì chờ bao lâu cũng không được nhận)
+    max_rows = tool03_service.max_rows_per_job()
+    if max_rows and len(product_rows) > max_rows:
+        raise HTTPException(status_code=413, detail=f"1 つのジョブで処理できる商品は {max_rows} 件までです ({len(product_rows)} 件指定)。")
 
     job_id = str(uuid.uuid4())
-    # Thêm job vào background tasks
-    background_tasks.add_task(tool03_service.generate_images_background, job_id, product_rows)
+    # Thêm job vào hàng đợi (worker sẽ xử lý theo thứ tự ưu tiên / công bằng giữa các công ty)
+    try:
+        queue_info = tool03_service.enqueue_generation_job(job_id, product_rows, encoder, callback_url, company_id)
+    except QueueFullError as e:
+        # Vượt quá giới hạn hàng đợi -> 429, Retry-After = thời gian ước tính để hàng đợi giảm xuống
+        logging.warning(f"ジョブの登録を拒否しました (会社: {company_id or 'default'}, {len(product_rows)} 行): {e}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
-    # Trả về job_id ngay lập tức
-    return schemas.Tool03CreateJobResponse(jobId=job_id, totalItems=len(product_rows))
+    # Trả về job_id và tình trạng hàng đợi ngay lập tức
+    return schemas.Tool03CreateJobResponse(jobId=job_id, totalItems=len(product_rows), **queue_info)
 
 # --- get_job_status_controller function ---
-def get_job_status_controller(job_id: str) -> Optional[schemas.Tool03JobStatusResponse]:
-    status_dict = tool03_service.get_job_status(job_id)
-    if status_dict:
-        # --- Thêm job_id vào dictionary ---
-        status_dict_with_id = {"jobId": job_id, **status_dict}
-        # ---------------------------
-        try:
-            # Chuyển đổi dict sang Pydantic model để xác thực và trả về
-            return schemas.Tool03JobStatusResponse(**status_dict_with_id)
-        except Exception as e:
-            # Ghi log nếu có lỗi xác thực không mong muốn
-            logging.error(f"ジョブ {job_id} の JobStatusResponse 検証エラー: {e}") # <<< Đã sửa logger -> logging
-            logging.error(f"元のデータ: {status_dict_with_id}") # <<< Đã sửa logger -> logging
-            # Trả về lỗi 500 nếu cấu trúc dữ liệu không khớp model
-            raise HTTPException(status_code=500, detail="ジョブステータスデータの処理エラー。")
+# Các trường có thể chọn bằng tham số fields
+RESULT_FIELDS = tuple(schemas.Tool03ImageResult.model_fields)
+
+def _status_etag(version: int, fields: Optional[List[str]], summary: bool) -> str:
+    # ETag = version của job + cách chọn dữ liệu (fields / summary).
+    # Không phụ thuộc vào since: nếu version không đổi thì client (dù dùng since hay không) đã có dữ liệu mới nhất.
+    selection = f"{','.join(fields or [])}|{int(summary)}"
+    return f'W/"{version}-{hashlib.sha1(selection.encode()).hexdigest()[:12]}"'
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in candidates]
+
+def get_job_status_controller(
+    job_id: str,
+    since: Optional[int] = None,
+    fields: Optional[str] = None,
+    summary: bool = False,
+    if_none_match: Optional[str] = None,
+) -> Optional[Response]:
+    # Kiểm tra version trước: nếu không có thay đổi thì trả về 304 mà không đọc results
+    version = tool03_service.get_job_version(job_id)
+    if version is None:
+        # Trả về None nếu service không tìm thấy job (router sẽ trả về 404)
+        return None
+
+    selected_fields = None
+    if fields:
+        selected_fields = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown_fields = [name for name in selected_fields if name not in RESULT_FIELDS]
+        if unknown_fields:
+            raise HTTPException(status_code=400, detail=f"不明なフィールドです: {', '.join(unknown_fields)} (指定可能: {', '.join(RESULT_FIELDS)})")
+    if since is not None and since > version:
+        # Cursor không hợp lệ (ví dụ: job đã được tạo lại) -> trả về toàn bộ
+        since = None
 
-    # Trả về None nếu service không tìm thấy job (router sẽ trả về 404)
-    return None
+    etag = _status_etag(version, selected_fields, summary)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
 
+    status_dict = tool03_service.get_job_status(job_id, since=since, include_results=not summary)
+    if status_dict is None:
+        return None
+    results = status_dict.pop("results")
+    try:
+        # Chỉ xác thực các trường chung; results (ResultTable) chỉ được chuyển sang dict khi tạo response
+        status_model = schemas.Tool03JobStatusResponse(jobId=job_id, **status_dict, results={}, since=since)
+    except Exception as e:
+        # Ghi log nếu có lỗi xác thực không mong muốn
+        logging.error(f"ジョブ {job_id} の JobStatusResponse 検証エラー: {e}") # <<< Đã sửa logger -> logging
+        logging.error(f"元のデータ: {status_dict}") # <<< Đã sửa logger -> logging
+        # Trả về lỗi 500 nếu cấu trúc dữ liệu không khớp model
+        raise HTTPException(status_code=500, detail="ジョブステータスデータの処理エラー。")
+    body = status_model.model_dump(mode="json")
+    body["results"] = results.to_dict(selected_fields)
+    etag = _status_etag(status_model.version, selected_fields, summary)
+    return JSONResponse(body, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+# --- stream_job_events_controller function ---
+def stream_job_events_controller(job_id: str, last_event_id: Optional[str] = None) -> Optional[StreamingResponse]:
+    if tool03_service.get_job_version(job_id) is None:
+        # Trả về None nếu không tìm thấy job (router sẽ trả về 404)
+        return None
+    # Last-Event-ID là version của job (nếu không hợp lệ thì gửi lại toàn bộ)
+    since = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    return StreamingResponse(
+        tool03_service.iter_job_events(job_id, since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # Tắt buffering của nginx
+    )
 
 # --- get_image_file_path_controller function ---
 def get_image_file_path_controller(job_id: str, filename: str) -> Optional[str]:
@@ -58,20 +141,112 @@ def get_image_file_path_controller(job_id: str, filename: str) -> Optional[str]:
           return str(file_path)
      return None
 
-# --- create_images_zip_controller function ---
-def create_images_zip_controller(job_id: str) -> Optional[str]:
+# --- _serve_file function ---
+def _serve_file(file_path: str, media_type: str, filename: str, headers: Dict[str, str]) -> Response:
+    # Chế độ X-Accel-Redirect / X-Sendfile: chỉ trả về header, proxy sẽ gửi file (sendfile, hỗ trợ Range)
+    offload = tool03_service.file_offload_header(Path(file_path))
+    if offload is None:
+        # FileResponse xử lý Range / If-Range (so sánh với ETag trong headers)
+        return FileResponse(file_path, media_type=media_type, filename=filename, headers=headers)
+    return Response(
+        media_type=media_type,
+        headers={**headers, offload[0]: offload[1], "Content-Disposition": _content_disposition(filename)},
+    )
+
+def _content_disposition(filename: str) -> str:
+    # Giống với FileResponse (tên file không phải ASCII -> filename*)
+    quoted_filename = quote(filename)
+    if quoted_filename == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename*=utf-8''{quoted_filename}"
+
+# --- get_image_file_response_controller function ---
+# URL có ?v=<contentHash> đúng với nội dung hiện tại -> cache lâu dài (URL sẽ đổi khi ảnh được tạo lại)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], etag: str, mtime: float) -> bool:
+    # If-None-Match được ưu tiên hơn If-Modified-Since
+    if if_none_match:
+        return _etag_matches(if_none_match, etag)
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def get_image_file_response_controller(
+    job_id: str,
+    filename: str,
+    version: Optional[str] = None,
+    if_none_match: Optional[str] = None,
+    if_modified_since: Optional[str] = None,
+    range_header: Optional[str] = None,
+) -> Optional[Response]:
+    file_path = get_image_file_path_controller(job_id, filename)
+    if not file_path:
+        # Trả về None nếu không tìm thấy ảnh (router sẽ trả về 404)
+        return None
     try:
-        zip_path = tool03_service.create_job_zip_archive(job_id)
-        return zip_path
+        # Ảnh vừa được tạo: trả về từ bộ nhớ (request có Range thì đọc từ file để FileResponse xử lý)
+        cached = None
+        if range_header is None and tool03_service.image_bytes.enabled:
+            cached = tool03_service.image_bytes.get(job_id, filename, Path(file_path))
+        if cached is not None:
+            stat, digest, data = cached
+        else:
+            data = None
+            stat, digest = tool03_service.image_digests.get(Path(file_path))
+    except FileNotFoundError:
+        return None
+    # ETag mạnh = hash nội dung ảnh (giống contentHash trong results)
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if version == digest else "no-cache",
+    }
+    if _not_modified(if_none_match, if_modified_since, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    media_type = "image/webp" if filename.lower().endswith(".webp") else "image/jpeg"
+    if data is not None:
+        return Response(
+            content=data,
+            media_type=media_type,
+            headers={**headers, "Accept-Ranges": "bytes", "Content-Disposition": _content_disposition(filename)},
+        )
+    return _serve_file(file_path, media_type, filename, headers)
+
+# --- download_images_zip_controller function ---
+def download_images_zip_controller(job_id: str, download_filename: str, if_none_match: Optional[str] = None) -> Response:
+    try:
+        zip_source = tool03_service.open_job_zip(job_id)
     except FileNotFoundError:
          raise HTTPException(status_code=404, detail="ジョブディレクトリが見つかりません。")
     except Exception as e:
-         logging.error(f"ジョブ {job_id} の Zip 作成エラー: {e}", exc_info=True) # <<< Đã sửa logger -> logging
+         logging.error(f"ジョブ {job_id} の Zip 作成エラー: {e}", exc_info=True)
          raise HTTPException(status_code=500, detail="Zip ファイルの作成に失敗しました。")
+    if isinstance(zip_source, Path):
+        # Archive đã được tạo sẵn: ETag = version của archive, hỗ trợ Range để tiếp tục tải khi bị gián đoạn
+        etag = f'"{zip_source.stem}"'
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return _serve_file(str(zip_source), "application/zip", download_filename, headers)
+    # Đang tạo (hoặc job chưa kết thúc): gửi từng phần trong khi tạo, không hỗ trợ Range
+    return StreamingResponse(
+        zip_source,
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{download_filename}"',
+            "Accept-Ranges": "none",
+            "Cache-Control": "no-cache",
+        },
+    )
 
 # --- start_ftp_upload_controller function ---
 def start_ftp_upload_controller(job_id: str, target: str, background_tasks: BackgroundTasks):
-    job_status = tool03_service.get_job_status(job_id)
+    job_status = tool03_service.get_job_status(job_id, include_results=False)
     if not job_status:
         raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
 
@@ -82,15 +257,38 @@ def start_ftp_upload_controller(job_id: str, target: str, background_tasks: Back
     logging.info(f"ジョブ {job_id} の {target} への FTP アップロードタスクをバックグラウンドに追加します。") # <<< Đã sửa logger -> logging
     background_tasks.add_task(tool03_service.upload_job_images_to_ftp, job_id, target)
 
+# --- cancel / pause / resume ---
+_CONTROL_ACTIONS = {
+    "cancel": (tool03_service.cancel_job, "キャンセル"),
+    "pause": (tool03_service.pause_job, "一時停止"),
+    "resume": (tool03_service.resume_job, "再開"),
+}
+
+def job_control_controller(job_id: str, action: str) -> schemas.Tool03JobControlResponse:
+    service_func, label = _CONTROL_ACTIONS[action]
+    try:
+        job_data = service_func(job_id)
+    except ValueError as e:
+        # Trạng thái hiện tại của job không cho phép thao tác này (ví dụ: job đã kết thúc)
+        raise HTTPException(status_code=409, detail=str(e))
+    if job_data is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    return schemas.Tool03JobControlResponse(
+        jobId=job_id,
+        message=f"ジョブ {job_id} の{label}を受け付けました。",
+        status=job_data.get("status"),
+        control=job_data.get("control"),
+    )
+
 # --- start_image_regeneration_job function ---
 def start_image_regeneration_job(
     job_id: str,
     modified_rows: List[schemas.Tool03ProductRowInput],
-    background_tasks: BackgroundTasks
-):
-    """Thêm background task để tái tạo ảnh cụ thể."""
+    company_id: Optional[str] = None
+) -> schemas.Tool03UpdateJobResponse:
+    """Thêm job tái tạo ảnh cụ thể vào hàng đợi ưu tiên cao (chỉ các dòng có dữ liệu thay đổi)."""
     # Kiểm tra job tồn tại
-    existing_job_status = tool03_service.get_job_status(job_id)
+    existing_job_status = tool03_service.get_job_status(job_id, include_results=False)
     if not existing_job_status:
         raise HTTPException(status_code=404, detail="ジョブが見つかりません")
 
@@ -98,5 +296,19 @@ def start_image_regeneration_job(
     # if existing_job_status.get("status") == "Failed":
     #     raise HTTPException(status_code=400, detail="失敗したジョブは更新できません。")
 
-    logging.info(f"ジョブ {job_id} に {len(modified_rows)} 件の画像再生成タスクを追加します。") # <<< Đã sửa logger -> logging
-    background_tasks.add_task(tool03_service.regenerate_specific_images_background, job_id, modified_rows)
\ No newline at end of file
+    # Chỉ tái tạo các dòng có input thay đổi so với lần render trước
+    changed_rows, unchanged_row_ids = tool03_service.split_changed_rows(job_id, modified_rows)
+    if not changed_rows:
+        logging.info(f"ジョブ {job_id}: 送信された {len(modified_rows)} 行に変更はありません。再生成をスキップします。")
+        return schemas.Tool03UpdateJobResponse(
+            message=f"ジョブ {job_id} に変更された行はありません。",
+            unchangedRowIds=unchanged_row_ids,
+        )
+
+    logging.info(f"ジョブ {job_id} に {len(changed_rows)} 件の画像再生成タスクを追加します (変更なし: {len(unchanged_row_ids)} 件)。") # <<< Đã sửa logger -> logging
+    tool03_service.enqueue_regeneration_job(job_id, changed_rows, company_id)
+    return schemas.Tool03UpdateJobResponse(
+        message=f"ジョブ {job_id} の画像再生成タスクが開始されました。",
+        changedItems=len(changed_rows),
+        unchangedRowIds=unchanged_row_ids,
+    )
\ No newline at end of file
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import io
+import time
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from PIL import Image, features
+
+from .schemas import Tool03EncoderOptions
+
+DEFAULT_ENCODER_OPTIONS = Tool03EncoderOptions()
+
+_FORMATS = {
+    # format -> (Pillow の形式名, 拡張子)
+    "jpeg": ("JPEG", ".jpg"),
+    "webp": ("WEBP", ".webp"),
+}
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    data: bytes
+    quality: int
+    encode_time_ms: float
+    attempts: int  # maxBytes 探索で試したエンコード回数
+
+
+def output_suffix(options: Tool03EncoderOptions) -> str:
+    return _FORMATS[options.format][1]
+
+
+def is_format_supported(options: Tool03EncoderOptions) -> bool:
+    """この環境の Pillow で options.format を書き出せるかどうか。"""
+    return options.format != "webp" or bool(features.check("webp"))
+
+
+def _save_kwargs(img: Image.Image, options: Tool03EncoderOptions, quality: int) -> Dict[str, Any]:
+    # 既定値 (JPEG, 品質 95, その他は未指定) では従来の img.save(path, "JPEG", quality=95) と同じ引数になるようにする
+    kwargs: Dict[str, Any] = {"quality": quality}
+    if options.format == "jpeg":
+        if options.progressive:
+            kwargs["progressive"] = True
+        if options.optimize:
+            kwargs["optimize"] = True
+        if options.subsampling:
+            kwargs["subsampling"] = options.subsampling
+    elif options.optimize:
+        kwargs["method"] = 6  # WebP の最も遅く高圧縮なモード
+    if not options.stripMetadata:
+        # Pillow は info を自動では書き出さないため、テンプレート由来のメタデータを明示的に渡す
+        for key in ("exif", "icc_profile", "xmp", "dpi"):
+            value = img.info.get(key)
+            if value:
+                kwargs[key] = value
+    return kwargs
+
+
+def _encode_once(img: Image.Image, options: Tool03EncoderOptions, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, _FORMATS[options.format][0], **_save_kwargs(img, options, quality))
+    return buffer.getvalue()
+
+
+def encode_image(img: Image.Image, options: Optional[Tool03EncoderOptions] = None) -> EncodedImage:
+    """
+    img を options に従ってエンコードします。
+    options.maxBytes を指定した場合は、options.quality を上限として maxBytes 以下になる最も高い品質を二分探索します
+    (品質 1 でも収まらない場合は品質 1 の結果を返します)。
+    """
+    options = options or DEFAULT_ENCODER_OPTIONS
+    if not is_format_supported(options):
+        raise ValueError(f"この環境では {options.format} 形式の出力はサポートされていません。")
+    start = time.perf_counter()
+    quality = options.quality
+    data = _encode_once(img, options, quality)
+    attempts = 1
+    if options.maxBytes and len(data) > options.maxBytes:
+        best: Optional[tuple] = None
+        smallest = (quality, data)
+        low, high = 1, quality - 1
+        while low <= high:
+            mid = (low + high) // 2
+            candidate = _encode_once(img, options, mid)
+            attempts += 1
+            if len(candidate) <= options.maxBytes:
+                best = (mid, candidate)
+                low = mid + 1
+            else:
+                smallest = (mid, candidate)  # 全て超過した場合、最後に試すのは品質 1
+                high = mid - 1
+        quality, data = best or smallest
+        if best is None:
+            logging.warning(f"品質 {quality} でも目標サイズ {options.maxBytes} bytes 以下にできませんでした ({len(data)} bytes)")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    return EncodedImage(data=data, quality=quality, encode_time_ms=elapsed_ms, attempts=attempts)
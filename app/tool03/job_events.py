@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class JobEventHub:
+    """
+    ジョブの状態変更をこのプロセス内で待っている SSE 接続に通知します。
+    ジョブストアの書き込みは描画ループ (イベントループ) と FTP アップロード (スレッドプール) の両方から行われるため、
+    待機側のイベントループに call_soon_threadsafe で通知します。
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, job_id: str) -> asyncio.Event:
+        event = asyncio.Event()
+        with self._lock:
+            self._subscribers.setdefault(job_id, []).append((asyncio.get_running_loop(), event))
+        return event
+
+    def unsubscribe(self, job_id: str, event: asyncio.Event):
+        with self._lock:
+            subscribers = [entry for entry in self._subscribers.get(job_id, []) if entry[1] is not event]
+            if subscribers:
+                self._subscribers[job_id] = subscribers
+            else:
+                self._subscribers.pop(job_id, None)
+
+    def notify(self, job_id: str):
+        with self._lock:
+            subscribers = list(self._subscribers.get(job_id, ()))
+        for loop, event in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # 接続側のイベントループが既に終了している
+
+    def subscriber_count(self, job_id: Optional[str] = None) -> int:
+        with self._lock:
+            if job_id is not None:
+                return len(self._subscribers.get(job_id, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+def format_sse(event: Optional[str] = None, data: Any = None, event_id: Optional[int] = None) -> str:
+    """Server-Sent Events の 1 イベント分の文字列を返します (data は JSON で送信)。"""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import Column, Float, Index, Integer, MetaData, String, Table, Text, create_engine, delete, func, select, update
+from sqlalchemy.dialects.mysql import LONGTEXT
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import StaticPool
+
+from .job_store import _create_sqlite_engine
+
+# レーン (値が小さいほど優先)。PATCH の再生成と少数行のジョブ (プレビュー) は高優先レーンで実行します
+LANE_HIGH = 0
+LANE_NORMAL = 1
+
+# ハンドラーがこの値を返した場合、エントリは完了せずに一時停止 (paused) として残ります
+PAUSED = "Paused"
+
+metadata = MetaData()
+
+tool03_job_queue_table = Table(
+    "tool03_job_queue", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("job_id", String(36), nullable=False),
+    Column("kind", String(16), nullable=False),  # generate / regenerate
+    Column("lane", Integer, nullable=False),
+    Column("company_id", String(64), nullable=False),
+    Column("row_count", Integer, nullable=False, default=0),  # 描画する行数 (流入制限・ETA 用)
+    Column("payload", Text().with_variant(LONGTEXT(), "mysql", "mariadb"), nullable=False),  # JSON (入力行など)
+    Column("state", String(16), nullable=False),  # queued / running / paused
+    Column("enqueued_at", Float, nullable=False),
+    Column("started_at", Float, nullable=True),
+    Column("lease_until", Float, nullable=True),  # running の間、実行中のワーカーが定期的に延長する
+    Column("worker_id", String(64), nullable=True),
+    Column("attempts", Integer, nullable=False, default=0),
+    Index("ix_tool03_job_queue_state", "state", "lane", "id"),
+)
+
+
+@dataclass(frozen=True)
+class QueueEntry:
+    id: int
+    job_id: str
+    kind: str
+    lane: int
+    company_id: str
+    row_count: int
+    payload: Dict[str, Any]
+    attempts: int
+    enqueued_at: float
+
+
+@dataclass(frozen=True)
+class QueueLoad:
+    entries: int        # 待機中・実行中のエントリ数
+    rows: int           # 待機中・実行中の行数の合計
+    company_rows: int   # そのうち指定した会社の行数
+
+
+class QueueFullError(Exception):
+    """流入制限 (キュー内の行数の上限) を超えたため登録できない場合。retry_after は再試行までの目安 (秒)。"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """
+    Tool 03 のジョブ (描画・再生成) を永続化するキュー。SQLAlchemy のエンジン (SQLite ファイル / メモリ / MariaDB) に保存します。
+    claim() は次の順で 1 件を選び、条件付き UPDATE で取得します (複数プロセスから同時に呼び出しても 1 件は 1 ワーカーのみ)。
+      - 同じジョブのエントリは登録順に 1 件ずつ (実行中のエントリがあるジョブは対象外)
+      - レーンの優先度順
+      - 実行中のエントリが少ない会社 (company_id) を優先し、同数の場合は登録順
+    実行中のエントリはリース (lease_until) を持ち、期限切れのもの (ワーカーの異常終了など) は recover_expired() でキューに戻します。
+    一時停止したジョブのエントリ (paused) は再開されるまで取得されず、同じジョブの後続のエントリも待たせます。
+    """
+
+    def __init__(self, engine: Engine, lease_seconds: float = 60, max_attempts: int = 3):
+        self.engine = engine
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()  # メモリ (単一接続) の場合にスレッド間で接続を共有するため
+        metadata.create_all(engine, checkfirst=True)
+
+    def enqueue(self, job_id: str, kind: str, payload: Dict[str, Any], lane: int = LANE_NORMAL,
+                company_id: Optional[str] = None, row_count: int = 0) -> int:
+        with self._lock, self.engine.begin() as conn:
+            result = conn.execute(tool03_job_queue_table.insert().values(
+                job_id=job_id, kind=kind, lane=lane, company_id=company_id or "default", row_count=row_count,
+                payload=json.dumps(payload, ensure_ascii=False), state="queued", enqueued_at=time.time(), attempts=0,
+            ))
+            return result.inserted_primary_key[0]
+
+    def claim(self, worker_id: str) -> Optional[QueueEntry]:
+        table = tool03_job_queue_table
+        now = time.time()
+        with self._lock, self.engine.begin() as conn:
+            active = conn.execute(
+                select(table.c.id, table.c.job_id, table.c.lane, table.c.company_id, table.c.state)
+                .order_by(table.c.id)
+            ).all()
+            blocked_jobs = {row.job_id for row in active if row.state in ("running", "paused")}
+            running_by_company = Counter(row.company_id for row in active if row.state == "running")
+            candidates = {}
+            for row in active:
+                if row.state == "queued" and row.job_id not in blocked_jobs:
+                    candidates.setdefault(row.job_id, row)  # ジョブ毎に最も古いエントリのみ
+            for row in sorted(candidates.values(), key=lambda row: (row.lane, running_by_company[row.company_id], row.id)):
+                claimed = conn.execute(
+                    update(table).where(table.c.id == row.id, table.c.state == "queued")
+                    .values(state="running", worker_id=worker_id, started_at=now,
+                            lease_until=now + self.lease_seconds, attempts=table.c.attempts + 1)
+                ).rowcount
+                if claimed == 1:
+                    entry = conn.execute(select(table).where(table.c.id == row.id)).one()
+                    return _to_entry(entry)
+        return None
+
+    def renew(self, entry_id: int, worker_id: str) -> bool:
+        """実行中のエントリのリースを延長します。他のワーカーに取られていた場合は False。"""
+        table = tool03_job_queue_table
+        with self._lock, self.engine.begin() as conn:
+            return conn.execute(
+                update(table).where(table.c.id == entry_id, table.c.worker_id == worker_id, table.c.state == "running")
+                .values(lease_until=time.time() + self.lease_seconds)
+            ).rowcount == 1
+
+    def complete(self, entry_id: int):
+        with self._lock, self.engine.begin() as conn:
+            conn.execute(delete(tool03_job_queue_table).where(tool03_job_queue_table.c.id == entry_id))
+
+    def release(self, entry_id: int, worker_id: str):
+        """実行を中断したエントリをキューに戻します (シャットダウン時。試行回数には数えない)。"""
+        table = tool03_job_queue_table
+        with self._lock, self.engine.begin() as conn:
+            conn.execute(
+                update(table).where(table.c.id == entry_id, table.c.worker_id == worker_id, table.c.state == "running")
+                .values(state="queued", worker_id=None, started_at=None, lease_until=None, attempts=table.c.attempts - 1)
+            )
+
+    def park(self, entry_id: int, worker_id: str):
+        """一時停止で実行を止めたエントリを paused にします (resume_job() でキューに戻るまで取得されない)。"""
+        table = tool03_job_queue_table
+        with self._lock, self.engine.begin() as conn:
+            conn.execute(
+                update(table).where(table.c.id == entry_id, table.c.worker_id == worker_id, table.c.state == "running")
+                .values(state="paused", worker_id=None, started_at=None, lease_until=None, attempts=table.c.attempts - 1)
+            )
+
+    def pause_job(self, job_id: str) -> int:
+        """ジョブの待機中のエントリを paused にし、その件数を返します (実行中のエントリはワーカーが停止後に park() する)。"""
+        table = tool03_job_queue_table
+        with self._lock, self.engine.begin() as conn:
+            return conn.execute(
+                update(table).where(table.c.job_id == job_id, table.c.state == "queued").values(state="paused")
+            ).rowcount
+
+    def resume_job(self, job_id: str) -> int:
+        """ジョブの paused のエントリをキューに戻し、その件数を返します。"""
+        table = tool03_job_queue_table
+        with self._lock, self.engine.begin() as conn:
+            return conn.execute(
+                update(table).where(table.c.job_id == job_id, table.c.state == "paused").values(state="queued")
+            ).rowcount
+
+    def cancel_job(self, job_id: str) -> bool:
+        """ジョブの待機中・一時停止中のエントリを削除します。実行中のエントリが残っている場合は True を返します。"""
+        table = tool03_job_queue_table
+        with self._lock, self.engine.begin() as conn:
+            conn.execute(delete(table).where(table.c.job_id == job_id, table.c.state.in_(("queued", "paused"))))
+            return conn.execute(
+                select(func.count()).where(table.c.job_id == job_id, table.c.state == "running")
+            ).scalar() > 0
+
+    def recover_expired(self) -> List[QueueEntry]:
+        """
+        リースが切れた実行中のエントリをキューに戻します。
+        試行回数が max_attempts に達したエントリはキューから削除し、そのリストを返します。
+        """
+        table = tool03_job_queue_table
+        now = time.time()
+        with self._lock, self.engine.begin() as conn:
+            expired = conn.execute(
+                select(table).where(table.c.state == "running", table.c.lease_until < now)
+            ).all()
+            dead = [row for row in expired if row.attempts >= self.max_attempts]
+            if dead:
+                conn.execute(delete(table).where(table.c.id.in_([row.id for row in dead])))
+            retry_ids = [row.id for row in expired if row.attempts < self.max_attempts]
+            if retry_ids:
+                conn.execute(
+                    update(table).where(table.c.id.in_(retry_ids), table.c.state == "running")
+                    .values(state="queued", worker_id=None, started_at=None, lease_until=None)
+                )
+                logging.warning(f"リースが切れた {len(retry_ids)} 件のジョブをキューに戻しました。")
+        return [_to_entry(row) for row in dead]
+
+    def load(self, company_id: Optional[str] = None) -> QueueLoad:
+        """キュー内 (待機中・実行中・一時停止中) のエントリ数と行数を返します。"""
+        table = tool03_job_queue_table
+        company_id = company_id or "default"
+        with self._lock, self.engine.connect() as conn:
+            entries = rows = company_rows = 0
+            for row_company, count, row_total in conn.execute(
+                select(table.c.company_id, func.count(), func.coalesce(func.sum(table.c.row_count), 0))
+                .group_by(table.c.company_id)
+            ):
+                entries += count
+                rows += row_total
+                if row_company == company_id:
+                    company_rows = row_total
+        return QueueLoad(entries=entries, rows=int(rows), company_rows=int(company_rows))
+
+    def ahead(self, entry_id: int) -> QueueLoad:
+        """
+        entry_id より先に実行されるエントリ (実行中のもの、上位レーンの待機中のもの、同じレーンで先に登録されたもの) の件数と行数を返します。
+        会社毎の公平性による順番の入れ替わりは考慮しない目安です。
+        """
+        table = tool03_job_queue_table
+        with self._lock, self.engine.connect() as conn:
+            lane = conn.execute(select(table.c.lane).where(table.c.id == entry_id)).scalar()
+            if lane is None:
+                return QueueLoad(entries=0, rows=0, company_rows=0)
+            count, rows = conn.execute(
+                select(func.count(), func.coalesce(func.sum(table.c.row_count), 0)).where(
+                    table.c.id != entry_id,
+                    table.c.state != "paused",
+                    (table.c.state == "running") | (table.c.lane < lane) | ((table.c.lane == lane) & (table.c.id < entry_id)),
+                )
+            ).one()
+        return QueueLoad(entries=count, rows=int(rows), company_rows=0)
+
+    def entries(self, kind: Optional[str] = None) -> List[QueueEntry]:
+        """キュー内 (待機中・実行中) のエントリを登録順に返します。"""
+        table = tool03_job_queue_table
+        query = select(table).order_by(table.c.id)
+        if kind:
+            query = query.where(table.c.kind == kind)
+        with self._lock, self.engine.connect() as conn:
+            return [_to_entry(row) for row in conn.execute(query)]
+
+
+def _to_entry(row) -> QueueEntry:
+    return QueueEntry(
+        id=row.id, job_id=row.job_id, kind=row.kind, lane=row.lane, company_id=row.company_id, row_count=row.row_count,
+        payload=json.loads(row.payload), attempts=row.attempts, enqueued_at=row.enqueued_at,
+    )
+
+
+class JobRunner:
+    """
+    JobQueue からエントリを取得して実行するワーカー (イベントループ上の workers 個のタスク)。
+    handlers は kind -> async 関数 (QueueEntry を受け取り、一時停止した場合は PAUSED を返す)。
+    実行中はリースを定期的に延長し、stop() で中断したエントリはキューに戻して次回の起動時に再実行します。
+    """
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable[[QueueEntry], Awaitable[None]]],
+                 workers: int = 2, poll_interval: float = 1.0, on_dead: Optional[Callable[[QueueEntry], None]] = None,
+                 rows_per_second: float = 10.0, on_parked: Optional[Callable[[QueueEntry], None]] = None):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.on_dead = on_dead
+        self.on_parked = on_parked  # 一時停止で park() した後に呼ばれる (停止中に再開された場合のキューへの戻し用)
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[int, QueueEntry] = {}  # entry.id -> 実行中のエントリ
+        # 1 ワーカーあたりの処理速度 (行/秒)。完了したエントリの実測値の指数移動平均で更新し、ETA・Retry-After の計算に使う
+        self.rows_per_second = max(0.1, rows_per_second)
+
+    def start(self):
+        """ワーカーを起動します (起動済みの場合は何もしない)。イベントループ上から呼び出します。"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and any(not task.done() for task in self._tasks):
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._tasks = [loop.create_task(self._worker(index)) for index in range(self.workers)]
+        self._tasks.append(loop.create_task(self._maintenance()))
+        logging.info(f"Tool 03 ジョブランナーを起動しました (ワーカー {self.workers} 個, ID: {self.worker_id})")
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for entry in list(self._running.values()):
+            await asyncio.to_thread(self.queue.release, entry.id, self.worker_id)
+        self._running.clear()
+
+    def wake(self):
+        """新しいエントリが登録されたことを待機中のワーカーに知らせます。"""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def running(self) -> List[QueueEntry]:
+        return list(self._running.values())
+
+    async def _worker(self, index: int):
+        while True:
+            self._wakeup.clear()
+            try:
+                entry = await asyncio.to_thread(self.queue.claim, self.worker_id)
+            except Exception as e:
+                logging.error(f"ジョブキューからの取得に失敗しました: {e}", exc_info=True)
+                entry = None
+            if entry is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            handler = self.handlers.get(entry.kind)
+            logging.info(f"[Job {entry.job_id}] キューから {entry.kind} を開始します (ワーカー {index}, レーン {entry.lane}, 会社 {entry.company_id}, 試行 {entry.attempts} 回目)")
+            self._running[entry.id] = entry
+            started = time.monotonic()
+            heartbeat = asyncio.create_task(self._heartbeat(entry))
+            outcome = None
+            try:
+                if handler is None:
+                    logging.error(f"[Job {entry.job_id}] 不明なキューエントリの種類です: {entry.kind}")
+                else:
+                    outcome = await handler(entry)
+            except asyncio.CancelledError:
+                raise  # stop() でキューに戻す
+            except Exception as e:
+                logging.error(f"[Job {entry.job_id}] キューエントリ {entry.kind} の実行中にエラーが発生しました: {e}", exc_info=True)
+            finally:
+                heartbeat.cancel()
+            self._running.pop(entry.id, None)
+            if outcome == PAUSED:
+                # ワーカーを空けて待機 (再開されるとキューに戻り、ハンドラーは続きから実行する)
+                await asyncio.to_thread(self.queue.park, entry.id, self.worker_id)
+                if self.on_parked:
+                    self.on_parked(entry)
+            else:
+                self._record_throughput(entry.row_count, time.monotonic() - started)
+                await asyncio.to_thread(self.queue.complete, entry.id)
+            self._wakeup.set()  # 同じジョブの次のエントリを他のワーカーが取得できるようにする
+
+    def _record_throughput(self, rows: int, elapsed: float):
+        if rows > 0 and elapsed > 0:
+            self.rows_per_second = 0.7 * self.rows_per_second + 0.3 * (rows / elapsed)
+
+    def estimate_seconds(self, rows_ahead: int, rows: int = 0) -> float:
+        """rows_ahead 行が全ワーカーで処理された後に rows 行を 1 ワーカーで処理し終えるまでの目安 (秒)。"""
+        return rows_ahead / (self.rows_per_second * self.workers) + rows / self.rows_per_second
+
+    async def _heartbeat(self, entry: QueueEntry):
+        while True:
+            await asyncio.sleep(max(1.0, self.queue.lease_seconds / 3))
+            if not await asyncio.to_thread(self.queue.renew, entry.id, self.worker_id):
+                logging.warning(f"[Job {entry.job_id}] キューエントリ {entry.id} のリースを延長できませんでした (他のワーカーに再割り当て済み?)")
+
+    async def _maintenance(self):
+        while True:
+            try:
+                for entry in await asyncio.to_thread(self.queue.recover_expired):
+                    logging.error(f"[Job {entry.job_id}] {entry.attempts} 回試行しても完了しなかったため {entry.kind} を中止します。")
+                    if self.on_dead:
+                        self.on_dead(entry)
+            except Exception as e:
+                logging.error(f"ジョブキューのリース確認に失敗しました: {e}", exc_info=True)
+            await asyncio.sleep(max(1.0, self.queue.lease_seconds / 2))
+
+
+def create_job_queue(backend: str, sqlite_path: Path, lease_seconds: float, max_attempts: int) -> JobQueue:
+    """TOOL03_JOB_QUEUE の値 (memory / sqlite / database) に応じたジョブキューを返します。"""
+    backend = (backend or "memory").lower()
+    if backend == "memory":
+        # プロセス内のみ (再起動で消える)。単一の接続を共有するインメモリ SQLite
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        return JobQueue(engine, lease_seconds, max_attempts)
+    if backend == "sqlite":
+        logging.info(f"Tool 03 ジョブキュー: SQLite ({sqlite_path})")
+        return JobQueue(_create_sqlite_engine(sqlite_path), lease_seconds, max_attempts)
+    if backend == "database":
+        from app.core.database import engine
+        logging.info("Tool 03 ジョブキュー: データベース (MariaDB)")
+        return JobQueue(engine, lease_seconds, max_attempts)
+    raise ValueError(f"不明な TOOL03_JOB_QUEUE: {backend} (memory, sqlite, database のいずれかを指定してください)")
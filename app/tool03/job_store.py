@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import (
+    Column, Float, Integer, MetaData, String, Table, Text, create_engine, delete, event, select, update,
+)
+from sqlalchemy.engine import Engine
+
+from .result_table import ResultTable
+
+# 行単位で保存するジョブのフィールド (row.id -> 値)。それ以外のフィールドは 1 キー 1 行で保存します
+# results は ResultTable、それ以外は dict として返します
+ROW_MAPS = ("results", "rowFingerprints")
+
+
+def _empty_row_maps() -> Dict[str, Any]:
+    return {"results": ResultTable(), "rowFingerprints": {}}
+
+
+class JobStore:
+    """
+    Tool 03 のジョブ状態の保存先。
+    ジョブはフィールド (status, progress など) と行単位のマップ (ROW_MAPS) で構成され、
+    get() はフィールドと行マップをまとめた dict (のコピー) を返します。
+    取得した dict を変更しても保存されないため、変更は update() / set_rows() で書き込みます。
+    フィールドと行を同時に変更する場合は update() の rows にまとめると、バージョンの更新と通知が 1 回で済みます。
+    ジョブは書き込みの度に単調増加するバージョン ("version") を持ち、results の各行も最後に更新された時点のバージョンを持ちます。
+    add_listener() で登録した関数は、書き込みが読み出し可能になった時点で job_id を引数に呼び出されます。
+    """
+
+    shared = False  # 他のプロセスからも書き込まれる (リスナーに通知されない変更がある) かどうか
+
+    def __init__(self):
+        self._listeners: List[Callable[[str], None]] = []
+
+    def add_listener(self, listener: Callable[[str], None]):
+        self._listeners.append(listener)
+
+    def _notify(self, job_id: str):
+        for listener in self._listeners:
+            try:
+                listener(job_id)
+            except Exception as e:
+                logging.warning(f"ジョブストアのリスナーでエラーが発生しました ({job_id}): {e}")
+
+    def create(self, job_id: str, job_data: Dict[str, Any]):
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_changes(self, job_id: str, since: Optional[int] = None, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        ステータス API 用に、フィールドと results (ResultTable) を返します (rowFingerprints は含めません)。
+        since を指定した場合は、バージョンが since より新しい行のみ含めます。
+        """
+        raise NotImplementedError
+
+    def get_version(self, job_id: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def exists(self, job_id: str) -> bool:
+        raise NotImplementedError
+
+    def update(self, job_id: str, fields: Dict[str, Any], rows: Optional[Dict[str, Dict[str, Any]]] = None):
+        """
+        フィールドを書き込みます。rows ({map_name: {row.id: 値}}) を指定した場合は行も同じ書き込みで反映します。
+        """
+        raise NotImplementedError
+
+    def set_rows(self, job_id: str, map_name: str, values: Dict[str, Any]):
+        """ROW_MAPS の 1 つに行単位で書き込みます (値が None の行は削除)。"""
+        self.update(job_id, {}, {map_name: values})
+
+    def delete(self, job_id: str):
+        raise NotImplementedError
+
+    def list_job_fields(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """全ジョブの指定フィールドを {job_id: {name: value}} で返します (クリーンアップ用)。"""
+        raise NotImplementedError
+
+    def flush(self):
+        """バッファ済みの書き込みを反映します。"""
+
+
+class InMemoryJobStore(JobStore):
+    """プロセス内の dict に保存します (uvicorn ワーカーが 1 つの場合のみ)。"""
+    shared = False
+
+    def __init__(self):
+        super().__init__()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id: str, job_data: Dict[str, Any]):
+        record = dict(job_data)
+        record["version"] = 1
+        record["results"] = ResultTable()
+        for row_id, result in (job_data.get("results") or {}).items():
+            record["results"].set(row_id, result, 1)
+        record["rowFingerprints"] = dict(record.get("rowFingerprints") or {})
+        with self._lock:
+            self._jobs[job_id] = record
+        self._notify(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return None
+            snapshot = dict(record)
+            snapshot["results"] = record["results"].copy()
+            snapshot["rowFingerprints"] = dict(record["rowFingerprints"])
+            return snapshot
+
+    def get_changes(self, job_id: str, since: Optional[int] = None, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return None
+            snapshot = {name: value for name, value in record.items() if name not in ROW_MAPS}
+            snapshot["results"] = record["results"].copy(since) if include_results else ResultTable()
+            return snapshot
+
+    def get_version(self, job_id: str) -> Optional[int]:
+        record = self._jobs.get(job_id)
+        return None if record is None else record["version"]
+
+    def exists(self, job_id: str) -> bool:
+        return job_id in self._jobs
+
+    def update(self, job_id: str, fields: Dict[str, Any], rows: Optional[Dict[str, Dict[str, Any]]] = None):
+        rows = rows or {}
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return
+            record.update(fields)
+            record["version"] += 1
+            for map_name, values in rows.items():
+                row_map = record[map_name]
+                for row_id, value in values.items():
+                    if value is None:
+                        row_map.pop(row_id, None)
+                    elif map_name == "results":
+                        row_map.set(row_id, value, record["version"])
+                    else:
+                        row_map[row_id] = value
+        # rowFingerprints だけの書き込みはステータス API に現れないため通知しない
+        if fields or "results" in rows:
+            self._notify(job_id)
+
+    def delete(self, job_id: str):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+        self._notify(job_id)
+
+    def list_job_fields(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        names = list(names)
+        with self._lock:
+            return {job_id: {name: record.get(name) for name in names} for job_id, record in self._jobs.items()}
+
+
+metadata = MetaData()
+
+tool03_jobs_table = Table(
+    "tool03_jobs", metadata,
+    Column("job_id", String(36), primary_key=True),
+    Column("created_at", Float, nullable=False),
+    Column("version", Integer, nullable=False, default=1),
+)
+tool03_job_fields_table = Table(
+    "tool03_job_fields", metadata,
+    Column("job_id", String(36), primary_key=True),
+    Column("name", String(64), primary_key=True),
+    Column("value", Text, nullable=True),  # JSON
+)
+tool03_job_rows_table = Table(
+    "tool03_job_rows", metadata,
+    Column("job_id", String(36), primary_key=True),
+    Column("map_name", String(32), primary_key=True),
+    Column("row_id", String(191), primary_key=True),
+    Column("value", Text, nullable=True),  # JSON
+    Column("version", Integer, nullable=False, default=1),  # 最後に更新されたときのジョブのバージョン
+)
+
+
+class SqlJobStore(JobStore):
+    """
+    SQLAlchemy のエンジン (SQLite ファイルまたは MariaDB) に保存し、複数の uvicorn ワーカー間でジョブを共有します。
+    フィールドと行はキー毎の行として保存するため、別ワーカーが別のフィールドを更新しても上書きし合いません。
+    書き込みはプロセス内でバッファし、flush_interval 秒毎または flush_rows 件毎にまとめて 1 トランザクションで反映します。
+    """
+    shared = True
+
+    def __init__(self, engine: Engine, flush_interval: float = 0.5, flush_rows: int = 200):
+        super().__init__()
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._lock = threading.RLock()
+        self._pending_fields: Dict[str, Dict[str, Any]] = {}
+        self._pending_rows: Dict[str, Dict[tuple, Any]] = {}
+        self._pending_count = 0
+        self._last_flush = time.monotonic()
+        self._exists_checked_at: Dict[str, float] = {}  # 行毎の存在確認でクエリしないよう flush_interval の間は結果を使い回す
+        self.flushes = 0
+        metadata.create_all(engine, checkfirst=True)
+
+    # --- 書き込み (バッファ) ---
+    def create(self, job_id: str, job_data: Dict[str, Any]):
+        fields = {name: value for name, value in job_data.items() if name not in ROW_MAPS}
+        with self._lock:
+            self._pending_fields.pop(job_id, None)
+            self._pending_rows.pop(job_id, None)
+            with self.engine.begin() as conn:
+                self._delete_job(conn, job_id)
+                conn.execute(tool03_jobs_table.insert().values(job_id=job_id, created_at=time.time(), version=1))
+                if fields:
+                    conn.execute(tool03_job_fields_table.insert(), [
+                        {"job_id": job_id, "name": name, "value": json.dumps(value, ensure_ascii=False)}
+                        for name, value in fields.items()
+                    ])
+                rows = [
+                    {"job_id": job_id, "map_name": map_name, "row_id": row_id, "value": json.dumps(value, ensure_ascii=False), "version": 1}
+                    for map_name in ROW_MAPS for row_id, value in (job_data.get(map_name) or {}).items()
+                ]
+                if rows:
+                    conn.execute(tool03_job_rows_table.insert(), rows)
+        self._notify(job_id)
+
+    def update(self, job_id: str, fields: Dict[str, Any], rows: Optional[Dict[str, Dict[str, Any]]] = None):
+        with self._lock:
+            if fields:
+                self._pending_fields.setdefault(job_id, {}).update(fields)
+                self._pending_count += len(fields)
+            if rows:
+                pending = self._pending_rows.setdefault(job_id, {})
+                for map_name, values in rows.items():
+                    for row_id, value in values.items():
+                        pending[(map_name, row_id)] = value
+                    self._pending_count += len(values)
+            self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self._pending_count >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending_fields, self._pending_fields = self._pending_fields, {}
+            pending_rows, self._pending_rows = self._pending_rows, {}
+            self._pending_count = 0
+            self._last_flush = time.monotonic()
+            job_ids = set(pending_fields) | set(pending_rows)
+            if not job_ids:
+                return
+            with self.engine.begin() as conn:
+                # 削除済み (クリーンアップ済み) のジョブは書き込みで復活させない
+                live_job_ids = set(conn.execute(
+                    select(tool03_jobs_table.c.job_id).where(tool03_jobs_table.c.job_id.in_(job_ids))
+                ).scalars())
+                for job_id in job_ids & live_job_ids:
+                    # 1 回の反映につきジョブのバージョンを 1 つ進め、この反映で書き込む行にそのバージョンを付ける
+                    conn.execute(
+                        update(tool03_jobs_table).where(tool03_jobs_table.c.job_id == job_id)
+                        .values(version=tool03_jobs_table.c.version + 1)
+                    )
+                    version = conn.execute(
+                        select(tool03_jobs_table.c.version).where(tool03_jobs_table.c.job_id == job_id)
+                    ).scalar_one()
+                    fields = pending_fields.get(job_id) or {}
+                    if fields:
+                        self._replace(conn, tool03_job_fields_table, job_id, "name", list(fields), [
+                            {"job_id": job_id, "name": name, "value": json.dumps(value, ensure_ascii=False)}
+                            for name, value in fields.items()
+                        ])
+                    rows = pending_rows.get(job_id) or {}
+                    for map_name in ROW_MAPS:
+                        row_values = {row_id: value for (name, row_id), value in rows.items() if name == map_name}
+                        if not row_values:
+                            continue
+                        self._replace(conn, tool03_job_rows_table, job_id, "row_id", list(row_values), [
+                            {"job_id": job_id, "map_name": map_name, "row_id": row_id, "value": json.dumps(value, ensure_ascii=False), "version": version}
+                            for row_id, value in row_values.items() if value is not None
+                        ], tool03_job_rows_table.c.map_name == map_name)
+            self.flushes += 1
+        for job_id in job_ids & live_job_ids:
+            self._notify(job_id)
+
+    @staticmethod
+    def _replace(conn, table: Table, job_id: str, key_column: str, keys: List[str], new_rows: List[Dict[str, Any]], *where):
+        # SQLite / MariaDB の両方で動くよう、対象キーを削除してから挿入する (同一トランザクション内)
+        conn.execute(delete(table).where(table.c.job_id == job_id, table.c[key_column].in_(keys), *where))
+        if new_rows:
+            conn.execute(table.insert(), new_rows)
+
+    def delete(self, job_id: str):
+        with self._lock:
+            self._pending_fields.pop(job_id, None)
+            self._pending_rows.pop(job_id, None)
+            self._exists_checked_at.pop(job_id, None)
+            with self.engine.begin() as conn:
+                self._delete_job(conn, job_id)
+        self._notify(job_id)
+
+    @staticmethod
+    def _delete_job(conn, job_id: str):
+        for table in (tool03_job_rows_table, tool03_job_fields_table, tool03_jobs_table):
+            conn.execute(delete(table).where(table.c.job_id == job_id))
+
+    # --- 読み込み (このプロセスの未反映の書き込みも反映) ---
+    def exists(self, job_id: str) -> bool:
+        checked_at = self._exists_checked_at.get(job_id)
+        if checked_at is not None and time.monotonic() - checked_at < self.flush_interval:
+            return True
+        with self.engine.connect() as conn:
+            found = conn.execute(
+                select(tool03_jobs_table.c.job_id).where(tool03_jobs_table.c.job_id == job_id)
+            ).first() is not None
+        if found:
+            self._exists_checked_at[job_id] = time.monotonic()
+        else:
+            self._exists_checked_at.pop(job_id, None)
+        return found
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._load(job_id, ROW_MAPS)
+
+    def get_changes(self, job_id: str, since: Optional[int] = None, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        return self._load(job_id, ("results",) if include_results else (), since)
+
+    def get_version(self, job_id: str) -> Optional[int]:
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(tool03_jobs_table.c.version).where(tool03_jobs_table.c.job_id == job_id)
+            ).scalar_one_or_none()
+
+    def _load(self, job_id: str, map_names: Iterable[str], since: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        map_names = tuple(map_names)
+        with self._lock:
+            pending_fields = dict(self._pending_fields.get(job_id) or {})
+            pending_rows = dict(self._pending_rows.get(job_id) or {})
+        with self.engine.connect() as conn:
+            version = conn.execute(
+                select(tool03_jobs_table.c.version).where(tool03_jobs_table.c.job_id == job_id)
+            ).scalar_one_or_none()
+            if version is None:
+                return None
+            record: Dict[str, Any] = _empty_row_maps()
+            for name, value in conn.execute(
+                select(tool03_job_fields_table.c.name, tool03_job_fields_table.c.value).where(tool03_job_fields_table.c.job_id == job_id)
+            ):
+                record[name] = json.loads(value) if value is not None else None
+            record["version"] = version
+            if map_names:
+                query = (
+                    select(tool03_job_rows_table.c.map_name, tool03_job_rows_table.c.row_id,
+                           tool03_job_rows_table.c.value, tool03_job_rows_table.c.version)
+                    .where(tool03_job_rows_table.c.job_id == job_id, tool03_job_rows_table.c.map_name.in_(map_names))
+                )
+                if since is not None:
+                    query = query.where(tool03_job_rows_table.c.version > since)
+                for map_name, row_id, value, row_version in conn.execute(query):
+                    if map_name == "results":
+                        record["results"].set(row_id, json.loads(value), row_version)
+                    else:
+                        record[map_name][row_id] = json.loads(value)
+        # このプロセスの未反映の書き込みも反映する (次の反映でバージョンが付く)
+        record.update(pending_fields)
+        for (map_name, row_id), value in pending_rows.items():
+            if map_name not in map_names:
+                continue
+            if value is None:
+                record[map_name].pop(row_id, None)
+            elif map_name == "results":
+                record["results"].set(row_id, value, version + 1)
+            else:
+                record[map_name][row_id] = value
+        if "rowFingerprints" not in map_names:
+            del record["rowFingerprints"]
+        return record
+
+    def list_job_fields(self, names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        names = list(names)
+        jobs: Dict[str, Dict[str, Any]] = {}
+        with self.engine.connect() as conn:
+            for (job_id,) in conn.execute(select(tool03_jobs_table.c.job_id)):
+                jobs[job_id] = {name: None for name in names}
+            for job_id, name, value in conn.execute(
+                select(tool03_job_fields_table.c.job_id, tool03_job_fields_table.c.name, tool03_job_fields_table.c.value)
+                .where(tool03_job_fields_table.c.name.in_(names))
+            ):
+                if job_id in jobs:
+                    jobs[job_id][name] = json.loads(value) if value is not None else None
+        return jobs
+
+
+def _create_sqlite_engine(path: Path) -> Engine:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30, "check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragma(dbapi_connection, _):
+        # 複数ワーカーからの同時読み書きのため WAL モードにする
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return engine
+
+
+def create_job_store(backend: str, sqlite_path: Path, flush_interval: float, flush_rows: int) -> JobStore:
+    """TOOL03_JOB_STORE の値 (memory / sqlite / database) に応じたジョブストアを返します。"""
+    backend = (backend or "memory").lower()
+    if backend == "memory":
+        return InMemoryJobStore()
+    if backend == "sqlite":
+        logging.info(f"Tool 03 ジョブストア: SQLite ({sqlite_path})")
+        return SqlJobStore(_create_sqlite_engine(sqlite_path), flush_interval, flush_rows)
+    if backend == "database":
+        # 既存の MariaDB 接続 (app.core.database) を使用する
+        from app.core.database import engine
+        logging.info("Tool 03 ジョブストア: データベース (MariaDB)")
+        return SqlJobStore(engine, flush_interval, flush_rows)
+    raise ValueError(f"不明な TOOL03_JOB_STORE: {backend} (memory, sqlite, database のいずれかを指定してください)")
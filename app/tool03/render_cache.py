@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import os
+import uuid
+import shutil
+import hashlib
+import json
+import logging
+import time
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+# キーの形式や描画ロジックを変更した場合はこの値を上げ、既存キャッシュを無効化します
+RENDER_CACHE_VERSION = 1
+# 最終利用日時を記録するマーカーファイルの接尾辞 (エントリと同じディレクトリに置く)
+USED_MARKER_SUFFIX = ".used"
+# evict() はキャッシュディレクトリ全体を走査するため、前回の走査からこの秒数以内の呼び出しは何もしない
+EVICT_INTERVAL_SECONDS = 60
+
+
+def link_or_copy(src: Path, dest: Path):
+    """src を dest にハードリンクします (別デバイスなどで失敗した場合はコピー)。dest は一時ファイル経由で置き換えます。"""
+    tmp_path = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+class RenderCache:
+    """
+    ジョブをまたいで生成済み画像を再利用するコンテンツアドレス型キャッシュ。
+    キーはテンプレートキー・テンプレートファイルのバージョン・描画に関わる行データ・エンコード設定のハッシュです。
+    ファイルはハードリンクで共有し、合計サイズが max_bytes を超えた場合は最終利用日時の古い順に削除します。
+    エントリはジョブの画像と inode を共有するため、最終利用日時はエントリ自体ではなくマーカーファイル (<エントリ>.used) の
+    更新日時に記録します (エントリの更新日時を変えると、他のジョブの画像の Last-Modified・ETag・Zip のバージョンが変わる)。
+    """
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._last_evict: Optional[float] = None
+        # ディレクトリは最初の保存時に作成する (レンダーワーカープロセスのインポート時にファイルシステムに触れない)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def make_key(self, template_key: str, template_path: Path, fields: Dict[str, Any], extra: Iterable = ()) -> str:
+        stat = os.stat(template_path)
+        payload = json.dumps(
+            [RENDER_CACHE_VERSION, template_key, Path(template_path).name, stat.st_mtime_ns, stat.st_size, fields, list(extra)],
+            ensure_ascii=False, sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str, suffix: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    def fetch(self, key: str, dest: Path) -> bool:
+        """キャッシュにあれば dest にリンク (またはコピー) して True を返します。"""
+        cached_path = self._path(key, Path(dest).suffix)
+        try:
+            link_or_copy(cached_path, dest)
+            self._touch_used(cached_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        except OSError as e:
+            logging.warning(f"レンダーキャッシュの読み出しに失敗しました ({key}): {e}")
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    @staticmethod
+    def _touch_used(cached_path: Path):
+        """LRU 用に最終利用日時を更新します (失敗してもキャッシュの読み出しは成功扱い)。"""
+        marker_path = cached_path.with_name(cached_path.name + USED_MARKER_SUFFIX)
+        try:
+            with open(marker_path, "ab"):
+                pass
+            os.utime(marker_path)
+        except OSError:
+            pass
+
+    def store(self, key: str, src: Path):
+        cached_path = self._path(key, Path(src).suffix)
+        try:
+            cached_path.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(src, cached_path)
+            with self._lock:
+                self.stores += 1
+        except OSError as e:
+            logging.warning(f"レンダーキャッシュへの保存に失敗しました ({key}): {e}")
+
+    def evict(self, force: bool = False) -> int:
+        """
+        合計サイズが max_bytes を超えていれば、古いエントリから max_bytes の 90% まで削除します。削除数を返します。
+        ジョブの完了毎に呼ばれるため、force でない場合は EVICT_INTERVAL_SECONDS に 1 回だけ走査します
+        (その間に増えた分は max_bytes の 10% の余裕と次回の走査で吸収する)。
+        """
+        if not self.enabled or not self.cache_dir.is_dir():
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_evict is not None and now - self._last_evict < EVICT_INTERVAL_SECONDS:
+                return 0
+            self._last_evict = now
+        files = []
+        used_times: Dict[str, float] = {}
+        for path in self.cache_dir.glob("*/*"):
+            if path.name.startswith("."):  # link_or_copy の一時ファイル
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.name.endswith(USED_MARKER_SUFFIX):
+                used_times[path.name[:-len(USED_MARKER_SUFFIX)]] = stat.st_mtime
+            else:
+                files.append((stat, path))
+        entries = []
+        total_bytes = 0
+        for stat, path in files:
+            # 一度も読み出されていないエントリは保存日時 (= 描画日時) を最終利用日時とする
+            entries.append((max(stat.st_mtime, used_times.get(path.name, 0)), stat.st_size, path))
+            total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return 0
+        target_bytes = int(self.max_bytes * 0.9)
+        removed = 0
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= target_bytes:
+                break
+            for stale_path in (path, path.with_name(path.name + USED_MARKER_SUFFIX)):
+                try:
+                    stale_path.unlink()
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+            removed += 1
+        with self._lock:
+            self.evictions += removed
+        logging.info(f"レンダーキャッシュから {removed} 件を削除しました (残り {total_bytes} bytes)")
+        return removed
+
+    def stats(self) -> Dict[str, Optional[int]]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "stores": self.stores, "evictions": self.evictions, "maxBytes": self.max_bytes}
@@ -0,0 +1,1110 @@
+# -*- coding: utf-8 -*-
+"""
+Tool 03 の画像描画 (フォント・テンプレート・Factory・行単位の描画)。
+レンダーワーカープロセスはこのモジュールのみを読み込むため、インポート時にジョブストア・キューなどを作成しないでください。
+"""
+import os
+import uuid
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Mapping
+from PIL import Image, ImageDraw, ImageFont
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+import datetime
+import math
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
+
+from app.core.config import TOOL03_FONT_CACHE_SIZE, TOOL03_RENDER_CACHE_MAX_BYTES
+
+from .schemas import Tool03ProductRowInput, Tool03ImageResult, Tool03EncoderOptions
+from .render_cache import RenderCache
+from .encoder import DEFAULT_ENCODER_OPTIONS, encode_image, output_suffix
+
+# --- パス解決ロジック ---
+# ... (パスロジック部分は変更なし) ...
+SERVICE_FILE_PATH = Path(__file__).resolve()
+APP_DIR = SERVICE_FILE_PATH.parent.parent
+PROJECT_ROOT = APP_DIR.parent
+ASSETS_DIR = PROJECT_ROOT / "assets"
+if not ASSETS_DIR.is_dir():
+    ASSETS_DIR = APP_DIR / "assets"
+    if not ASSETS_DIR.is_dir():
+        raise FileNotFoundError(
+            f"assets ディレクトリが見つかりません: {PROJECT_ROOT / 'assets'} または {APP_DIR / 'assets'}"
+        )
+FONTS_DIR = ASSETS_DIR / "fonts"
+if not FONTS_DIR.is_dir():
+     raise FileNotFoundError(f"フォントディレクトリが見つかりません: {FONTS_DIR}")
+TOOL03_TEMPLATES_DIR_OPTION1 = ASSETS_DIR / "tool03" / "templates"
+TOOL03_TEMPLATES_DIR_OPTION2 = APP_DIR / "tool03" / "assets" / "templates"
+if TOOL03_TEMPLATES_DIR_OPTION1.is_dir():
+    TOOL03_TEMPLATES_DIR = TOOL03_TEMPLATES_DIR_OPTION1
+elif TOOL03_TEMPLATES_DIR_OPTION2.is_dir():
+    TOOL03_TEMPLATES_DIR = TOOL03_TEMPLATES_DIR_OPTION2
+else:
+    raise FileNotFoundError(
+        f"Tool 03 テンプレートディレクトリが見つかりません: {TOOL03_TEMPLATES_DIR_OPTION1} または {TOOL03_TEMPLATES_DIR_OPTION2}"
+    )
+# --- パス解決ロジックの終わり ---
+
+# ジョブをまたいで生成済み画像を再利用するレンダーキャッシュ
+render_cache = RenderCache(PROJECT_ROOT / "storage" / "tool03_render_cache", TOOL03_RENDER_CACHE_MAX_BYTES)
+
+
+# === フォントキャッシュ ===
+class FontCache:
+    """(フォントパス, サイズ, index) をキーとする FreeType フォントのプロセス共通 LRU キャッシュ。"""
+    def __init__(self, max_size: int = 512):
+        self.max_size = max(1, max_size)
+        self._fonts: "OrderedDict[tuple, ImageFont.FreeTypeFont]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, font_path, font_size: int, index: int = 0) -> ImageFont.FreeTypeFont:
+        key = (str(font_path), int(font_size), int(index))
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self._fonts.move_to_end(key)
+                self.hits += 1
+                return font
+            self.misses += 1
+        # ファイル読み込みはロック外で行う (読み込み失敗時の IOError は呼び出し元へ)
+        font = ImageFont.truetype(key[0], key[1], index=key[2])
+        with self._lock:
+            self._fonts[key] = font
+            self._fonts.move_to_end(key)
+            while len(self._fonts) > self.max_size:
+                self._fonts.popitem(last=False)
+                self.evictions += 1
+        return font
+
+    def clear(self):
+        with self._lock:
+            self._fonts.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._fonts), "maxSize": self.max_size, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+font_cache = FontCache(TOOL03_FONT_CACHE_SIZE)
+
+def get_font(font_path, font_size: int, index: int = 0) -> ImageFont.FreeTypeFont:
+    """全 Factory 共通のフォント取得関数 (ImageFont.truetype の代わりに使用)。"""
+    return font_cache.get(font_path, font_size, index)
+
+
+# === テンプレート画像キャッシュ ===
+class TemplateCache:
+    """
+    デコード済みテンプレート画像 (RGB) のキャッシュ。
+    描画ごとにキャッシュ画像のコピーを返し、ファイルの mtime が変わった場合は再読み込みします。
+    """
+    def __init__(self):
+        self._templates: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, template_path: Path) -> Image.Image:
+        stat = os.stat(template_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        key = str(template_path)
+        with self._lock:
+            cached = self._templates.get(key)
+            if cached is not None and cached[0] == version:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        with Image.open(template_path) as src:
+            img = src.convert("RGB")
+        img.load()
+        with self._lock:
+            self._templates[key] = (version, img)
+        if cached is not None:
+            logging.info(f"テンプレートの更新を検出したため再読み込みしました: {template_path.name}")
+        return img
+
+    def get(self, template_path: Path) -> Image.Image:
+        """テンプレートのコピーを返します (呼び出し側で自由に描画可能)。"""
+        return self._load(template_path).copy()
+
+    def preload(self, templates_dir: Path = None) -> int:
+        """ディレクトリ内の全テンプレートを事前にデコードします。読み込んだ数を返します。"""
+        count = 0
+        for template_path in sorted((templates_dir or TOOL03_TEMPLATES_DIR).glob("template_*.jpg")):
+            try:
+                self._load(template_path)
+                count += 1
+            except Exception as e:
+                logging.error(f"テンプレートの事前読み込みに失敗しました: {template_path}: {e}")
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._templates), "hits": self.hits, "misses": self.misses}
+
+template_cache = TemplateCache()
+
+
+# === 固定テキストのスプライトキャッシュ ===
+class StaticTextSpriteCache:
+    """
+    テンプレートの固定文言 ("円", "のところ", "OFF", "税込", 割引単位 "%" / "円") のラスタライズ結果をキャッシュします。
+    スプライトは (フォント, サイズ, テキスト, サブピクセル位置) 毎の 8bit マスクで、描画時は
+    ImageDraw.bitmap で色を付けて合成します (draw.text と同じ合成処理のため、出力は完全に一致します)。
+    """
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max(1, max_entries)
+        self._sprites: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, font: ImageFont.FreeTypeFont, text: str, frac_x: float, frac_y: float) -> tuple:
+        key = (font.path, font.size, font.index, text, frac_x, frac_y)
+        with self._lock:
+            sprite = self._sprites.get(key)
+            if sprite is not None:
+                self._sprites.move_to_end(key)
+                self.hits += 1
+                return sprite
+            self.misses += 1
+        left, top, right, bottom = font.getbbox(text)
+        pad = int(font.size) + 2
+        canvas = Image.new("L", (max(right, 0) + pad * 2, max(bottom, 0) + pad * 2), 0)
+        ImageDraw.Draw(canvas).text((pad + frac_x, pad + frac_y), text, fill=255, font=font)
+        bbox = canvas.getbbox()
+        sprite = (canvas.crop(bbox), (bbox[0] - pad, bbox[1] - pad)) if bbox else (None, (0, 0))
+        with self._lock:
+            self._sprites[key] = sprite
+            while len(self._sprites) > self.max_entries:
+                self._sprites.popitem(last=False)
+        return sprite
+
+    def paint(self, draw: ImageDraw, xy: tuple, text: str, font: ImageFont.FreeTypeFont, fill):
+        """draw.text(xy, text, fill=fill, font=font) と同じ結果を、キャッシュ済みスプライトで描画します。"""
+        frac_x, int_x = math.modf(xy[0])
+        frac_y, int_y = math.modf(xy[1])
+        mask, (offset_x, offset_y) = self._get(font, text, frac_x, frac_y)
+        if mask is not None:
+            draw.bitmap((int(int_x) + offset_x, int(int_y) + offset_y), mask, fill=fill)
+
+    def clear(self):
+        with self._lock:
+            self._sprites.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._sprites), "hits": self.hits, "misses": self.misses}
+
+static_text_sprites = StaticTextSpriteCache()
+
+
+# === ヘルパー関数 ===
+def calculate_font_size_linear(text: str, font_path: str, box_width: int, box_height: int) -> int:
+    """サイズ 1 から順に試す従来の線形スキャン (TextFitEngine の検証・ベンチマーク用の基準実装)。"""
+    font_size = 1
+    max_font_size = box_height + 10
+    try:
+        while font_size <= max_font_size:
+            font = get_font(font_path, font_size)
+            bbox = font.getbbox(text)
+            if bbox is None: return max(1, font_size - 1)
+            width = bbox[2] - bbox[0]
+            height = bbox[3] - bbox[1]
+            if width > box_width or height > box_height:
+                return max(1, font_size - 1)
+            font_size += 1
+        return max(1, font_size - 1)
+    except IOError:
+        logging.error(f"フォントファイルを開けません: {font_path}")
+        return 1
+    except Exception as e:
+        logging.error(f"フォント '{font_path}' のサイズ計算中にエラー: {e}")
+        return 1
+
+
+class TextFitEngine:
+    """
+    ボックスに収まる最大フォントサイズを求めるエンジン。
+    基準サイズの bbox からサイズを予測し、その周辺を二分探索して境界を確定します。
+    ヒンティングによる bbox の揺れを考慮し、予測値の誤差範囲内のサイズは下から再確認するため、
+    結果は calculate_font_size_linear と同じになります。結果は (text, font, box) 単位でメモ化します。
+    """
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max(1, max_entries)
+        self._memo: "OrderedDict[tuple, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def fit(self, text: str, font_path, box_width: int, box_height: int) -> int:
+        key = (text, str(font_path), box_width, box_height)
+        with self._lock:
+            size = self._memo.get(key)
+            if size is not None:
+                self._memo.move_to_end(key)
+                self.hits += 1
+                return size
+            self.misses += 1
+        try:
+            size = self._solve(text, str(font_path), box_width, box_height)
+        except IOError:
+            logging.error(f"フォントファイルを開けません: {font_path}")
+            return 1
+        except Exception as e:
+            logging.error(f"フォント '{font_path}' のサイズ計算中にエラー: {e}")
+            return 1
+        with self._lock:
+            self._memo[key] = size
+            while len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return size
+
+    def _solve(self, text: str, font_path: str, box_width: int, box_height: int) -> int:
+        max_font_size = box_height + 10
+
+        def fits(font_size: int) -> bool:
+            if font_size > max_font_size:
+                return False
+            bbox = get_font(font_path, font_size).getbbox(text)
+            return (bbox[2] - bbox[0]) <= box_width and (bbox[3] - bbox[1]) <= box_height
+
+        # 基準サイズでの bbox から 1px あたりの幅・高さを求めて境界を予測
+        ref_size = max(1, min(box_height, max_font_size))
+        ref_bbox = get_font(font_path, ref_size).getbbox(text)
+        ref_width = ref_bbox[2] - ref_bbox[0]
+        ref_height = ref_bbox[3] - ref_bbox[1]
+        limits = [max_font_size]
+        if ref_width > 0: limits.append(box_width * ref_size / ref_width)
+        if ref_height > 0: limits.append(box_height * ref_size / ref_height)
+        predicted = max(1, int(min(limits)))
+
+        # 予測値を挟む区間 [lo, hi) を探す (fits(lo) かつ not fits(hi))
+        lo, hi, step = predicted, predicted + 1, 1
+        while lo > 1 and not fits(lo):
+            hi = lo
+            lo = max(1, lo - step)
+            step *= 2
+        if not fits(lo):
+            return 1
+        step = 1
+        while fits(hi):
+            lo = hi
+            hi = min(max_font_size + 1, hi + step)
+            step *= 2
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if fits(mid): lo = mid
+            else: hi = mid
+
+        # 予測誤差 (グリフ毎の丸め) の範囲内にある小さいサイズも収まるか確認
+        width_slack = 2 * (len(text) + 2)
+        height_slack = 4
+        first_failure = hi
+        font_size = hi - 1
+        while font_size >= 1 and (
+            ref_width * font_size / ref_size + width_slack > box_width
+            or ref_height * font_size / ref_size + height_slack > box_height
+        ):
+            if not fits(font_size):
+                first_failure = font_size
+            font_size -= 1
+        return max(1, first_failure - 1)
+
+    def clear(self):
+        with self._lock:
+            self._memo.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._memo), "hits": self.hits, "misses": self.misses}
+
+text_fit_engine = TextFitEngine()
+
+def calculate_font_size(text: str, font_path: str, box_width: int, box_height: int) -> int:
+    return text_fit_engine.fit(text, font_path, box_width, box_height)
+
+
+# === Factory Pattern ===
+
+class FactoryRegistry:
+    def __init__(self):
+        self._factories: Dict[str, type] = {}
+        self._instances: Dict[str, 'BaseImageFactory'] = {}
+        self._lock = threading.Lock()
+    def register_factory(self, key: str, factory_cls: type):
+        if not issubclass(factory_cls, BaseImageFactory):
+            raise TypeError("factory_cls は BaseImageFactory を継承する必要があります")
+        self._factories[key] = factory_cls
+        self._instances.pop(key, None)
+        logging.debug(f"Factory 登録済み: {key} -> {factory_cls.__name__}")
+    def get_factory(self, key: str) -> 'BaseImageFactory':
+        """キーに対応する Factory を返します。Factory はステートレスなので、キー毎に 1 インスタンスを全スレッドで共有します。"""
+        factory = self._instances.get(key)
+        if factory is not None:
+            return factory
+        logging.debug(f"キー '{key}' の Factory を検索中")
+        factory_cls = self._factories.get(key)
+        if not factory_cls:
+            base_key = key.split('-')[0]
+            logging.debug(f"キー '{key}' が見つかりません。基本キー '{base_key}' を試行します")
+            factory_cls = self._factories.get(base_key)
+            if not factory_cls:
+                logging.error(f"キー '{key}' と基本キー '{base_key}' の両方に Template Factory が存在しません")
+                raise ValueError(f"Template Factory が存在しません: {key}")
+        logging.debug(f"キー '{key}' に対して Factory クラス {factory_cls.__name__} を使用します")
+        with self._lock:
+            return self._instances.setdefault(key, factory_cls())
+
+factory_registry = FactoryRegistry()
+
+def _freeze_layout(value):
+    """レイアウト定義 (dict / list) を読み取り専用の MappingProxyType / tuple に変換します。"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze_layout(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze_layout(v) for v in value)
+    return value
+
+@dataclass(frozen=True)
+class LayoutPlan:
+    """テンプレート (A〜F と -2 版) 毎に一度だけ作成される読み取り専用のレイアウト。"""
+    template_key: str
+    template_path: Path
+    width: int
+    height: int
+    has_mobile_area: bool
+    texts: Mapping[str, Mapping[str, Any]]          # *_params (テキストボックス)
+    price_groups: Mapping[str, Mapping[str, Any]]   # *_group (価格・単位・接尾辞)
+
+class BaseImageFactory:
+    # --- フォントと色の定義 ---
+    def __init__(self):
+        self.font_path_arial=FONTS_DIR/'ARIALNB.TTF';self.font_path_yugothB=FONTS_DIR/'YuGothB.ttc';self.font_path_noto_sans_black=FONTS_DIR/'NotoSansJP-Black.ttf';self.font_path_noto_sans_bold=FONTS_DIR/'NotoSansJP-Bold.ttf';self.font_path_noto_sans_medium=FONTS_DIR/'NotoSansJP-Medium.ttf';self.font_path_noto_serif_extrabold=FONTS_DIR/'NotoSerifJP-ExtraBold.ttf';self.font_path_reddit=FONTS_DIR/'RedditSans-ExtraBold.ttf';self.font_path_reddit_condensed_extrabold=FONTS_DIR/'RedditSansCondensed-ExtraBold.ttf';self.font_path_shippori_bold=FONTS_DIR/'ShipporiMinchoB1-Bold.ttf';self.font_path_public_sans_bold=FONTS_DIR/'PublicSans-Bold.ttf'
+        self.WHITE=(255,255,255);self.BLACK=(0,0,0);self.RED=(255,0,0)
+        self.width=800;self.height=800
+        self.mobile_start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':35,'y1':1250,'x2':475,'y2':1319,'align':'right'};
+        self.mobile_end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':535,'y1':1250,'x2':975,'y2':1319,'align':'left'}
+        self._plans: Dict[tuple, LayoutPlan] = {}
+        self._plans_lock = threading.Lock()
+
+    # --- レイアウトプラン ---
+    def compile_plan(self, template_key: str, has_mobile_data: bool) -> LayoutPlan:
+        """Factory のレイアウト定義を LayoutPlan にコンパイルします (テンプレート毎に 1 回だけ)。"""
+        plan_key = (template_key, has_mobile_data)
+        plan = self._plans.get(plan_key)
+        if plan is not None:
+            return plan
+        template_path = self.get_template_path(template_key, has_mobile_data)
+        has_mobile_area = has_mobile_data and template_path.name.endswith("-2.jpg")
+        attrs = vars(self)
+        plan = LayoutPlan(
+            template_key=template_key,
+            template_path=template_path,
+            width=self.width,
+            height=1370 if has_mobile_area else self.height,
+            has_mobile_area=has_mobile_area,
+            texts=_freeze_layout({k: v for k, v in attrs.items() if k.endswith('_params')}),
+            price_groups=_freeze_layout({k: v for k, v in attrs.items() if k.endswith('_group')}),
+        )
+        with self._plans_lock:
+            return self._plans.setdefault(plan_key, plan)
+
+    # --- ヘルパー関数 ---
+    def get_template_path(self, template_key: str, has_mobile_data: bool) -> Path:
+        base_key = template_key.split('-')[0]
+        template_file_name_base = f"template_{base_key}"
+        suffix = ".jpg"
+        mobile_template_path = TOOL03_TEMPLATES_DIR / f"{template_file_name_base}-2{suffix}"
+        normal_template_path = TOOL03_TEMPLATES_DIR / f"{template_file_name_base}{suffix}"
+        if has_mobile_data and mobile_template_path.exists():
+            logging.debug(f"モバイルテンプレートを使用: {mobile_template_path}")
+            return mobile_template_path
+        if not normal_template_path.exists():
+            logging.error(f"基本テンプレートが存在しません: {normal_template_path}")
+            raise FileNotFoundError(f"基本テンプレートが存在しません: {normal_template_path}")
+        logging.debug(f"通常テンプレートを使用: {normal_template_path}")
+        return normal_template_path
+
+    def _get_text_size(self, text: str, font: ImageFont.FreeTypeFont) -> tuple[int, int]:
+        try:
+            bbox = font.getbbox(text)
+            if bbox is None: return 0, 0
+            width = bbox[2] - bbox[0]
+            height = bbox[3] - bbox[1]
+            return width, height
+        except Exception as e:
+            logging.error(f"'{text}' の _get_text_size でエラー: {e}")
+            return 0, 0
+
+    def _place_text(self, draw: ImageDraw, params: Dict[str, Any]):
+        text = str(params.get('text', ''))
+        if not text:
+            return
+        font_path = str(params['font_path'])
+        font_color = params['font_color']
+        x1, y1, x2, y2 = params['x1'], params['y1'], params['x2'], params['y2']
+        align = params.get('align', 'left')
+        box_width = x2 - x1
+        box_height = y2 - y1
+        if box_width <= 0 or box_height <= 0:
+            logging.warning(f"テキスト '{text}' のバウンディングボックスが無効です: ({x1},{y1})-({x2},{y2})")
+            return
+        font_size = calculate_font_size(text, font_path, box_width, box_height)
+        if font_size <= 0:
+             logging.warning(f"テキスト '{text}' の計算済みフォントサイズが0以下です (ボックス: ({x1},{y1})-({x2},{y2}))")
+             return
+        try:
+            font = get_font(font_path, font_size)
+            text_width, _ = self._get_text_size(text, font)
+            if align == 'left':
+                x = x1
+            elif align == 'center':
+                x = x1 + (box_width - text_width) / 2
+            elif align == 'right':
+                x = x2 - text_width
+            else:
+                x = x1
+            bbox = font.getbbox(text)
+            if bbox is None: raise ValueError("フォントがテキスト配置用の None bbox を返しました")
+            text_actual_height = bbox[3] - bbox[1]
+            y_offset = bbox[1]
+            y = y1 + (box_height - text_actual_height) / 2 - y_offset
+            draw.text((x, y), text, fill=font_color, font=font)
+        except Exception as e:
+            logging.error(f"テキスト '{text}' (フォント {font_path} サイズ {font_size}) の描画中にエラー: {e}", exc_info=True)
+
+    def _format_price(self, price_str: Optional[str]) -> str:
+        if price_str is None: return ""
+        try:
+            price_decimal = Decimal(price_str).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+            return f"{int(price_decimal):,}"
+        except Exception:
+            return str(price_str)
+
+    def _calculate_discount_display(self, regular_price_str: Optional[str], sale_price_str: Optional[str], discount_type: Optional[str]) -> str:
+        if regular_price_str is None or sale_price_str is None: return ""
+        try:
+            regular_price = Decimal(regular_price_str)
+            sale_price = Decimal(sale_price_str)
+            if regular_price <= 0 or regular_price <= sale_price: return ""
+            difference = regular_price - sale_price
+            if discount_type == "yen":
+                discount_val = difference.quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+                return f"{int(discount_val):,}円"
+            else:
+                percentage = (difference / regular_price * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+                return f"{int(percentage)}%"
+        except Exception as e:
+            logging.warning(f"割引計算エラー ({regular_price_str}, {sale_price_str}, {discount_type}): {e}")
+            return ""
+
+    def _format_datetime_jp(self, iso_str: Optional[str]) -> str:
+        """ISO (YYYY-MM-DDTHH:mm) 形式の日付文字列を日本語形式 (MM月DD日HH:mm) に変換します。"""
+        if not iso_str:
+            return ""
+        try:
+            # fromisoformat を使って ISO 文字列をパース
+            dt = datetime.datetime.fromisoformat(iso_str)
+            # f-string を使って 0 埋めなしでフォーマット
+            return f"{dt.month}月{dt.day}日{dt.hour}:{dt.minute:02d}"
+        except ValueError:
+            logging.warning(f"無効な日付形式のため、そのまま返します: {iso_str}")
+            return iso_str # パース失敗時は元の文字列をそのまま返す
+        except Exception as e:
+            logging.error(f"日付フォーマットエラー ({iso_str}): {e}")
+            return iso_str # その他のエラー時も元の文字列を返す
+    # ----------------------------------------------
+
+    def _place_price_group(self, draw: ImageDraw, price_params: Dict, unit_params: Dict, suffix_params: Dict):
+        price_text = str(price_params.get('text', ''))
+        unit_text = str(unit_params.get('text', ''))
+        suffix_text = str(suffix_params.get('text', ''))
+        if not price_text: return
+        gap_width = 5
+        try:
+            price_font = get_font(price_params['font_path'], price_params['font_size'])
+            unit_font = get_font(unit_params['font_path'], unit_params['font_size']) if unit_text else None
+            suffix_font = get_font(suffix_params['font_path'], suffix_params['font_size']) if suffix_text else None
+            price_w, _ = self._get_text_size(price_text, price_font)
+            unit_w, _ = self._get_text_size(unit_text, unit_font) if unit_font else (0, 0)
+            suffix_w, _ = self._get_text_size(suffix_text, suffix_font) if suffix_font else (0, 0)
+            total_width = price_w
+            if unit_text: total_width += gap_width + unit_w
+            if suffix_text: total_width += gap_width + suffix_w
+            container_width = price_params['x_end'] - price_params['x_origin']
+            start_x = price_params['x_origin'] + (container_width - total_width) / 2
+            price_y = price_params['y_origin']
+            draw.text((start_x, price_y), price_text, fill=price_params['font_color'], font=price_font)
+            current_x = start_x + price_w
+            if unit_font:
+                current_x += gap_width
+                unit_y = price_y + unit_params.get('dy', 0)
+                static_text_sprites.paint(draw, (current_x, unit_y), unit_text, unit_font, unit_params['font_color'])
+                current_x += unit_w
+            if suffix_font:
+                current_x += gap_width
+                suffix_y = price_y + suffix_params.get('dy', 0)
+                static_text_sprites.paint(draw, (current_x, suffix_y), suffix_text, suffix_font, suffix_params['font_color'])
+        except Exception as e:
+            logging.error(f"価格 '{price_text}' の _place_price_group でエラー: {e}", exc_info=True)
+
+    def draw(self, row_data: Tool03ProductRowInput, template_key: str) -> Image.Image:
+        has_mobile_data = bool(row_data.mobileStartDate and row_data.mobileEndDate)
+        try:
+            plan = self.compile_plan(template_key, has_mobile_data)
+        except FileNotFoundError:
+            logging.error(f"テンプレートキー '{template_key}' (モバイル: {has_mobile_data}) のテンプレートファイルが見つかりません")
+            raise
+        return self.render(plan, row_data)
+
+    def render(self, plan: LayoutPlan, row_data: Tool03ProductRowInput) -> Image.Image:
+        """plan と行データから画像を描画します。共有状態を変更しないため、複数スレッドから同時に呼び出せます。"""
+        img = self.render_shared_layer(plan, row_data)
+        self.draw_price_layer(img, plan, row_data)
+        return img
+
+    def render_shared_layer(self, plan: LayoutPlan, row_data: Tool03ProductRowInput) -> Image.Image:
+        """
+        価格以外の要素 (日時・セール文言・priceType・モバイル日時) をテンプレートのコピーに描画します。
+        これらが同じ行同士はこの画像を共有し、draw_price_layer で価格だけを重ねることができます。
+        """
+        has_mobile_data = bool(row_data.mobileStartDate and row_data.mobileEndDate)
+        try:
+            img = template_cache.get(plan.template_path)
+            draw_obj = ImageDraw.Draw(img)
+            self._draw_shared_details(draw_obj, plan, row_data)
+            if has_mobile_data:
+                 if plan.has_mobile_area:
+                     logging.debug(f"{plan.template_key} の _draw_mobile_details を呼び出し")
+                     self._draw_mobile_details(draw_obj, plan, row_data)
+                 else:
+                     logging.warning(f"モバイルデータはありますが、{plan.template_key} のモバイルテンプレートが見つからないため、モバイル詳細はスキップします。")
+            return img
+        except FileNotFoundError:
+            logging.error(f"テンプレートキー '{plan.template_key}' (モバイル: {has_mobile_data}) のテンプレートファイルが見つかりません")
+            raise
+        except Exception as e:
+            logging.error(f"テンプレートキー '{plan.template_key}' の画像描画中に不明なエラー: {e}", exc_info=True)
+            raise
+
+    def draw_price_layer(self, img: Image.Image, plan: LayoutPlan, row_data: Tool03ProductRowInput):
+        """行毎に異なる価格・割引の要素を img に描画します。"""
+        try:
+            self._draw_price_details(ImageDraw.Draw(img), plan, row_data)
+        except Exception as e:
+            logging.error(f"テンプレートキー '{plan.template_key}' の価格描画中に不明なエラー: {e}", exc_info=True)
+            raise
+
+    def _split_discount(self, row_data: Tool03ProductRowInput) -> tuple[str, str]:
+        """割引表示を数値部分と単位 ('%' / '円' / '') に分けて返します。"""
+        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
+        discount_number = discount_text_val.replace('%', '').replace('円', '')
+        discount_unit_text = '%' if '%' in discount_text_val else '円' if '円' in discount_text_val else ''
+        return discount_number, discount_unit_text
+
+    def _draw_shared_details(self, draw: ImageDraw, plan: LayoutPlan, row_data: Tool03ProductRowInput):
+        texts = plan.texts
+        self._place_text(draw, {**texts['start_datetime_params'], 'text': self._format_datetime_jp(row_data.startDate)})
+        self._place_text(draw, {**texts['end_datetime_params'], 'text': self._format_datetime_jp(row_data.endDate)})
+        self._place_text(draw, {**texts['message_params'], 'text': row_data.saleText or ""})
+        # priceType を描画 (例: 当店通常価格)
+        self._place_text(draw, {**texts['price_type_params'], 'text': row_data.priceType or ""})
+
+    def _draw_price_details(self, draw: ImageDraw, plan: LayoutPlan, row_data: Tool03ProductRowInput):
+        # 注意: 'normal_price_group' は priceType を含まず、価格のみを描画します
+        # 行毎のテキストはプランをコピーした dict に入れる (プラン自体は変更しない)
+        groups = plan.price_groups
+        normal, discount, sale = groups['normal_price_group'], groups['discount_group'], groups['sale_price_group']
+        discount_number, discount_unit_text = self._split_discount(row_data)
+        self._place_price_group(draw, {**normal['price'], 'text': self._format_price(row_data.regularPrice)}, normal['unit'], normal['suffix'])
+        self._place_price_group(draw, {**discount['price'], 'text': discount_number}, {**discount['unit'], 'text': discount_unit_text}, discount['suffix'])
+        self._place_price_group(draw, {**sale['price'], 'text': self._format_price(row_data.salePrice)}, sale['unit'], sale['suffix'])
+
+    def _draw_mobile_details(self, draw: ImageDraw, plan: LayoutPlan, row_data: Tool03ProductRowInput):
+        logging.debug(f"{self.__class__.__name__} のデフォルト _draw_mobile_details を呼び出し")
+        if row_data.mobileStartDate:
+            self._place_text(draw, {**plan.texts['mobile_start_datetime_params'], 'text': self._format_datetime_jp(row_data.mobileStartDate)})
+        if row_data.mobileEndDate:
+            self._place_text(draw, {**plan.texts['mobile_end_datetime_params'], 'text': self._format_datetime_jp(row_data.mobileEndDate)})
+        # -----------------------------------------
+
+# --- Factory の実装 (A, B, B2, C, C2, ...) ---
+class FactoryTypeA(BaseImageFactory):
+    def __init__(self):
+        super().__init__()
+        self.width, self.height = 800, 880
+        self.RED = (189, 41, 39)
+        self.start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.BLACK,'x1':270,'y1':80,'x2':771,'y2':125,'align':'center'}
+        self.end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.BLACK,'x1':270,'y1':190,'x2':771,'y2':235,'align':'center'}
+        self.message_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':30,'y1':280,'x2':770,'y2':370,'align':'center'}
+        
+        # --- 新規追加 (START) ---
+        # RTF (800px) とサンプルに基づく。左揃えの代わりに中央揃え。
+        self.price_type_params={'font_path':self.font_path_noto_sans_bold, 'font_color':self.WHITE, 'x1':65, 'y1':410, 'x2':805, 'y2':450, 'align':'left'}
+        # --- 新規追加 (END) ---
+
+        self.normal_price_group={
+            # X座標は価格 (price)、単位 (unit)、接尾辞 (suffix) のみを含むように調整
+            'price': {'text':'', 'font_path':self.font_path_public_sans_bold,'font_size':60,'font_color':self.WHITE,'x_origin':330,'x_end':740,'y_origin':395},
+            'unit':  {'text':'円', 'font_path':self.font_path_noto_sans_black, 'font_size':30,'font_color':self.WHITE,'dy':20},
+            'suffix':{'text':'のところ','font_path':self.font_path_noto_sans_black,'font_size':25,'font_color':self.WHITE,'dy':25}
+        }
+        self.discount_group={
+             'price': {'text':'', 'font_path':self.font_path_public_sans_bold,'font_size':85,'font_color':self.BLACK,'x_origin':0,'x_end':self.width,'y_origin':485},
+             'unit':  {'text':'', 'font_path':self.font_path_noto_sans_black, 'font_size':50,'font_color':self.BLACK,'dy':20},
+             'suffix':{'text':'OFF','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.BLACK,'dy':45}
+        }
+        self.sale_price_group={
+            'price': {'text':'', 'font_path':self.font_path_public_sans_bold,'font_size':160,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':620},
+            'unit':  {'text':'円', 'font_path':self.font_path_noto_sans_black, 'font_size':50,'font_color':self.RED,'dy':90},
+            'suffix':{'text':'税込','font_path':self.font_path_noto_sans_black,'font_size':20,'font_color':self.RED,'dy':70}
+        }
+factory_registry.register_factory('A', FactoryTypeA)
+
+class FactoryTypeB(BaseImageFactory):
+    def __init__(self):
+        super().__init__()
+        self.width, self.height = 1000, 1000
+        self.YELLOW=(255,239,0); self.RED=(215,0,0)
+        self.start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':25,'y1':162,'x2':465,'y2':231,'align':'right'}
+        self.end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':555,'y1':162,'x2':995,'y2':231,'align':'left'}
+        self.message_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':107,'y1':38,'x2':894,'y2':148,'align':'center'}
+        
+        # --- 新規追加 (START) ---
+        # 1000px 推定: normal_price_group (Y=370) の上。
+        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.WHITE, 'x1':0, 'y1':310, 'x2':1000, 'y2':360, 'align':'center'}
+        # --- 新規追加 (END) ---
+        
+        self.normal_price_group={
+            'price': {'text':'','font_path':self.font_path_reddit,'font_size':130,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':370},
+            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.WHITE,'dy':35},
+            'suffix':{'text':'のところ','font_path':self.font_path_noto_sans_black,'font_size':50,'font_color':self.WHITE,'dy':65}
+        }
+        self.discount_group={
+             'price': {'text':'','font_path':self.font_path_reddit,'font_size':95,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':540},
+             'unit':  {'text':'','font_path':self.font_path_noto_sans_black,'font_size':60,'font_color':self.RED,'dy':20},
+             'suffix':{'text':'OFF','font_path':self.font_path_noto_sans_black,'font_size':40,'font_color':self.RED,'dy':45}
+        }
+        self.sale_price_group={
+            'price': {'text':'','font_path':self.font_path_reddit,'font_size':230,'font_color':self.YELLOW,'x_origin':0,'x_end':self.width,'y_origin':660},
+            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.YELLOW,'dy':130},
+            'suffix':{'text':'税込','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.YELLOW,'dy':100}
+        }
+factory_registry.register_factory('B', FactoryTypeB)
+
+class FactoryTypeB2(FactoryTypeB):
+    def __init__(self):
+        super().__init__()
+        # --- 上書き (START) ---
+        # Yシフト +45 (RTF 768px に基づく: 390 - 345 = 45)
+        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.WHITE, 'x1':0, 'y1':310, 'x2':1000, 'y2':360, 'align':'center'}
+        # --- 上書き (END) ---
+    
+    # _draw_shared_details は継承され、上書きされた self.price_type_params を自動的に使用します。
+    pass
+factory_registry.register_factory('B-2', FactoryTypeB2)
+
+class FactoryTypeC(BaseImageFactory):
+    def __init__(self):
+        super().__init__()
+        self.width, self.height = 1000, 1000
+        self.YELLOW=(235, 210, 150); self.RED=(150,0,0)
+        self.start_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.WHITE,'x1':25,'y1':187,'x2':465,'y2':252,'align':'right'}
+        self.end_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.WHITE,'x1':530,'y1':187,'x2':960,'y2':252,'align':'left'}
+        self.message_params={'font_path':self.font_path_shippori_bold,'font_color':self.WHITE,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
+        
+        # --- 新規追加 (START) ---
+        # 1000px 推定: normal_price_group (Y=360) の上。
+        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.WHITE, 'x1':0, 'y1':310, 'x2':1000, 'y2':360, 'align':'center'}
+        # --- 新規追加 (END) ---
+
+        self.normal_price_group={
+            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':130,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':360},
+            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.WHITE,'dy':65},
+            'suffix':{'text':'のところ','font_path':self.font_path_shippori_bold,'font_size':50,'font_color':self.WHITE,'dy':95}
+        }
+        self.discount_group={
+             'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':95,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':530},
+             'unit':  {'text':'','font_path':self.font_path_shippori_bold,'font_size':60,'font_color':self.RED,'dy':40},
+             'suffix':{'text':'OFF','font_path':self.font_path_shippori_bold,'font_size':40,'font_color':self.RED,'dy':65}
+        }
+        self.sale_price_group={
+            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':200,'font_color':self.YELLOW,'x_origin':0,'x_end':self.width,'y_origin':650},
+            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.YELLOW,'dy':145},
+            'suffix':{'text':'税込','font_path':self.font_path_shippori_bold,'font_size':30,'font_color':self.YELLOW,'dy':115}
+        }
+factory_registry.register_factory('C', FactoryTypeC)
+
+class FactoryTypeC2(FactoryTypeC):
+    def __init__(self):
+        super().__init__()
+        # --- 上書き (START) ---
+        # Yシフト +75 (RTF 768px に基づく: 435 - 360 = 75)
+        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.WHITE, 'x1':0, 'y1':300+35, 'x2':1000, 'y2':350+35, 'align':'center'}
+        # --- 上書き (END) ---
+    pass
+factory_registry.register_factory('C-2', FactoryTypeC2)
+
+class FactoryTypeD(BaseImageFactory):
+    def __init__(self):
+        super().__init__()
+        # ... (Factory D のパラメータは変更なし) ...
+        self.width, self.height = 1000, 1000
+        self.BROWN=(90,70,50); self.RED=(215,0,0)
+        self.start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':25,'y1':187,'x2':465,'y2':252,'align':'right'}
+        self.end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':530,'y1':187,'x2':960,'y2':252,'align':'left'}
+        self.message_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
+
+        # --- 新規追加 (START) ---
+        # 1000px 推定: normal_price_group (Y=380) の上。
+        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.BROWN, 'x1':0, 'y1':315, 'x2':1000, 'y2':370, 'align':'center'}
+        # --- 新規追加 (END) ---
+        
+        self.normal_price_group={
+            'price': {'text':'','font_path':self.font_path_public_sans_bold,'font_size':130,'font_color':self.BROWN,'x_origin':0,'x_end':self.width,'y_origin':380},
+            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.BROWN,'dy':35},
+            'suffix':{'text':'のところ','font_path':self.font_path_noto_sans_black,'font_size':50,'font_color':self.BROWN,'dy':60}
+        }
+        self.discount_group={
+             'price': {'text':'','font_path':self.font_path_public_sans_bold,'font_size':85,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':550},
+             'unit':  {'text':'','font_path':self.font_path_noto_sans_black,'font_size':50,'font_color':self.WHITE,'dy':15},
+             'suffix':{'text':'OFF','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.WHITE,'dy':40}
+        }
+        self.sale_price_group={
+            'price': {'text':'','font_path':self.font_path_public_sans_bold,'font_size':200,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':700},
+            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.RED,'dy':95},
+            'suffix':{'text':'税込','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.RED,'dy':65}
+        }
+factory_registry.register_factory('D', FactoryTypeD)
+
+class FactoryTypeD2(FactoryTypeD):
+    def __init__(self):
+        super().__init__()
+        # --- 上書き (START) ---
+        # Yシフト +20 (RTF 768px に基づく)
+        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.BROWN, 'x1':0, 'y1':315+20, 'x2':1000, 'y2':370+20, 'align':'center'}
+        # --- 上書き (END) ---
+    pass
+factory_registry.register_factory('D-2', FactoryTypeD2)
+
+class FactoryTypeE(BaseImageFactory):
+    def __init__(self):
+        super().__init__()
+        # ... (Factory E のパラメータは変更なし) ...
+        self.width, self.height = 1000, 1000
+        self.SILVER=(204,204,204); self.GOLD=(235, 210, 150)
+        self.start_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.BLACK,'x1':25,'y1':200,'x2':465,'y2':265,'align':'right'}
+        self.end_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.BLACK,'x1':530,'y1':200,'x2':960,'y2':265,'align':'left'}
+        self.message_params={'font_path':self.font_path_shippori_bold,'font_color':self.BLACK,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
+
+        # --- 新規追加 (START) ---
+        # 1000px 推定: normal_price_group (Y=360) の上。
+        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.SILVER, 'x1':0, 'y1':325, 'x2':1000, 'y2':385, 'align':'center'}
+        # --- 新規追加 (END) ---
+        
+        self.normal_price_group={
+            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':130,'font_color':self.SILVER,'x_origin':0,'x_end':self.width,'y_origin':360},
+            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.SILVER,'dy':65},
+            'suffix':{'text':'のところ','font_path':self.font_path_shippori_bold,'font_size':50,'font_color':self.SILVER,'dy':95}
+        }
+        self.discount_params={
+            'font_path':self.font_path_shippori_bold,
+            'font_color':self.GOLD,
+            'x1': 645, 'y1': 620, 'x2': 965, 'y2': 670,
+            'align':'center'
+        }
+        self.sale_price_group={
+            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':200,'font_color':self.GOLD,'x_origin':0,'x_end':self.width,'y_origin':650},
+            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.GOLD,'dy':145},
+            'suffix':{'text':'税込','font_path':self.font_path_shippori_bold,'font_size':30,'font_color':self.GOLD,'dy':115}
+        }
+    def _draw_price_details(self, draw: ImageDraw, plan: LayoutPlan, row_data: Tool03ProductRowInput):
+        # E は割引を "NN%OFF" / "NN円OFF" の 1 行テキストで描画
+        texts, groups = plan.texts, plan.price_groups
+        discount_number, discount_unit_text = self._split_discount(row_data)
+        discount_display_text = f"{discount_number}{discount_unit_text}OFF" if discount_unit_text else ""
+        self._place_text(draw, {**texts['discount_params'], 'text': discount_display_text})
+        normal, sale = groups['normal_price_group'], groups['sale_price_group']
+        self._place_price_group(draw, {**normal['price'], 'text': self._format_price(row_data.regularPrice)}, normal['unit'], normal['suffix'])
+        self._place_price_group(draw, {**sale['price'], 'text': self._format_price(row_data.salePrice)}, sale['unit'], sale['suffix'])
+factory_registry.register_factory('E', FactoryTypeE)
+
+class FactoryTypeE2(FactoryTypeE):
+    def __init__(self):
+        super().__init__()
+        # --- 上書き (START) ---
+        # Yシフト +45 (コード 290+45 に基づく)
+        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.SILVER, 'x1':0, 'y1':290+45, 'x2':1000, 'y2':350+45, 'align':'center'}
+        # --- 上書き (END) ---
+    pass
+factory_registry.register_factory('E-2', FactoryTypeE2)
+
+class FactoryTypeF(BaseImageFactory):
+    def __init__(self):
+        super().__init__()
+        # ... (Factory F のパラメータは変更なし) ...
+        self.width, self.height = 1000, 1000
+        self.BLACK=(93, 95, 96); self.GOLD=(210, 172, 67)
+        self.start_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.GOLD,'x1':25,'y1':187,'x2':465,'y2':252,'align':'right'}
+        self.end_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.GOLD,'x1':530,'y1':187,'x2':960,'y2':252,'align':'left'}
+        self.message_params={'font_path':self.font_path_shippori_bold,'font_color':self.GOLD,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
+        
+        # --- 新規追加 (START) ---
+        # 1000px 推定: normal_price_group (Y=360) の上。
+        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.BLACK, 'x1':0, 'y1':320, 'x2':1000, 'y2':370, 'align':'center'}
+        # --- 新規追加 (END) ---
+
+        self.normal_price_group={
+            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':130,'font_color':self.BLACK,'x_origin':0,'x_end':self.width,'y_origin':360},
+            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.BLACK,'dy':65},
+            'suffix':{'text':'のところ','font_path':self.font_path_shippori_bold,'font_size':50,'font_color':self.BLACK,'dy':95}
+        }
+        self.discount_group={
+             'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':95,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':530},
+             'unit':  {'text':'','font_path':self.font_path_shippori_bold,'font_size':60,'font_color':self.WHITE,'dy':40},
+             'suffix':{'text':'OFF','font_path':self.font_path_shippori_bold,'font_size':40,'font_color':self.WHITE,'dy':65}
+        }
+        self.sale_price_group={
+            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':200,'font_color':self.GOLD,'x_origin':0,'x_end':self.width,'y_origin':650},
+            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.GOLD,'dy':145},
+            'suffix':{'text':'税込','font_path':self.font_path_shippori_bold,'font_size':30,'font_color':self.GOLD,'dy':115}
+        }
+factory_registry.register_factory('F', FactoryTypeF)
+
+class FactoryTypeF2(FactoryTypeF):
+    def __init__(self):
+        super().__init__()
+        # --- 上書き (START) ---
+        # Yシフト +40 (コード 290+40, 350+40 に基づく)
+        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.BLACK, 'x1':0, 'y1':290+40, 'x2':1000, 'y2':350+40, 'align':'center'}
+        # --- 上書き (END) ---
+    pass
+factory_registry.register_factory('F-2', FactoryTypeF2)
+
+# === 行単位の描画処理 ===
+def resolve_factory_key(row: Tool03ProductRowInput) -> str:
+    """行のテンプレート名とモバイル日時から Factory キー (例: 'B', 'B-2') を決定します。"""
+    template_name = row.template or "テンプレートA"
+    base_key = template_name.replace("テンプレート", "")
+    factory_key = base_key
+    has_mobile_data = bool(row.mobileStartDate and row.mobileEndDate)
+    potential_mobile_key = f"{base_key}-2"
+    if has_mobile_data and potential_mobile_key in factory_registry._factories:
+        factory_key = potential_mobile_key
+    logging.debug(f"  - 受信テンプレート名: '{row.template}' / base_key: '{base_key}' / 最終 factory_key: '{factory_key}'")
+    return factory_key
+
+# 画像の内容に影響する行フィールド (productCode はファイル名のみに使われるため含めない)
+RENDER_RELEVANT_FIELDS = (
+    "template", "startDate", "endDate", "priceType", "regularPrice", "salePrice",
+    "saleText", "discountType", "mobileStartDate", "mobileEndDate",
+)
+
+def row_fingerprint(row: Tool03ProductRowInput) -> str:
+    """行の描画結果 (画像の内容とファイル名) を決める入力のハッシュ。PATCH 時の差分判定に使います。"""
+    payload = json.dumps([row.productCode] + [getattr(row, field) for field in RENDER_RELEVANT_FIELDS], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def render_cache_key(row: Tool03ProductRowInput, factory_key: str, plan: LayoutPlan, encoder: Tool03EncoderOptions) -> Optional[str]:
+    """行のレンダーキャッシュキーを返します (キャッシュ無効時や計算できない場合は None)。"""
+    if not render_cache.enabled:
+        return None
+    try:
+        fields = {field: getattr(row, field) for field in RENDER_RELEVANT_FIELDS}
+        return render_cache.make_key(factory_key, plan.template_path, fields, extra=sorted(encoder.model_dump().items()))
+    except OSError:
+        return None
+
+def get_job_encoder(job_data: Optional[Dict[str, Any]]) -> Tool03EncoderOptions:
+    """ジョブに保存されたエンコード設定を返します (未設定の場合は既定値)。"""
+    encoder = (job_data or {}).get("encoder")
+    return Tool03EncoderOptions(**encoder) if encoder else DEFAULT_ENCODER_OPTIONS
+
+def output_filename_for(row: Tool03ProductRowInput, encoder: Tool03EncoderOptions) -> str:
+    return f"{row.productCode}{output_suffix(encoder)}"
+
+def content_hash(data: bytes) -> str:
+    """画像の内容のハッシュ (結果の contentHash と画像の ETag に使用)。"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+def file_content_hash(path: Path) -> str:
+    with open(path, "rb") as f:
+        return content_hash(f.read())
+
+def write_bytes_atomic(data: bytes, output_path: Path):
+    """一時ファイルに書き込んでから置き換えます (レンダーキャッシュとハードリンクで共有しているファイルを書き換えないため)。"""
+    tmp_path = output_path.with_name(f".{output_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, output_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+def _save_row_image(job_id: str, row: Tool03ProductRowInput, factory_key: str, job_dir: str, draw_image,
+                    encoder: Tool03EncoderOptions, cache_key: Optional[str] = None, keep_encoded: bool = False) -> Dict[str, Any]:
+    """draw_image() で描画した画像を encoder の設定でエンコードして job_dir に保存し、Tool03ImageResult 形式の dict を返します。"""
+    result = Tool03ImageResult(status="Processing").model_dump()
+    try:
+        img: Image.Image = draw_image()
+        encoded = encode_image(img, encoder)
+        img.close()
+        output_filename = output_filename_for(row, encoder)
+        output_path = Path(job_dir) / output_filename
+        write_bytes_atomic(encoded.data, output_path)
+        result["status"] = "Success"
+        result["filename"] = output_filename
+        result["fileSize"] = len(encoded.data)
+        result["encodeTimeMs"] = round(encoded.encode_time_ms, 2)
+        result["quality"] = encoded.quality
+        result["contentHash"] = content_hash(encoded.data)
+        if keep_encoded:
+            # 呼び出し元 (service.cache_rendered_image) でメモリキャッシュに保存する
+            stat = output_path.stat()
+            result["encoded"] = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), encoded.data)
+        if cache_key:
+            render_cache.store(cache_key, output_path)
+    except (FileNotFoundError, ValueError, NotImplementedError) as e:
+        logging.error(f"[Job {job_id}] 画像 ({row.productCode}, テンプレート '{factory_key}') の処理エラー: {e}")
+        result["status"] = "Error"
+        result["message"] = str(e)
+    except Exception as draw_error:
+        logging.error(f"[Job {job_id}] 画像 ({row.productCode}, テンプレート '{factory_key}') の描画中に不明なエラー: {draw_error}", exc_info=True)
+        result["status"] = "Error"
+        result["message"] = "画像描画中に不明なエラーが発生しました。"
+    return result
+
+def render_row_image(job_id: str, row: Tool03ProductRowInput, job_dir: str, encoder: Optional[Tool03EncoderOptions] = None) -> Dict[str, Any]:
+    """
+    1 行分の画像を描画して job_dir に保存し、Tool03ImageResult 形式の dict を返します。
+    レンダーワーカープロセスからも呼び出されるため、job_store には触れません。
+    """
+    return render_row_batch(job_id, [row], job_dir, encoder)[0]
+
+def shared_layer_key(row: Tool03ProductRowInput) -> tuple:
+    """共通レイヤー (価格以外の描画内容) を決めるフィールドの組。この値が同じ行は共通レイヤーを共有できます。"""
+    has_mobile_data = bool(row.mobileStartDate and row.mobileEndDate)
+    return (
+        row.template or "テンプレートA", row.startDate, row.endDate, row.saleText or "", row.priceType or "",
+        row.mobileStartDate if has_mobile_data else None, row.mobileEndDate if has_mobile_data else None,
+    )
+
+def plan_render_batches(rows: List[Tool03ProductRowInput], max_batch_size: int) -> List[List[List[int]]]:
+    """
+    rows を共通レイヤーのキー毎にまとめ、最大 max_batch_size 行のバッチ (行インデックスのリスト) に分けます。
+    出力ファイル名 (productCode) が同じ行は同じファイルに書き込むため、2 回目以降の出現を後のラウンドに分け、
+    入力順の最後の行が最後に書き込まれるようにします。戻り値はラウンド毎のバッチのリストで、
+    同じラウンドのバッチは並行に描画でき、ラウンドは前のラウンドの完了後に順に描画してください。
+    """
+    occurrences: Dict[str, int] = {}
+    rounds: List[List[List[int]]] = []
+    open_batches: List[Dict[tuple, List[int]]] = []
+    for index, row in enumerate(rows):
+        round_index = occurrences.get(row.productCode, 0)
+        occurrences[row.productCode] = round_index + 1
+        if round_index == len(rounds):
+            rounds.append([])
+            open_batches.append({})
+        key = shared_layer_key(row)
+        batch = open_batches[round_index].get(key)
+        if batch is None or len(batch) >= max_batch_size:
+            batch = []
+            open_batches[round_index][key] = batch
+            rounds[round_index].append(batch)
+        batch.append(index)
+    return rounds
+
+def iter_render_row_batch(job_id: str, rows: List[Tool03ProductRowInput], job_dir: str, encoder: Optional[Tool03EncoderOptions] = None,
+                          keep_encoded: bool = False):
+    """
+    shared_layer_key が同じ rows の共通レイヤーを 1 回だけ描画し、そのコピーに各行の価格レイヤーを重ねて保存します。
+    レンダーキャッシュにある行は描画せずにキャッシュからリンクします。
+    行毎の結果 dict を順に yield します (キャッシュから再利用した行は "cacheHit": True、
+    keep_encoded の場合に描画した行は "encoded" を含みます。どちらも呼び出し元で取り除きます)。
+    """
+    encoder = encoder or DEFAULT_ENCODER_OPTIONS
+    factory_key = resolve_factory_key(rows[0])
+    has_mobile_data = bool(rows[0].mobileStartDate and rows[0].mobileEndDate)
+    factory = plan = shared = None
+    plan_error: Optional[Exception] = None
+    try:
+        factory = factory_registry.get_factory(factory_key)
+        plan = factory.compile_plan(factory_key, has_mobile_data)
+    except Exception as e:
+        plan_error = e
+
+    def get_shared_layer() -> Image.Image:
+        # 共通レイヤーはキャッシュに無い行が現れた時点で初めて描画する
+        nonlocal shared
+        if plan_error is not None:
+            raise plan_error
+        if shared is None:
+            shared = factory.render_shared_layer(plan, rows[0])
+        return shared
+
+    for position, row in enumerate(rows):
+        cache_key = render_cache_key(row, factory_key, plan, encoder) if plan is not None else None
+        if cache_key:
+            output_filename = output_filename_for(row, encoder)
+            output_path = Path(job_dir) / output_filename
+            if render_cache.fetch(cache_key, output_path):
+                result = Tool03ImageResult(
+                    status="Success", filename=output_filename, fileSize=output_path.stat().st_size,
+                    contentHash=file_content_hash(output_path),
+                )
+                yield {**result.model_dump(), "cacheHit": True}
+                continue
+
+        def draw_image():
+            base = get_shared_layer()
+            # 最後の行は共通レイヤーに直接描画する (コピー不要)
+            img = base if position == len(rows) - 1 else base.copy()
+            factory.draw_price_layer(img, plan, row)
+            return img
+        yield _save_row_image(job_id, row, factory_key, job_dir, draw_image, encoder, cache_key, keep_encoded)
+
+def render_row_batch(job_id: str, rows: List[Tool03ProductRowInput], job_dir: str, encoder: Optional[Tool03EncoderOptions] = None,
+                     keep_encoded: bool = False) -> List[Dict[str, Any]]:
+    return list(iter_render_row_batch(job_id, rows, job_dir, encoder, keep_encoded))
+
+
+# === レンダーワーカープロセスの初期化 ===
+def prewarm_render_caches():
+    """全テンプレートと、各 Factory の固定サイズのフォントを事前に読み込みます。"""
+    template_count = template_cache.preload()
+    for factory_cls in set(factory_registry._factories.values()):
+        try:
+            factory = factory_cls()
+        except Exception as e:
+            logging.warning(f"{factory_cls.__name__} の事前読み込みをスキップします: {e}")
+            continue
+        for value in vars(factory).values():
+            if not (isinstance(value, dict) and 'price' in value):
+                continue
+            for part in value.values():
+                try:
+                    get_font(part['font_path'], part['font_size'])
+                except (IOError, KeyError):
+                    pass
+    logging.debug(f"レンダーキャッシュを事前読み込みしました: テンプレート {template_count} 件, フォント {font_cache.stats()['size']} 件")
+
+def _init_render_worker():
+    prewarm_render_caches()
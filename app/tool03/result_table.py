@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import sys
+import math
+from array import array
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional
+
+# ステータスは小さな整数コードで保存します (インデックス = コード)
+RESULT_STATUS_CODES = ("Pending", "Processing", "Success", "Error")
+_STATUS_TO_CODE = {status: code for code, status in enumerate(RESULT_STATUS_CODES)}
+
+# contentHash (sha256 の先頭 32 桁の 16 進) を生のバイト列で保存する幅
+CONTENT_HASH_BYTES = 16
+_NO_CONTENT_HASH = bytes(CONTENT_HASH_BYTES)
+
+
+class ResultTable(MutableMapping):
+    """
+    ジョブの行毎の結果 (row.id -> Tool03ImageResult 形式の dict) を列毎の配列で保持するテーブル。
+    1 行 1 dict の代わりにステータスは整数コード、ファイル名は intern した文字列、
+    サイズ・エンコード時間・品質は array で保持し、メッセージはある行だけ保持します。
+    内容のハッシュは 1 行 16 バイトの生のダイジェストとして bytearray に詰めて保持し、読み出し時に 16 進に戻します (全て 0 = None)。
+    dict として読み出した値はその都度組み立てたコピーのため、変更する場合は代入し直してください。
+    各行は最後に更新されたときのジョブのバージョンも保持します (差分ポーリング用、set() で指定)。
+    """
+    __slots__ = ("_index", "_status", "_filenames", "_file_sizes", "_encode_times", "_qualities", "_messages", "_content_hashes", "_other_content_hashes", "_versions")
+
+    def __init__(self, results: Optional[Dict[str, Dict[str, Any]]] = None):
+        self._index: Dict[str, int] = {}      # row.id -> 列のインデックス
+        self._status = array("b")
+        self._filenames: List[Optional[str]] = []
+        self._file_sizes = array("q")         # -1 = None
+        self._encode_times = array("f")       # NaN = None
+        self._qualities = array("B")          # 0 = None
+        self._messages: Dict[int, str] = {}
+        self._content_hashes = bytearray()   # 1 行 CONTENT_HASH_BYTES バイト
+        self._other_content_hashes: Dict[int, str] = {}  # 16 進 32 桁以外の値 (通常は空)
+        self._versions = array("q")
+        if results:
+            self.update(results)
+
+    def __setitem__(self, row_id: str, result: Dict[str, Any]):
+        self.set(row_id, result)
+
+    def set(self, row_id: str, result: Dict[str, Any], version: int = 0):
+        slot = self._index.get(row_id)
+        if slot is None:
+            slot = len(self._status)
+            self._index[row_id] = slot
+            self._status.append(0)
+            self._filenames.append(None)
+            self._file_sizes.append(-1)
+            self._encode_times.append(math.nan)
+            self._qualities.append(0)
+            self._content_hashes += _NO_CONTENT_HASH
+            self._versions.append(0)
+        self._versions[slot] = version
+        self._status[slot] = _STATUS_TO_CODE[result["status"]]
+        filename = result.get("filename")
+        self._filenames[slot] = sys.intern(filename) if filename else None
+        file_size = result.get("fileSize")
+        self._file_sizes[slot] = -1 if file_size is None else file_size
+        encode_time = result.get("encodeTimeMs")
+        self._encode_times[slot] = math.nan if encode_time is None else encode_time
+        self._qualities[slot] = result.get("quality") or 0
+        self._set_content_hash(slot, result.get("contentHash"))
+        message = result.get("message")
+        if message is None:
+            self._messages.pop(slot, None)
+        else:
+            self._messages[slot] = message
+
+    def _set_content_hash(self, slot: int, content_hash: Optional[str]):
+        start = slot * CONTENT_HASH_BYTES
+        digest = _NO_CONTENT_HASH
+        self._other_content_hashes.pop(slot, None)
+        if content_hash:
+            try:
+                digest = bytes.fromhex(content_hash)
+            except ValueError:
+                digest = b""
+            if len(digest) != CONTENT_HASH_BYTES or digest == _NO_CONTENT_HASH:
+                # 想定外の形式はそのまま別に保持します
+                self._other_content_hashes[slot] = content_hash
+                digest = _NO_CONTENT_HASH
+        self._content_hashes[start:start + CONTENT_HASH_BYTES] = digest
+
+    def _content_hash(self, slot: int) -> Optional[str]:
+        start = slot * CONTENT_HASH_BYTES
+        digest = self._content_hashes[start:start + CONTENT_HASH_BYTES]
+        if digest == _NO_CONTENT_HASH:
+            return self._other_content_hashes.get(slot)
+        return digest.hex()
+
+    def _row(self, slot: int) -> Dict[str, Any]:
+        file_size = self._file_sizes[slot]
+        encode_time = self._encode_times[slot]
+        quality = self._qualities[slot]
+        return {
+            "status": RESULT_STATUS_CODES[self._status[slot]],
+            "filename": self._filenames[slot],
+            "message": self._messages.get(slot),
+            "fileSize": None if file_size < 0 else file_size,
+            "encodeTimeMs": None if math.isnan(encode_time) else round(encode_time, 2),
+            "quality": quality or None,
+            "contentHash": self._content_hash(slot),
+        }
+
+    def __getitem__(self, row_id: str) -> Dict[str, Any]:
+        return self._row(self._index[row_id])
+
+    def __delitem__(self, row_id: str):
+        # 列は詰めずに空きのまま残す (削除はまれなため)
+        slot = self._index.pop(row_id)
+        self._filenames[slot] = None
+        self._set_content_hash(slot, None)
+        self._messages.pop(slot, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, row_id: object) -> bool:
+        return row_id in self._index
+
+    def __repr__(self) -> str:
+        return f"ResultTable({len(self)} rows)"
+
+    def status(self, row_id: str) -> Optional[str]:
+        slot = self._index.get(row_id)
+        return None if slot is None else RESULT_STATUS_CODES[self._status[slot]]
+
+    def filenames(self, status: str = "Success") -> List[str]:
+        """指定したステータスの行のファイル名を返します (dict を組み立てずに走査)。"""
+        code = _STATUS_TO_CODE[status]
+        return [
+            self._filenames[slot] for slot in self._index.values()
+            if self._status[slot] == code and self._filenames[slot]
+        ]
+
+    def version(self, row_id: str) -> int:
+        return self._versions[self._index[row_id]]
+
+    def copy(self, since: Optional[int] = None) -> "ResultTable":
+        """コピーを返します。since を指定した場合はバージョンが since より新しい行のみ含めます。"""
+        if since is not None:
+            table = ResultTable()
+            for row_id, slot in self._index.items():
+                if self._versions[slot] > since:
+                    table.set(row_id, self._row(slot), self._versions[slot])
+            return table
+        table = ResultTable()
+        table._index = dict(self._index)
+        table._status = array("b", self._status)
+        table._filenames = list(self._filenames)
+        table._file_sizes = array("q", self._file_sizes)
+        table._encode_times = array("f", self._encode_times)
+        table._qualities = array("B", self._qualities)
+        table._messages = dict(self._messages)
+        table._content_hashes = bytearray(self._content_hashes)
+        table._other_content_hashes = dict(self._other_content_hashes)
+        table._versions = array("q", self._versions)
+        return table
+
+    def to_dict(self, fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """API のレスポンス形式 (row.id -> dict) に変換します。fields を指定した場合はそのキーのみ含めます。"""
+        if fields is None:
+            return {row_id: self._row(slot) for row_id, slot in self._index.items()}
+        return {
+            row_id: {name: value for name, value in self._row(slot).items() if name in fields}
+            for row_id, slot in self._index.items()
+        }
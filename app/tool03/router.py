@@ -1,115 +1,194 @@
 # -*- coding: utf-8 -*-
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Path, Body
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Path, Body, Query, Header
+from fastapi.responses import FileResponse, StreamingResponse
 import os
 import shutil
-from typing import List, Dict
+from typing import List, Dict, Optional
 import datetime # datetime をインポート
+from contextlib import asynccontextmanager
 
 # 同一ディレクトリ (.) から schemas と controller をインポート
 from . import schemas
 from . import controller
 from . import service as tool03_service # ジョブステータス確認用の service をインポート
 
+@asynccontextmanager
+async def lifespan(_app):
+    # ジョブキューのワーカーを起動 (前回の起動で未完了のジョブも再開) し、終了時は実行中のジョブをキューに戻す
+    tool03_service.start_job_runner()
+    yield
+    await tool03_service.stop_job_runner()
+
 router = APIRouter(
     prefix="/api/tools/03",
     tags=["Tool 03 - 二重価格画像作成"],
+    lifespan=lifespan,
 )
 
 # --- エンドポイント /jobs (POST) ---
 @router.post(
     "/jobs",
     response_model=schemas.Tool03CreateJobResponse,
-    status_code=202 # 受理 (Accepted)
+    status_code=202, # 受理 (Accepted)
+    responses={
+        413: {"description": "1 ジョブの行数の上限を超えています"},
+        429: {"description": "キュー内の行数の上限 (会社毎・全体) を超えています。Retry-After 秒後に再試行してください"},
+    },
 )
 async def create_image_generation_job(
     request: schemas.Tool03CreateJobRequest,
-    background_tasks: BackgroundTasks
+    x_company_id: Optional[str] = Header(None, max_length=64, description="ジョブキューで公平に順番を割り当てる単位 (会社 ID)"),
 ):
-    """画像生成ジョブをバックグラウンドで開始します。"""
-    return controller.start_image_generation_job(request.productRows, background_tasks)
+    """画像生成ジョブをキューに登録します (ワーカーが空き次第バックグラウンドで実行)。"""
+    callback_url = str(request.callbackUrl) if request.callbackUrl else None
+    return controller.start_image_generation_job(request.productRows, request.encoder, callback_url, x_company_id)
 
 # --- エンドポイント /jobs/{job_id} (PATCH) ---
 @router.patch(
     "/jobs/{job_id}",
+    response_model=schemas.Tool03UpdateJobResponse,
     status_code=202 # 受理 (Accepted)
-    # コマンドを受け取るだけなので response_model は不要
 )
 async def update_image_generation_job(
     request: schemas.Tool03CreateJobRequest, # 既存のスキーマを再利用
-    background_tasks: BackgroundTasks,
-    job_id: str = Path(..., description="更新対象のジョブID", min_length=36, max_length=36)
+    job_id: str = Path(..., description="更新対象のジョブID", min_length=36, max_length=36),
+    x_company_id: Optional[str] = Header(None, max_length=64, description="省略時はジョブ作成時の会社 ID"),
 ):
-    """ジョブ内の指定された画像を再生成するためのバックグラウンドタスクを開始します。"""
+    """ジョブ内の指定された画像のうち、入力が変更された行だけを再生成するバックグラウンドタスクを開始します。"""
     if not request.productRows:
          # 実行する内容がないため、202 (または 200 OK) を返す
-         return {"message": "更新対象の行が指定されていません。"} 
+         return schemas.Tool03UpdateJobResponse(message="更新対象の行が指定されていません。")
+
+    # controller を呼び出してバックグラウンド更新タスクを開始 (変更のない行はスキップ)
+    return controller.start_image_regeneration_job(job_id, request.productRows, x_company_id)
 
-    # controller を呼び出してバックグラウンド更新タスクを開始
-    controller.start_image_regeneration_job(job_id, request.productRows, background_tasks)
-    return {"message": f"ジョブ {job_id} の画像再生成タスクが開始されました。"}
+# --- エンドポイント /jobs/{job_id} (DELETE) ---
+@router.delete(
+    "/jobs/{job_id}",
+    response_model=schemas.Tool03JobControlResponse,
+    status_code=202, # 受理 (Accepted)
+    responses={404: {"description": "ジョブが見つかりません"}, 409: {"description": "ジョブは既に終了しています"}},
+)
+async def cancel_image_generation_job(
+    job_id: str = Path(..., description="キャンセル対象のジョブID", min_length=36, max_length=36),
+):
+    """ジョブの描画 (キュー待ち・一時停止中を含む) と FTP アップロードをキャンセルします。描画済みの画像は残ります。"""
+    return controller.job_control_controller(job_id, "cancel")
+
+# --- エンドポイント /jobs/{job_id}/pause, /jobs/{job_id}/resume (POST) ---
+@router.post(
+    "/jobs/{job_id}/pause",
+    response_model=schemas.Tool03JobControlResponse,
+    status_code=202, # 受理 (Accepted)
+    responses={404: {"description": "ジョブが見つかりません"}, 409: {"description": "一時停止できる処理がありません"}},
+)
+async def pause_image_generation_job(
+    job_id: str = Path(..., description="一時停止するジョブID", min_length=36, max_length=36),
+):
+    """ジョブの描画と FTP アップロードを一時停止します (描画中の行・アップロード中のファイルが終わった時点で停止)。"""
+    return controller.job_control_controller(job_id, "pause")
+
+@router.post(
+    "/jobs/{job_id}/resume",
+    response_model=schemas.Tool03JobControlResponse,
+    status_code=202, # 受理 (Accepted)
+    responses={404: {"description": "ジョブが見つかりません"}, 409: {"description": "ジョブは一時停止されていません"}},
+)
+async def resume_image_generation_job(
+    job_id: str = Path(..., description="再開するジョブID", min_length=36, max_length=36),
+):
+    """一時停止したジョブを再開します (描画は完了済みの行を除いて続きから)。"""
+    return controller.job_control_controller(job_id, "resume")
 
 # --- エンドポイント /jobs/{job_id}/status (GET) ---
 @router.get(
     "/jobs/{job_id}/status",
-    response_model=schemas.Tool03JobStatusResponse
+    response_model=schemas.Tool03JobStatusResponse,
+    responses={304: {"description": "前回のレスポンス (If-None-Match の ETag) から変更なし"}},
 )
 async def get_job_status(
-    job_id: str = Path(..., description="確認対象のジョブID", min_length=36, max_length=36) # UUID長制約
+    job_id: str = Path(..., description="確認対象のジョブID", min_length=36, max_length=36), # UUID長制約
+    since: Optional[int] = Query(None, ge=0, description="前回のレスポンスの version。指定するとそれ以降に変更された行のみ results に含めます"),
+    fields: Optional[str] = Query(None, description="results の各行に含めるフィールド (カンマ区切り、例: status,filename)"),
+    summary: bool = Query(False, description="true の場合は results を含めず、件数などの概要のみ返します"),
+    if_none_match: Optional[str] = Header(None),
 ):
     """画像生成ジョブのステータスを確認します。"""
-    status_data = controller.get_job_status_controller(job_id)
+    status_data = controller.get_job_status_controller(job_id, since, fields, summary, if_none_match)
     if status_data is None:
         raise HTTPException(status_code=404, detail="ジョブが見つかりません")
     return status_data
 
+# --- エンドポイント /jobs/{job_id}/events (GET, SSE) ---
+@router.get(
+    "/jobs/{job_id}/events",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}, "description": "row / job / ftp / progress イベントのストリーム"}},
+)
+async def stream_job_events(
+    job_id: str = Path(..., description="対象のジョブID", min_length=36, max_length=36),
+    last_event_id: Optional[str] = Header(None, description="再接続時にブラウザが送信する最後のイベント ID (ジョブのバージョン)"),
+    last_event_id_query: Optional[str] = Query(None, alias="lastEventId", description="Last-Event-ID ヘッダーの代わりに指定する場合"),
+):
+    """ジョブの進捗 (行の完了・ジョブの完了・FTP ステータス) を Server-Sent Events で配信します。"""
+    response = controller.stream_job_events_controller(job_id, last_event_id or last_event_id_query)
+    if response is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return response
+
 # --- エンドポイント /jobs/{job_id}/image/{filename} (GET) ---
 @router.get(
     "/jobs/{job_id}/image/{filename}",
-    response_class=FileResponse
+    response_class=FileResponse,
+    responses={
+        206: {"description": "Range で指定した範囲"},
+        304: {"description": "If-None-Match / If-Modified-Since から変更なし"},
+    },
 )
 async def get_image_file(
     job_id: str = Path(..., description="ジョブID", min_length=36, max_length=36),
-    filename: str = Path(..., description="取得対象の画像ファイル名")
+    filename: str = Path(..., description="取得対象の画像ファイル名"),
+    v: Optional[str] = Query(None, description="結果の contentHash。現在の画像と一致する場合は長期間キャッシュ可能 (immutable) として返します"),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range"),
 ):
-    """ジョブによって生成された画像ファイルを取得します。"""
-    file_path = controller.get_image_file_path_controller(job_id, filename)
-    if not file_path or not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="画像が見つかりません")
-    
+    """ジョブによって生成された画像ファイルを取得します (ETag・Range 対応、描画直後の画像はメモリから返します)。"""
     # ファイル名が有効かチェック (セキュリティエラー回避)
     if ".." in filename or filename.startswith("/"):
         raise HTTPException(status_code=400, detail="無効なファイル名です")
 
-    return FileResponse(file_path, media_type="image/jpeg", filename=filename)
+    response = controller.get_image_file_response_controller(job_id, filename, v, if_none_match, if_modified_since, range_header)
+    if response is None:
+        raise HTTPException(status_code=404, detail="画像が見つかりません")
+    return response
 
 
 # --- エンドポイント /jobs/{job_id}/download (GET) ---
 @router.get(
     "/jobs/{job_id}/download",
-    response_class=FileResponse
+    response_class=FileResponse,
+    responses={
+        200: {"content": {"application/zip": {}}, "description": "ジョブの全画像を含む Zip (無圧縮)"},
+        206: {"description": "Range で指定した範囲 (作成済みのアーカイブのみ)"},
+        304: {"description": "If-None-Match から変更なし"},
+    },
 )
 async def download_images_zip(
-    job_id: str = Path(..., description="ダウンロード対象のジョブID", min_length=36, max_length=36)
+    job_id: str = Path(..., description="ダウンロード対象のジョブID", min_length=36, max_length=36),
+    if_none_match: Optional[str] = Header(None),
 ):
-    """ジョブの全画像を含む Zip ファイルを作成してダウンロードします。"""
-    zip_path = controller.create_images_zip_controller(job_id)
-    if not zip_path or not os.path.exists(zip_path):
-        raise HTTPException(status_code=404, detail="ジョブが見つからないか、Zip の作成に失敗しました")
-    
+    """
+    ジョブの全画像を含む Zip ファイルをダウンロードします。
+    終了したジョブはキャッシュしたアーカイブを返し (ETag・Range 対応、中断したダウンロードを再開可能)、
+    それ以外は作成しながら送信します (一時ファイルは作成しません)。
+    """
     # ユーザーに返す Zip ファイル名を生成
     # download_filename = f"tool03_images_{job_id}.zip" # <<< 古い行
     today_str = datetime.date.today().strftime('%Y%m%d') # 現在の日付 (YYYYMMDD) を取得
     download_filename = f"{today_str}_image.zip"         # 新しいファイル名を生成
 
-    # FileResponse を使用して Zip ファイルを送信
-    # background=BackgroundTask(os.remove, zip_path) # 送信後に Zip ファイルを自動削除 (任意)
-    return FileResponse(
-        path=zip_path,
-        filename=download_filename,
-        media_type='application/zip',
-        # background=BackgroundTask(os.remove, zip_path) # 自動削除する場合はコメント解除
-    )
+    return controller.download_images_zip_controller(job_id, download_filename, if_none_match)
 
 # --- エンドポイント /jobs/{job_id}/upload (POST) ---
 @router.post(
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, HttpUrl
+from typing import List, Optional, Dict, Any, Literal
 
 # --- 入力スキーマ ---
 class Tool03ProductRowInput(BaseModel):
@@ -19,14 +19,43 @@ class Tool03ProductRowInput(BaseModel):
         mobileStartDate: Optional[str] = Field(None, description="楽天モバイル開始日時 (YYYY-MM-DDTHH:mm)")
         mobileEndDate: Optional[str] = Field(None, description="楽天モバイル終了日時 (YYYY-MM-DDTHH:mm)")
 
+class Tool03EncoderOptions(BaseModel):
+        """出力画像のエンコード設定 (ジョブ単位)。既定値は従来の JPEG (品質 95) と同じ出力になります。"""
+        format: Literal["jpeg", "webp"] = Field("jpeg", description="出力形式 (jpeg, webp)")
+        quality: int = Field(95, ge=1, le=100, description="品質 (maxBytes 指定時は探索の上限)")
+        progressive: bool = Field(False, description="プログレッシブ JPEG で出力する (JPEG のみ)")
+        optimize: bool = Field(False, description="ハフマンテーブルを最適化する (WebP の場合は高圧縮モード)")
+        subsampling: Optional[Literal["4:4:4", "4:2:2", "4:2:0"]] = Field(None, description="クロマサブサンプリング (JPEG のみ、未指定時は Pillow の既定値)")
+        stripMetadata: bool = Field(True, description="テンプレート由来の EXIF / XMP / ICC プロファイルを出力しない")
+        maxBytes: Optional[int] = Field(None, gt=0, description="目標の最大ファイルサイズ (bytes)。指定時はこのサイズ以下になる最も高い品質を探索します")
+
 class Tool03CreateJobRequest(BaseModel):
         productRows: List[Tool03ProductRowInput]
+        encoder: Optional[Tool03EncoderOptions] = Field(None, description="出力画像のエンコード設定 (POST のみ有効、PATCH ではジョブ作成時の設定を使用)")
+        callbackUrl: Optional[HttpUrl] = Field(None, description="ジョブ完了時・FTP アップロード完了時に署名付き POST を送信する URL (POST のみ有効)")
 
 # --- 出力スキーマ ---
 class Tool03CreateJobResponse(BaseModel):
         jobId: str
         status: str = "Pending"
         totalItems: int
+        queueDepth: int = Field(0, description="このジョブより先に実行される (実行中を含む) ジョブ数")
+        rowsAhead: int = Field(0, description="このジョブより先に実行される行数")
+        estimatedStartSeconds: float = Field(0, description="実行開始までの目安 (秒)")
+        estimatedCompletionSeconds: float = Field(0, description="完了までの目安 (秒)")
+
+class Tool03UpdateJobResponse(BaseModel):
+        """PATCH /jobs/{job_id} のレスポンス"""
+        message: str
+        changedItems: int = Field(0, description="入力が変更されたため再生成する行数")
+        unchangedRowIds: List[str] = Field(default_factory=list, description="前回の描画から入力が変わっていないため再生成をスキップした行 ID")
+
+class Tool03JobControlResponse(BaseModel):
+        """DELETE /jobs/{job_id}, POST /jobs/{job_id}/pause, /resume のレスポンス"""
+        jobId: str
+        message: str
+        status: str = Field(..., description="受け付けた時点のジョブのステータス (実行中の場合は描画中の行が終わった時点で Paused / Cancelled になります)")
+        control: Optional[str] = Field(None, description="受け付けた要求 (paused, cancelled。再開の場合は None)")
 
 # --- ジョブステータス用スキーマ ---
 class Tool03ImageResult(BaseModel):
@@ -34,21 +63,35 @@ class Tool03ImageResult(BaseModel):
         status: str = Field(..., description="処理ステータス (Success, Error, Processing, Pending)") # Pending を追加
         filename: Optional[str] = Field(None, description="生成された画像ファイル名 (成功時)")
         message: Optional[str] = Field(None, description="エラーメッセージ (失敗時)")
+        fileSize: Optional[int] = Field(None, description="出力ファイルのサイズ (bytes, 成功時)")
+        encodeTimeMs: Optional[float] = Field(None, description="エンコードにかかった時間 (ms, レンダーキャッシュから再利用した場合は None)")
+        quality: Optional[int] = Field(None, description="実際に使用した品質 (レンダーキャッシュから再利用した場合は None)")
+        contentHash: Optional[str] = Field(None, description="画像の内容のハッシュ (成功時)。画像 URL に ?v= で付けると長期間キャッシュされます")
 
 class Tool03JobStatusResponse(BaseModel):
         """ジョブのステータス情報"""
         jobId: str
-        status: str = Field(..., description="全体のステータス (Pending, Processing, Completed, Completed with errors, Failed)")
+        status: str = Field(..., description="全体のステータス (Pending, Processing, Paused, Completed, Completed with errors, Failed, Cancelled)")
         progress: int = Field(..., description="処理済みの画像数 (Success または Error)")
+        statusCounts: Dict[str, int] = Field(default_factory=dict, description="行ステータス毎の件数 (Pending, Processing, Success, Error)")
         total: int = Field(..., description="処理対象の総画像数")
-        results: Dict[str, Tool03ImageResult] = Field(..., description="各画像の詳細結果 (キーは row.id)")
+        results: Dict[str, Tool03ImageResult] = Field(..., description="各画像の詳細結果 (キーは row.id)。since 指定時は変更された行のみ、summary 指定時は空")
+        version: int = Field(0, description="ジョブのバージョン (状態が変わる度に増加)。次回のポーリングで since に指定します")
+        since: Optional[int] = Field(None, description="results の基準としたバージョン (None の場合は全行)")
         startTime: float
         endTime: Optional[float] = Field(None)
         message: Optional[str] = Field(None, description="全体のエラーメッセージ (ジョブが Failed の場合)") # 共通メッセージ追加
+        encoder: Optional[Tool03EncoderOptions] = Field(None, description="ジョブのエンコード設定")
+        callbackUrl: Optional[str] = Field(None, description="完了通知の送信先 URL")
+        control: Optional[str] = Field(None, description="受け付けた一時停止・キャンセルの要求 (paused, cancelled)")
 
         # --- FTPステータスフィールドを追加 ---
-        ftpUploadStatusGold: Optional[str] = Field("idle", description="FTP GOLD アップロードステータス (idle, uploading, success, failed)")
+        ftpUploadStatusGold: Optional[str] = Field("idle", description="FTP GOLD アップロードステータス (idle, uploading, paused, success, failed, cancelled)")
         ftpUploadErrorGold: Optional[str] = Field(None, description="FTP GOLD アップロードエラーメッセージ")
-        ftpUploadStatusRcabinet: Optional[str] = Field("idle", description="FTP R-Cabinet アップロードステータス (idle, uploading, success, failed)")
+        ftpUploadStatusRcabinet: Optional[str] = Field("idle", description="FTP R-Cabinet アップロードステータス (idle, uploading, paused, success, failed, cancelled)")
         ftpUploadErrorRcabinet: Optional[str] = Field(None, description="FTP R-Cabinet アップロードエラーメッセージ")
-        # ------------------------------------
\ No newline at end of file
+        # ------------------------------------
+
+        # --- レンダーキャッシュ ---
+        renderCacheHits: int = Field(0, description="レンダーキャッシュから再利用した画像数")
+        renderCacheMisses: int = Field(0, description="新たに描画した画像数")
\ No newline at end of file
@@ -1,862 +1,815 @@
 # -*- coding: utf-8 -*-
 import os
-import uuid
 import shutil
 from pathlib import Path
-from typing import List, Dict, Any, Optional
-from PIL import Image, ImageDraw, ImageFont
+from typing import Iterator, List, Dict, Any, Optional, Union
 import asyncio
-from decimal import Decimal, ROUND_HALF_UP
 import time
-import tempfile
 import ftplib
 import logging
-import datetime  # <<< datetime のインポートを追加
+import math
+import threading
+from urllib.parse import quote
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from app.core.config import (
+    TOOL03_RENDER_WORKERS, TOOL03_RENDER_BATCH_SIZE,
+    TOOL03_JOB_STORE, TOOL03_JOB_STORE_SQLITE_PATH, TOOL03_JOB_STORE_FLUSH_INTERVAL, TOOL03_JOB_STORE_FLUSH_ROWS,
+    TOOL03_SSE_HEARTBEAT_INTERVAL, TOOL03_SSE_POLL_INTERVAL, TOOL03_SSE_MIN_INTERVAL,
+    TOOL03_WEBHOOK_SECRET, TOOL03_WEBHOOK_CONCURRENCY, TOOL03_WEBHOOK_MAX_ATTEMPTS, TOOL03_WEBHOOK_TIMEOUT, TOOL03_WEBHOOK_BACKOFF,
+    TOOL03_WEBHOOK_ALLOWED_HOSTS,
+    TOOL03_JOB_QUEUE, TOOL03_JOB_QUEUE_SQLITE_PATH, TOOL03_JOB_QUEUE_WORKERS, TOOL03_JOB_QUEUE_POLL_INTERVAL,
+    TOOL03_JOB_QUEUE_LEASE_SECONDS, TOOL03_JOB_QUEUE_MAX_ATTEMPTS, TOOL03_JOB_QUEUE_PRIORITY_MAX_ROWS,
+    TOOL03_MAX_ROWS_PER_JOB, TOOL03_MAX_QUEUED_ROWS_PER_COMPANY, TOOL03_MAX_INFLIGHT_ROWS, TOOL03_JOB_QUEUE_ROWS_PER_SECOND,
+    TOOL03_JOB_CONTROL_INTERVAL, TOOL03_JOB_CHECKPOINT_DIR, TOOL03_ZIP_CACHE_MAX_BYTES,
+    TOOL03_FILE_SERVING, TOOL03_FILE_SERVING_PREFIX, TOOL03_IMAGE_MEMORY_CACHE_MAX_BYTES,
+)
 
 # 同じディレクトリ (.) から schemas をインポート
-from .schemas import Tool03ProductRowInput, Tool03JobStatusResponse, Tool03ImageResult
-
-# --- パス解決ロジック ---
-# ... (パスロジック部分は変更なし) ...
-SERVICE_FILE_PATH = Path(__file__).resolve()
-APP_DIR = SERVICE_FILE_PATH.parent.parent
-PROJECT_ROOT = APP_DIR.parent
-ASSETS_DIR = PROJECT_ROOT / "assets"
-if not ASSETS_DIR.is_dir():
-    ASSETS_DIR = APP_DIR / "assets"
-    if not ASSETS_DIR.is_dir():
-        raise FileNotFoundError(
-            f"assets ディレクトリが見つかりません: {PROJECT_ROOT / 'assets'} または {APP_DIR / 'assets'}"
-        )
-FONTS_DIR = ASSETS_DIR / "fonts"
-if not FONTS_DIR.is_dir():
-     raise FileNotFoundError(f"フォントディレクトリが見つかりません: {FONTS_DIR}")
-TOOL03_TEMPLATES_DIR_OPTION1 = ASSETS_DIR / "tool03" / "templates"
-TOOL03_TEMPLATES_DIR_OPTION2 = APP_DIR / "tool03" / "assets" / "templates"
-if TOOL03_TEMPLATES_DIR_OPTION1.is_dir():
-    TOOL03_TEMPLATES_DIR = TOOL03_TEMPLATES_DIR_OPTION1
-elif TOOL03_TEMPLATES_DIR_OPTION2.is_dir():
-    TOOL03_TEMPLATES_DIR = TOOL03_TEMPLATES_DIR_OPTION2
-else:
-    raise FileNotFoundError(
-        f"Tool 03 テンプレートディレクトリが見つかりません: {TOOL03_TEMPLATES_DIR_OPTION1} または {TOOL03_TEMPLATES_DIR_OPTION2}"
-    )
-# --- パス解決ロジックの終わり ---
+from .schemas import Tool03ProductRowInput, Tool03JobStatusResponse, Tool03ImageResult, Tool03EncoderOptions
+from .encoder import DEFAULT_ENCODER_OPTIONS
+# 描画処理 (レンダーワーカープロセスはこのモジュールのみ読み込む)
+from .renderer import (
+    PROJECT_ROOT, render_cache, row_fingerprint, get_job_encoder, output_filename_for, file_content_hash,
+    plan_render_batches, iter_render_row_batch, render_row_batch, _init_render_worker,
+)
+from .job_store import create_job_store
+from .result_table import ResultTable, RESULT_STATUS_CODES
+from .job_events import JobEventHub, format_sse
+from .webhooks import WebhookSender
+from .job_queue import LANE_HIGH, LANE_NORMAL, PAUSED, JobRunner, QueueEntry, QueueFullError, create_job_queue
+from .checkpoint import JobCheckpoint, JobCheckpointStore
+from .zip_stream import iter_stored_zip
+from .zip_artifacts import ZipArtifactCache
 
 
 # ジョブストレージパス
 JOB_STORAGE_BASE_DIR = PROJECT_ROOT / "storage" / "tool03_jobs"
 JOB_STORAGE_BASE_DIR.mkdir(parents=True, exist_ok=True)
 
-# --- ジョブステータスストレージ (インメモリ) ---
-job_tracker: Dict[str, Dict[str, Any]] = {}
+# 完了したジョブのダウンロード用 Zip アーカイブ (バージョン毎に作成し、再生成後は変更のないエントリを再利用)
+zip_artifacts = ZipArtifactCache(PROJECT_ROOT / "storage" / "tool03_zip_cache", TOOL03_ZIP_CACHE_MAX_BYTES)
+
+# --- ジョブステータスストレージ ---
+# TOOL03_JOB_STORE=sqlite / database の場合は複数の uvicorn ワーカー間で共有され、再起動後も残ります
+job_store = create_job_store(
+    TOOL03_JOB_STORE, PROJECT_ROOT / TOOL03_JOB_STORE_SQLITE_PATH,
+    TOOL03_JOB_STORE_FLUSH_INTERVAL, TOOL03_JOB_STORE_FLUSH_ROWS,
+)
+# ジョブの変更を SSE 接続に通知する (ジョブストアへの書き込みが読み出し可能になった時点で呼ばれる)
+job_events = JobEventHub()
+job_store.add_listener(job_events.notify)
+# 描画・再生成を実行するジョブキュー (ランナーはファイル末尾で作成)
+job_queue = create_job_queue(
+    TOOL03_JOB_QUEUE, PROJECT_ROOT / TOOL03_JOB_QUEUE_SQLITE_PATH,
+    TOOL03_JOB_QUEUE_LEASE_SECONDS, TOOL03_JOB_QUEUE_MAX_ATTEMPTS,
+)
+# 描画ジョブの入力と行毎の進捗 (再起動時に未完了のジョブを続きから再開する)
+job_checkpoints = JobCheckpointStore(PROJECT_ROOT / TOOL03_JOB_CHECKPOINT_DIR if TOOL03_JOB_CHECKPOINT_DIR else None)
+# ジョブ完了・FTP アップロード完了のコールバック (callbackUrl 指定時のみ)
+webhook_sender = WebhookSender(
+    TOOL03_WEBHOOK_SECRET, TOOL03_WEBHOOK_CONCURRENCY, TOOL03_WEBHOOK_MAX_ATTEMPTS,
+    TOOL03_WEBHOOK_TIMEOUT, TOOL03_WEBHOOK_BACKOFF, TOOL03_WEBHOOK_ALLOWED_HOSTS.split(","),
+)
 # ----------------------------------------------
 
 
-# === ヘルパー関数 ===
-def calculate_font_size(text: str, font_path: str, box_width: int, box_height: int) -> int:
-    font_size = 1
-    max_font_size = box_height + 10
-    try:
-        while font_size <= max_font_size:
-            font = ImageFont.truetype(str(font_path), font_size)
-            bbox = font.getbbox(text)
-            if bbox is None: return max(1, font_size - 1)
-            width = bbox[2] - bbox[0]
-            height = bbox[3] - bbox[1]
-            if width > box_width or height > box_height:
-                return max(1, font_size - 1)
-            font_size += 1
-        return max(1, font_size - 1)
-    except IOError:
-        logging.error(f"フォントファイルを開けません: {font_path}")
-        return 1
-    except Exception as e:
-        logging.error(f"フォント '{font_path}' のサイズ計算中にエラー: {e}")
-        return 1
-
-
-# === Factory Pattern ===
-
-class FactoryRegistry:
-    def __init__(self):
-        self._factories: Dict[str, type] = {}
-    def register_factory(self, key: str, factory_cls: type):
-        if not issubclass(factory_cls, BaseImageFactory):
-            raise TypeError("factory_cls は BaseImageFactory を継承する必要があります")
-        self._factories[key] = factory_cls
-        logging.debug(f"Factory 登録済み: {key} -> {factory_cls.__name__}")
-    def get_factory(self, key: str) -> 'BaseImageFactory':
-        logging.debug(f"キー '{key}' の Factory を検索中")
-        factory_cls = self._factories.get(key)
-        if not factory_cls:
-            base_key = key.split('-')[0]
-            logging.debug(f"キー '{key}' が見つかりません。基本キー '{base_key}' を試行します")
-            factory_cls = self._factories.get(base_key)
-            if not factory_cls:
-                logging.error(f"キー '{key}' と基本キー '{base_key}' の両方に Template Factory が存在しません")
-                raise ValueError(f"Template Factory が存在しません: {key}")
-        logging.debug(f"キー '{key}' に対して Factory クラス {factory_cls.__name__} を使用します")
-        return factory_cls()
-
-factory_registry = FactoryRegistry()
-
-class BaseImageFactory:
-    # --- フォントと色の定義 ---
-    def __init__(self):
-        self.font_path_arial=FONTS_DIR/'ARIALNB.TTF';self.font_path_yugothB=FONTS_DIR/'YuGothB.ttc';self.font_path_noto_sans_black=FONTS_DIR/'NotoSansJP-Black.ttf';self.font_path_noto_sans_bold=FONTS_DIR/'NotoSansJP-Bold.ttf';self.font_path_noto_sans_medium=FONTS_DIR/'NotoSansJP-Medium.ttf';self.font_path_noto_serif_extrabold=FONTS_DIR/'NotoSerifJP-ExtraBold.ttf';self.font_path_reddit=FONTS_DIR/'RedditSans-ExtraBold.ttf';self.font_path_reddit_condensed_extrabold=FONTS_DIR/'RedditSansCondensed-ExtraBold.ttf';self.font_path_shippori_bold=FONTS_DIR/'ShipporiMinchoB1-Bold.ttf';self.font_path_public_sans_bold=FONTS_DIR/'PublicSans-Bold.ttf'
-        self.WHITE=(255,255,255);self.BLACK=(0,0,0);self.RED=(255,0,0)
-        self.width=800;self.height=800
-        self.mobile_start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':35,'y1':1250,'x2':475,'y2':1319,'align':'right'};
-        self.mobile_end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':535,'y1':1250,'x2':975,'y2':1319,'align':'left'}
-
-    # --- ヘルパー関数 ---
-    def get_template_path(self, template_key: str, has_mobile_data: bool) -> Path:
-        base_key = template_key.split('-')[0]
-        template_file_name_base = f"template_{base_key}"
-        suffix = ".jpg"
-        mobile_template_path = TOOL03_TEMPLATES_DIR / f"{template_file_name_base}-2{suffix}"
-        normal_template_path = TOOL03_TEMPLATES_DIR / f"{template_file_name_base}{suffix}"
-        if has_mobile_data and mobile_template_path.exists():
-            logging.debug(f"モバイルテンプレートを使用: {mobile_template_path}")
-            return mobile_template_path
-        if not normal_template_path.exists():
-            logging.error(f"基本テンプレートが存在しません: {normal_template_path}")
-            raise FileNotFoundError(f"基本テンプレートが存在しません: {normal_template_path}")
-        logging.debug(f"通常テンプレートを使用: {normal_template_path}")
-        return normal_template_path
-
-    def _get_text_size(self, text: str, font: ImageFont.FreeTypeFont) -> tuple[int, int]:
-        try:
-            bbox = font.getbbox(text)
-            if bbox is None: return 0, 0
-            width = bbox[2] - bbox[0]
-            height = bbox[3] - bbox[1]
-            return width, height
-        except Exception as e:
-            logging.error(f"'{text}' の _get_text_size でエラー: {e}")
-            return 0, 0
+# === ジョブの一時停止・キャンセル ===
+# ジョブの "control" フィールド (None / "paused" / "cancelled") に API から要求を書き込み、描画ループ・FTP ループが確認します
+CONTROL_PAUSED = "paused"
+CONTROL_CANCELLED = "cancelled"
 
-    def _place_text(self, draw: ImageDraw, params: Dict[str, Any]):
-        text = str(params.get('text', ''))
-        if not text:
-            return
-        font_path = str(params['font_path'])
-        font_color = params['font_color']
-        x1, y1, x2, y2 = params['x1'], params['y1'], params['x2'], params['y2']
-        align = params.get('align', 'left')
-        box_width = x2 - x1
-        box_height = y2 - y1
-        if box_width <= 0 or box_height <= 0:
-            logging.warning(f"テキスト '{text}' のバウンディングボックスが無効です: ({x1},{y1})-({x2},{y2})")
-            return
-        font_size = calculate_font_size(text, font_path, box_width, box_height)
-        if font_size <= 0:
-             logging.warning(f"テキスト '{text}' の計算済みフォントサイズが0以下です (ボックス: ({x1},{y1})-({x2},{y2}))")
-             return
-        try:
-            font = ImageFont.truetype(font_path, font_size)
-            text_width, _ = self._get_text_size(text, font)
-            if align == 'left':
-                x = x1
-            elif align == 'center':
-                x = x1 + (box_width - text_width) / 2
-            elif align == 'right':
-                x = x2 - text_width
-            else:
-                x = x1
-            bbox = font.getbbox(text)
-            if bbox is None: raise ValueError("フォントがテキスト配置用の None bbox を返しました")
-            text_actual_height = bbox[3] - bbox[1]
-            y_offset = bbox[1]
-            y = y1 + (box_height - text_actual_height) / 2 - y_offset
-            draw.text((x, y), text, fill=font_color, font=font)
-        except Exception as e:
-            logging.error(f"テキスト '{text}' (フォント {font_path} サイズ {font_size}) の描画中にエラー: {e}", exc_info=True)
+class JobControl:
+    """
+    描画ループ・FTP アップロードのループから一時停止・キャンセルの要求を確認します。
+    要求は別のワーカープロセスの API から書き込まれることもあるため、ジョブストアを check_interval 秒毎に読み直します。
+    """
+    def __init__(self, job_id: str, check_interval: float = 0.5):
+        self.job_id = job_id
+        self.check_interval = check_interval
+        self._state: Optional[str] = None
+        self._checked_at = 0.0
 
-    def _format_price(self, price_str: Optional[str]) -> str:
-        if price_str is None: return ""
-        try:
-            price_decimal = Decimal(price_str).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
-            return f"{int(price_decimal):,}"
-        except Exception:
-            return str(price_str)
+    def state(self, refresh: bool = False) -> Optional[str]:
+        """None (継続) / "paused" / "cancelled" を返します。ジョブが削除された場合は "cancelled"。"""
+        now = time.monotonic()
+        if refresh or now - self._checked_at >= self.check_interval:
+            job_data = job_store.get_changes(self.job_id, None, include_results=False)
+            self._state = CONTROL_CANCELLED if job_data is None else job_data.get("control")
+            self._checked_at = now
+        return self._state
 
-    def _calculate_discount_display(self, regular_price_str: Optional[str], sale_price_str: Optional[str], discount_type: Optional[str]) -> str:
-        if regular_price_str is None or sale_price_str is None: return ""
-        try:
-            regular_price = Decimal(regular_price_str)
-            sale_price = Decimal(sale_price_str)
-            if regular_price <= 0 or regular_price <= sale_price: return ""
-            difference = regular_price - sale_price
-            if discount_type == "yen":
-                discount_val = difference.quantize(Decimal('1'), rounding=ROUND_HALF_UP)
-                return f"{int(discount_val):,}円"
-            else:
-                percentage = (difference / regular_price * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
-                return f"{int(percentage)}%"
-        except Exception as e:
-            logging.warning(f"割引計算エラー ({regular_price_str}, {sale_price_str}, {discount_type}): {e}")
-            return ""
+    def requested(self) -> bool:
+        return self.state() is not None
 
-    def _format_datetime_jp(self, iso_str: Optional[str]) -> str:
-        """ISO (YYYY-MM-DDTHH:mm) 形式の日付文字列を日本語形式 (MM月DD日HH:mm) に変換します。"""
-        if not iso_str:
-            return ""
-        try:
-            # fromisoformat を使って ISO 文字列をパース
-            dt = datetime.datetime.fromisoformat(iso_str)
-            # f-string を使って 0 埋めなしでフォーマット
-            return f"{dt.month}月{dt.day}日{dt.hour}:{dt.minute:02d}"
-        except ValueError:
-            logging.warning(f"無効な日付形式のため、そのまま返します: {iso_str}")
-            return iso_str # パース失敗時は元の文字列をそのまま返す
-        except Exception as e:
-            logging.error(f"日付フォーマットエラー ({iso_str}): {e}")
-            return iso_str # その他のエラー時も元の文字列を返す
-    # ----------------------------------------------
-
-    def _place_price_group(self, draw: ImageDraw, price_params: Dict, unit_params: Dict, suffix_params: Dict):
-        price_text = str(price_params.get('text', ''))
-        unit_text = str(unit_params.get('text', ''))
-        suffix_text = str(suffix_params.get('text', ''))
-        if not price_text: return
-        gap_width = 5
-        try:
-            price_font = ImageFont.truetype(str(price_params['font_path']), price_params['font_size'])
-            unit_font = ImageFont.truetype(str(unit_params['font_path']), unit_params['font_size']) if unit_text else None
-            suffix_font = ImageFont.truetype(str(suffix_params['font_path']), suffix_params['font_size']) if suffix_text else None
-            price_w, _ = self._get_text_size(price_text, price_font)
-            unit_w, _ = self._get_text_size(unit_text, unit_font) if unit_font else (0, 0)
-            suffix_w, _ = self._get_text_size(suffix_text, suffix_font) if suffix_font else (0, 0)
-            total_width = price_w
-            if unit_text: total_width += gap_width + unit_w
-            if suffix_text: total_width += gap_width + suffix_w
-            container_width = price_params['x_end'] - price_params['x_origin']
-            start_x = price_params['x_origin'] + (container_width - total_width) / 2
-            price_y = price_params['y_origin']
-            draw.text((start_x, price_y), price_text, fill=price_params['font_color'], font=price_font)
-            current_x = start_x + price_w
-            if unit_font:
-                current_x += gap_width
-                unit_y = price_y + unit_params.get('dy', 0)
-                draw.text((current_x, unit_y), unit_text, fill=unit_params['font_color'], font=unit_font)
-                current_x += unit_w
-            if suffix_font:
-                current_x += gap_width
-                suffix_y = price_y + suffix_params.get('dy', 0)
-                draw.text((current_x, suffix_y), suffix_text, fill=suffix_params['font_color'], font=suffix_font)
-        except Exception as e:
-            logging.error(f"価格 '{price_text}' の _place_price_group でエラー: {e}", exc_info=True)
+    def wait_while_paused(self, keepalive=None, keepalive_interval: float = 30.0) -> bool:
+        """
+        (スレッドから) 一時停止中は再開されるまで待ちます。継続する場合は True、キャンセルされた場合は False。
+        keepalive を指定した場合は待機中に keepalive_interval 秒毎に呼び出します (FTP 接続の維持など)。
+        """
+        last_keepalive = time.monotonic()
+        while True:
+            state = self.state()
+            if state is None:
+                return True
+            if state == CONTROL_CANCELLED:
+                return False
+            if keepalive is not None and time.monotonic() - last_keepalive >= keepalive_interval:
+                keepalive()
+                last_keepalive = time.monotonic()
+            time.sleep(self.check_interval)
+# ----------------------------------------------
+
+
+# === レンダーワーカープール (マルチプロセス) ===
+_render_pool: Optional[ProcessPoolExecutor] = None
+_render_pool_lock = threading.Lock()
+
+def get_render_pool() -> Optional[ProcessPoolExecutor]:
+    """TOOL03_RENDER_WORKERS > 0 の場合にレンダーワーカープールを返します (初回呼び出し時に起動)。"""
+    global _render_pool
+    if TOOL03_RENDER_WORKERS <= 0:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            logging.info(f"Tool 03 レンダーワーカープールを起動します (プロセス数: {TOOL03_RENDER_WORKERS})")
+            _render_pool = ProcessPoolExecutor(
+                max_workers=TOOL03_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_render_worker,
+            )
+        return _render_pool
+
+def shutdown_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+# ワーカープールで 1 バッチに含める最大行数。バッチはワーカーで全行を描画し終えるまで結果が返らないため、
+# 描画中 (Processing) の行・進捗の更新間隔・一時停止やキャンセルまでに描画される行数を抑えるよう小さくする
+RENDER_POOL_MAX_BATCH_ROWS = 4
+
+async def run_render_rows(job_id: str, rows: List[Tool03ProductRowInput], job_dir: Path, encoder: Tool03EncoderOptions,
+                          on_start, on_done, control: Optional["JobControl"] = None) -> bool:
+    """
+    rows を描画して encoder の設定で保存し、行ごとに on_start(index, row) と on_done(index, row, result) を呼び出します。
+    on_start が False を返した場合は以降の行を投入しません。
+    行は共通レイヤー毎のバッチ (plan_render_batches) 単位で描画し、出力ファイル名が同じ行は入力順に描画します。
+    ワーカープールが無効な場合はイベントループ上で 1 行ずつ処理します。
+    ワーカープールでは 1 ワーカーあたり最大 2 バッチ (最大 RENDER_POOL_MAX_BATCH_ROWS 行ずつ) を投入します。
+    control を指定した場合は行 (ワーカープールではバッチの投入) 毎に一時停止・キャンセルを確認し、
+    要求があれば描画中の行を完了させてから戻ります。全ての行を処理した場合は True を返します。
+    """
+    pool = get_render_pool()
+    if pool is None:
+        batch_size = TOOL03_RENDER_BATCH_SIZE
+    else:
+        # 行数が少ないジョブでも全ワーカーに行き渡るようにする
+        batch_size = min(TOOL03_RENDER_BATCH_SIZE, RENDER_POOL_MAX_BATCH_ROWS, math.ceil(len(rows) / TOOL03_RENDER_WORKERS))
+    rounds = plan_render_batches(rows, max(1, batch_size))
+    logging.debug(
+        f"[Job {job_id}] {len(rows)} 行を {sum(len(batches) for batches in rounds)} 個の共通レイヤーバッチ"
+        f" ({len(rounds)} ラウンド) で描画します。"
+    )
+    if pool is None:
+        for batches in rounds:
+            for batch in batches:
+                renderer = iter_render_row_batch(job_id, [rows[index] for index in batch], str(job_dir), encoder, image_bytes.enabled)
+                for index in batch:
+                    if (control is not None and control.requested()) or not on_start(index, rows[index]):
+                        renderer.close()
+                        return False
+                    result = next(renderer)
+                    cache_rendered_image(job_id, result)
+                    on_done(index, rows[index], result)
+                    await asyncio.sleep(0.01)
+        return True
+
+    loop = asyncio.get_running_loop()
+    max_in_flight = TOOL03_RENDER_WORKERS * 2
+    in_flight: Dict[asyncio.Future, List[int]] = {}
+    batch_iter = iter(())
+    stopped = False
+    finished = False
+
+    def submit_next() -> bool:
+        nonlocal stopped, finished
+        if stopped:
+            return False
+        if control is not None and control.requested():
+            stopped = True
+            return False
+        batch = next(batch_iter, None)
+        if batch is None:
+            finished = True
+            return False
+        for index in batch:
+            if not on_start(index, rows[index]):
+                stopped = True
+                return False
+        future = loop.run_in_executor(
+            pool, render_row_batch, job_id, [rows[index] for index in batch], str(job_dir), encoder, image_bytes.enabled,
+        )
+        in_flight[future] = batch
+        return True
+
+    # 同じラウンドのバッチは出力ファイル名が重複しないため並行に描画し、次のラウンドは全バッチの完了後に投入する
+    for batches in rounds:
+        batch_iter = iter(batches)
+        finished = False
+        while len(in_flight) < max_in_flight and submit_next():
+            pass
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                batch = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logging.error(f"[Job {job_id}] レンダーワーカーでエラーが発生しました ({len(batch)} 行): {e}", exc_info=True)
+                    results = [
+                        Tool03ImageResult(status="Error", message="画像描画中に不明なエラーが発生しました。").model_dump()
+                        for _ in batch
+                    ]
+                for index, result in zip(batch, results):
+                    cache_rendered_image(job_id, result)
+                    on_done(index, rows[index], result)
+                submit_next()
+        if not finished:
+            return False
+    return True
+
+
+def _count_render_cache_result(job_data: Dict[str, Any], result: Dict[str, Any]):
+    """行の結果からレンダーキャッシュのヒット/ミスをジョブのカウンタに加算します ("cacheHit" は結果から取り除きます)。"""
+    if result.pop("cacheHit", False):
+        job_data["renderCacheHits"] = job_data.get("renderCacheHits", 0) + 1
+    elif result.get("status") == "Success":
+        job_data["renderCacheMisses"] = job_data.get("renderCacheMisses", 0) + 1
+
+
+def _record_row_fingerprint(job_data: Dict[str, Any], row: Tool03ProductRowInput, result: Dict[str, Any]):
+    """正常に描画できた行の入力ハッシュを記録します (エラー行は次回の PATCH で必ず再描画されるよう記録しない)。"""
+    fingerprints = job_data.setdefault("rowFingerprints", {})
+    if result.get("status") == "Success":
+        fingerprints[row.id] = row_fingerprint(row)
+    else:
+        fingerprints.pop(row.id, None)
+
+def _ensure_status_counts(job_data: Dict[str, Any]) -> Dict[str, int]:
+    """job_data の statusCounts を返します (statusCounts を持たない古いジョブの場合は results から 1 回だけ集計)。"""
+    counts = job_data.get("statusCounts")
+    if counts is None:
+        counts = dict.fromkeys(RESULT_STATUS_CODES, 0)
+        for result in job_data.get("results", {}).values():
+            counts[result.get("status")] = counts.get(result.get("status"), 0) + 1
+        counts["Pending"] += max(job_data.get("total", 0) - len(job_data.get("results", {})), 0)
+        job_data["statusCounts"] = counts
+    return counts
+
+def _set_row_result(job_data: Dict[str, Any], row_id: str, result: Dict[str, Any]):
+    """results[row_id] を置き換え、statusCounts と progress を O(1) で更新します。"""
+    counts = _ensure_status_counts(job_data)
+    previous_status = job_data["results"].status(row_id) or "Pending"
+    counts[previous_status] = counts.get(previous_status, 0) - 1
+    counts[result["status"]] = counts.get(result["status"], 0) + 1
+    job_data["results"][row_id] = result
+    job_data["progress"] = counts.get("Success", 0) + counts.get("Error", 0)
+
+def _write_row_result(job_id: str, job_data: Dict[str, Any], row_id: str, result: Dict[str, Any],
+                      fields: Optional[Dict[str, Any]] = None, rows: Optional[Dict[str, Dict[str, Any]]] = None):
+    """
+    _set_row_result で job_data を更新し、変更分をジョブストアに書き込みます。
+    fields / rows を指定した場合は同じ書き込みにまとめます (行の状態遷移 1 回につきバージョンの更新は 1 回)。
+    """
+    _set_row_result(job_data, row_id, result)
+    job_store.update(
+        job_id,
+        {"progress": job_data["progress"], "statusCounts": dict(job_data["statusCounts"]), **(fields or {})},
+        {"results": {row_id: result}, **(rows or {})},
+    )
+
+def _apply_row_result(job_id: str, job_data: Dict[str, Any], row: Tool03ProductRowInput, result: Dict[str, Any]):
+    """行の結果を job_data (バックグラウンドタスクが持つジョブのローカルコピー) に反映し、変更分をジョブストアに書き込みます。"""
+    _count_render_cache_result(job_data, result)
+    _record_row_fingerprint(job_data, row, result)
+    _write_row_result(job_id, job_data, row.id, result, fields={
+        "renderCacheHits": job_data.get("renderCacheHits", 0),
+        "renderCacheMisses": job_data.get("renderCacheMisses", 0),
+    }, rows={"rowFingerprints": {row.id: job_data["rowFingerprints"].get(row.id)}})
+
+def split_changed_rows(job_id: str, rows: List[Tool03ProductRowInput]) -> tuple[List[Tool03ProductRowInput], List[str]]:
+    """
+    PATCH で送られた rows を、前回の描画から入力が変わった行 (または新規行・エラー行) と変わっていない行に分けます。
+    (再描画が必要な行のリスト, 変更のない行 ID のリスト) を返します。
+    """
+    job_data = job_store.get(job_id) or {}
+    fingerprints = job_data.get("rowFingerprints", {})
+    results = job_data.get("results") or ResultTable()
+    job_dir = JOB_STORAGE_BASE_DIR / job_id
+    encoder = get_job_encoder(job_data)
+    changed_rows: List[Tool03ProductRowInput] = []
+    unchanged_row_ids: List[str] = []
+    for row in rows:
+        if (
+            fingerprints.get(row.id) == row_fingerprint(row)
+            and results.status(row.id) == "Success"
+            and (job_dir / output_filename_for(row, encoder)).is_file()
+        ):
+            unchanged_row_ids.append(row.id)
+        else:
+            changed_rows.append(row)
+    return changed_rows, unchanged_row_ids
 
-    def draw(self, row_data: Tool03ProductRowInput, template_key: str) -> Image.Image:
-        has_mobile_data = bool(row_data.mobileStartDate and row_data.mobileEndDate)
-        original_height = self.height
-        try:
-            template_path = self.get_template_path(template_key, has_mobile_data)
-            if has_mobile_data and template_path.name.endswith("-2.jpg") and hasattr(self, '_draw_mobile_details'):
-                self.height = 1370
-                logging.debug(f"モバイルテンプレート {template_path.name} のため、一時的に高さを 1370 に設定")
-            img = Image.open(template_path).convert("RGB")
-            draw_obj = ImageDraw.Draw(img)
-            self._draw_details(draw_obj, row_data)
-            if has_mobile_data and hasattr(self, '_draw_mobile_details') and callable(getattr(self, '_draw_mobile_details')):
-                 if template_path.name.endswith("-2.jpg"):
-                     logging.debug(f"{template_key} の _draw_mobile_details を呼び出し")
-                     self._draw_mobile_details(draw_obj, row_data)
-                 else:
-                     logging.warning(f"モバイルデータはありますが、{template_key} のモバイルテンプレートが見つからないため、モバイル詳細はスキップします。")
-            return img
-        except FileNotFoundError:
-            logging.error(f"テンプレートキー '{template_key}' (モバイル: {has_mobile_data}) のテンプレートファイルが見つかりません")
-            raise
-        except Exception as e:
-            logging.error(f"テンプレートキー '{template_key}' の画像描画中に不明なエラー: {e}", exc_info=True)
-            raise
-        finally:
-            self.height = original_height
-
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        raise NotImplementedError
-
-    def _draw_mobile_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        logging.debug(f"{self.__class__.__name__} のデフォルト _draw_mobile_details を呼び出し")
-        if row_data.mobileStartDate:
-            self._place_text(draw, {**self.mobile_start_datetime_params, 'text': self._format_datetime_jp(row_data.mobileStartDate)})
-        if row_data.mobileEndDate:
-            self._place_text(draw, {**self.mobile_end_datetime_params, 'text': self._format_datetime_jp(row_data.mobileEndDate)})
-        # -----------------------------------------
-
-# --- Factory の実装 (A, B, B2, C, C2, ...) ---
-class FactoryTypeA(BaseImageFactory):
-    def __init__(self):
-        super().__init__()
-        self.width, self.height = 800, 880
-        self.RED = (189, 41, 39)
-        self.start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.BLACK,'x1':270,'y1':80,'x2':771,'y2':125,'align':'center'}
-        self.end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.BLACK,'x1':270,'y1':190,'x2':771,'y2':235,'align':'center'}
-        self.message_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':30,'y1':280,'x2':770,'y2':370,'align':'center'}
-        
-        # --- 新規追加 (START) ---
-        # RTF (800px) とサンプルに基づく。左揃えの代わりに中央揃え。
-        self.price_type_params={'font_path':self.font_path_noto_sans_bold, 'font_color':self.WHITE, 'x1':65, 'y1':410, 'x2':805, 'y2':450, 'align':'left'}
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group={
-            # X座標は価格 (price)、単位 (unit)、接尾辞 (suffix) のみを含むように調整
-            'price': {'text':'', 'font_path':self.font_path_public_sans_bold,'font_size':60,'font_color':self.WHITE,'x_origin':330,'x_end':740,'y_origin':395},
-            'unit':  {'text':'円', 'font_path':self.font_path_noto_sans_black, 'font_size':30,'font_color':self.WHITE,'dy':20},
-            'suffix':{'text':'のところ','font_path':self.font_path_noto_sans_black,'font_size':25,'font_color':self.WHITE,'dy':25}
-        }
-        self.discount_group={
-             'price': {'text':'', 'font_path':self.font_path_public_sans_bold,'font_size':85,'font_color':self.BLACK,'x_origin':0,'x_end':self.width,'y_origin':485},
-             'unit':  {'text':'', 'font_path':self.font_path_noto_sans_black, 'font_size':50,'font_color':self.BLACK,'dy':20},
-             'suffix':{'text':'OFF','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.BLACK,'dy':45}
-        }
-        self.sale_price_group={
-            'price': {'text':'', 'font_path':self.font_path_public_sans_bold,'font_size':160,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':620},
-            'unit':  {'text':'円', 'font_path':self.font_path_noto_sans_black, 'font_size':50,'font_color':self.RED,'dy':90},
-            'suffix':{'text':'税込','font_path':self.font_path_noto_sans_black,'font_size':20,'font_color':self.RED,'dy':70}
-        }
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        self._place_text(draw, {**self.start_datetime_params, 'text': self._format_datetime_jp(row_data.startDate)})
-        self._place_text(draw, {**self.end_datetime_params, 'text': self._format_datetime_jp(row_data.endDate)})
-        # -----------------------------------------
-        self._place_text(draw, {**self.message_params, 'text': row_data.saleText or ""})
-        
-        # --- 新規追加 (START) ---
-        # priceType を描画 (例: 当店通常価格)
-        self._place_text(draw, {**self.price_type_params, 'text': row_data.priceType or ""})
-        # --- 新規追加 (END) ---
-
-        # 注意: 'normal_price_group' は priceType を含まず、価格のみを描画するようになりました
-        # (サンプル 001 に基づくと、priceType と price は異なる位置にあるようで、古いコードロジックとは少し異なる可能性があります)
-        # 要件に従い一時的に分離。
-        self.normal_price_group['price']['text'] = self._format_price(row_data.regularPrice)
-        
-        self.sale_price_group['price']['text'] = self._format_price(row_data.salePrice)
-        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
-        discount_number = discount_text_val.replace('%', '').replace('円', '')
-        discount_unit_text = '%' if '%' in discount_text_val else '円' if '円' in discount_text_val else ''
-        self.discount_group['price']['text'] = discount_number
-        self.discount_group['unit']['text'] = discount_unit_text
-        self._place_price_group(draw, self.normal_price_group['price'], self.normal_price_group['unit'], self.normal_price_group['suffix'])
-        self._place_price_group(draw, self.discount_group['price'], self.discount_group['unit'], self.discount_group['suffix'])
-        self._place_price_group(draw, self.sale_price_group['price'], self.sale_price_group['unit'], self.sale_price_group['suffix'])
-factory_registry.register_factory('A', FactoryTypeA)
-
-class FactoryTypeB(BaseImageFactory):
-    def __init__(self):
-        super().__init__()
-        self.width, self.height = 1000, 1000
-        self.YELLOW=(255,239,0); self.RED=(215,0,0)
-        self.start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':25,'y1':162,'x2':465,'y2':231,'align':'right'}
-        self.end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':555,'y1':162,'x2':995,'y2':231,'align':'left'}
-        self.message_params={'font_path':self.font_path_noto_sans_black,'font_color':self.RED,'x1':107,'y1':38,'x2':894,'y2':148,'align':'center'}
-        
-        # --- 新規追加 (START) ---
-        # 1000px 推定: normal_price_group (Y=370) の上。
-        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.WHITE, 'x1':0, 'y1':310, 'x2':1000, 'y2':360, 'align':'center'}
-        # --- 新規追加 (END) ---
-        
-        self.normal_price_group={
-            'price': {'text':'','font_path':self.font_path_reddit,'font_size':130,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':370},
-            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.WHITE,'dy':35},
-            'suffix':{'text':'のところ','font_path':self.font_path_noto_sans_black,'font_size':50,'font_color':self.WHITE,'dy':65}
-        }
-        self.discount_group={
-             'price': {'text':'','font_path':self.font_path_reddit,'font_size':95,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':540},
-             'unit':  {'text':'','font_path':self.font_path_noto_sans_black,'font_size':60,'font_color':self.RED,'dy':20},
-             'suffix':{'text':'OFF','font_path':self.font_path_noto_sans_black,'font_size':40,'font_color':self.RED,'dy':45}
-        }
-        self.sale_price_group={
-            'price': {'text':'','font_path':self.font_path_reddit,'font_size':230,'font_color':self.YELLOW,'x_origin':0,'x_end':self.width,'y_origin':660},
-            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.YELLOW,'dy':130},
-            'suffix':{'text':'税込','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.YELLOW,'dy':100}
-        }
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        self._place_text(draw, {**self.start_datetime_params, 'text': self._format_datetime_jp(row_data.startDate)})
-        self._place_text(draw, {**self.end_datetime_params, 'text': self._format_datetime_jp(row_data.endDate)})
-        # -----------------------------------------
-        self._place_text(draw, {**self.message_params, 'text': row_data.saleText or ""})
-        
-        # --- 新規追加 (START) ---
-        self._place_text(draw, {**self.price_type_params, 'text': row_data.priceType or ""})
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group['price']['text'] = self._format_price(row_data.regularPrice)
-        self.sale_price_group['price']['text'] = self._format_price(row_data.salePrice)
-        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
-        discount_number = discount_text_val.replace('%', '').replace('円', '')
-        discount_unit_text = '%' if '%' in discount_text_val else '円' if '円' in discount_text_val else ''
-        self.discount_group['price']['text'] = discount_number
-        self.discount_group['unit']['text'] = discount_unit_text
-        self._place_price_group(draw, self.normal_price_group['price'], self.normal_price_group['unit'], self.normal_price_group['suffix'])
-        self._place_price_group(draw, self.discount_group['price'], self.discount_group['unit'], self.discount_group['suffix'])
-        self._place_price_group(draw, self.sale_price_group['price'], self.sale_price_group['unit'], self.sale_price_group['suffix'])
-factory_registry.register_factory('B', FactoryTypeB)
-
-class FactoryTypeB2(FactoryTypeB):
-    def __init__(self):
-        super().__init__()
-        # --- 上書き (START) ---
-        # Yシフト +45 (RTF 768px に基づく: 390 - 345 = 45)
-        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.WHITE, 'x1':0, 'y1':310, 'x2':1000, 'y2':360, 'align':'center'}
-        # --- 上書き (END) ---
-    
-    # _draw_details は継承され、上書きされた self.price_type_params を自動的に使用します。
-    pass
-factory_registry.register_factory('B-2', FactoryTypeB2)
-
-class FactoryTypeC(BaseImageFactory):
-    def __init__(self):
-        super().__init__()
-        self.width, self.height = 1000, 1000
-        self.YELLOW=(235, 210, 150); self.RED=(150,0,0)
-        self.start_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.WHITE,'x1':25,'y1':187,'x2':465,'y2':252,'align':'right'}
-        self.end_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.WHITE,'x1':530,'y1':187,'x2':960,'y2':252,'align':'left'}
-        self.message_params={'font_path':self.font_path_shippori_bold,'font_color':self.WHITE,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
-        
-        # --- 新規追加 (START) ---
-        # 1000px 推定: normal_price_group (Y=360) の上。
-        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.WHITE, 'x1':0, 'y1':310, 'x2':1000, 'y2':360, 'align':'center'}
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group={
-            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':130,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':360},
-            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.WHITE,'dy':65},
-            'suffix':{'text':'のところ','font_path':self.font_path_shippori_bold,'font_size':50,'font_color':self.WHITE,'dy':95}
-        }
-        self.discount_group={
-             'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':95,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':530},
-             'unit':  {'text':'','font_path':self.font_path_shippori_bold,'font_size':60,'font_color':self.RED,'dy':40},
-             'suffix':{'text':'OFF','font_path':self.font_path_shippori_bold,'font_size':40,'font_color':self.RED,'dy':65}
-        }
-        self.sale_price_group={
-            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':200,'font_color':self.YELLOW,'x_origin':0,'x_end':self.width,'y_origin':650},
-            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.YELLOW,'dy':145},
-            'suffix':{'text':'税込','font_path':self.font_path_shippori_bold,'font_size':30,'font_color':self.YELLOW,'dy':115}
-        }
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        self._place_text(draw, {**self.start_datetime_params, 'text': self._format_datetime_jp(row_data.startDate)})
-        self._place_text(draw, {**self.end_datetime_params, 'text': self._format_datetime_jp(row_data.endDate)})
-        # -----------------------------------------
-        self._place_text(draw, {**self.message_params, 'text': row_data.saleText or ""})
-
-        # --- 新規追加 (START) ---
-        self._place_text(draw, {**self.price_type_params, 'text': row_data.priceType or ""})
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group['price']['text'] = self._format_price(row_data.regularPrice)
-        self.sale_price_group['price']['text'] = self._format_price(row_data.salePrice)
-        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
-        discount_number = discount_text_val.replace('%', '').replace('円', '')
-        discount_unit_text = '%' if '%' in discount_text_val else '円' if '円' in discount_text_val else ''
-        self.discount_group['price']['text'] = discount_number
-        self.discount_group['unit']['text'] = discount_unit_text
-        self._place_price_group(draw, self.normal_price_group['price'], self.normal_price_group['unit'], self.normal_price_group['suffix'])
-        self._place_price_group(draw, self.discount_group['price'], self.discount_group['unit'], self.discount_group['suffix'])
-        self._place_price_group(draw, self.sale_price_group['price'], self.sale_price_group['unit'], self.sale_price_group['suffix'])
-factory_registry.register_factory('C', FactoryTypeC)
-
-class FactoryTypeC2(FactoryTypeC):
-    def __init__(self):
-        super().__init__()
-        # --- 上書き (START) ---
-        # Yシフト +75 (RTF 768px に基づく: 435 - 360 = 75)
-        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.WHITE, 'x1':0, 'y1':300+35, 'x2':1000, 'y2':350+35, 'align':'center'}
-        # --- 上書き (END) ---
-    pass
-factory_registry.register_factory('C-2', FactoryTypeC2)
-
-class FactoryTypeD(BaseImageFactory):
-    def __init__(self):
-        super().__init__()
-        # ... (Factory D のパラメータは変更なし) ...
-        self.width, self.height = 1000, 1000
-        self.BROWN=(90,70,50); self.RED=(215,0,0)
-        self.start_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':25,'y1':187,'x2':465,'y2':252,'align':'right'}
-        self.end_datetime_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':530,'y1':187,'x2':960,'y2':252,'align':'left'}
-        self.message_params={'font_path':self.font_path_noto_sans_black,'font_color':self.WHITE,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
-
-        # --- 新規追加 (START) ---
-        # 1000px 推定: normal_price_group (Y=380) の上。
-        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.BROWN, 'x1':0, 'y1':315, 'x2':1000, 'y2':370, 'align':'center'}
-        # --- 新規追加 (END) ---
-        
-        self.normal_price_group={
-            'price': {'text':'','font_path':self.font_path_public_sans_bold,'font_size':130,'font_color':self.BROWN,'x_origin':0,'x_end':self.width,'y_origin':380},
-            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.BROWN,'dy':35},
-            'suffix':{'text':'のところ','font_path':self.font_path_noto_sans_black,'font_size':50,'font_color':self.BROWN,'dy':60}
-        }
-        self.discount_group={
-             'price': {'text':'','font_path':self.font_path_public_sans_bold,'font_size':85,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':550},
-             'unit':  {'text':'','font_path':self.font_path_noto_sans_black,'font_size':50,'font_color':self.WHITE,'dy':15},
-             'suffix':{'text':'OFF','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.WHITE,'dy':40}
-        }
-        self.sale_price_group={
-            'price': {'text':'','font_path':self.font_path_public_sans_bold,'font_size':200,'font_color':self.RED,'x_origin':0,'x_end':self.width,'y_origin':700},
-            'unit':  {'text':'円','font_path':self.font_path_noto_sans_black,'font_size':70,'font_color':self.RED,'dy':95},
-            'suffix':{'text':'税込','font_path':self.font_path_noto_sans_black,'font_size':30,'font_color':self.RED,'dy':65}
-        }
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        self._place_text(draw, {**self.start_datetime_params, 'text': self._format_datetime_jp(row_data.startDate)})
-        self._place_text(draw, {**self.end_datetime_params, 'text': self._format_datetime_jp(row_data.endDate)})
-        # -----------------------------------------
-        self._place_text(draw, {**self.message_params, 'text': row_data.saleText or ""})
-
-        # --- 新規追加 (START) ---
-        self._place_text(draw, {**self.price_type_params, 'text': row_data.priceType or ""})
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group['price']['text'] = self._format_price(row_data.regularPrice)
-        self.sale_price_group['price']['text'] = self._format_price(row_data.salePrice)
-        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
-        discount_number = discount_text_val.replace('%', '').replace('円', '')
-        discount_unit_text = '%' if '%' in discount_text_val else '円' if '円' in discount_text_val else ''
-        self.discount_group['price']['text'] = discount_number
-        self.discount_group['unit']['text'] = discount_unit_text
-        self._place_price_group(draw, self.normal_price_group['price'], self.normal_price_group['unit'], self.normal_price_group['suffix'])
-        self._place_price_group(draw, self.discount_group['price'], self.discount_group['unit'], self.discount_group['suffix'])
-        self._place_price_group(draw, self.sale_price_group['price'], self.sale_price_group['unit'], self.sale_price_group['suffix'])
-factory_registry.register_factory('D', FactoryTypeD)
-
-class FactoryTypeD2(FactoryTypeD):
-    def __init__(self):
-        super().__init__()
-        # --- 上書き (START) ---
-        # Yシフト +20 (RTF 768px に基づく)
-        self.price_type_params={'font_path':self.font_path_noto_sans_black, 'font_color':self.BROWN, 'x1':0, 'y1':315+20, 'x2':1000, 'y2':370+20, 'align':'center'}
-        # --- 上書き (END) ---
-    pass
-factory_registry.register_factory('D-2', FactoryTypeD2)
-
-class FactoryTypeE(BaseImageFactory):
-    def __init__(self):
-        super().__init__()
-        # ... (Factory E のパラメータは変更なし) ...
-        self.width, self.height = 1000, 1000
-        self.SILVER=(204,204,204); self.GOLD=(235, 210, 150)
-        self.start_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.BLACK,'x1':25,'y1':200,'x2':465,'y2':265,'align':'right'}
-        self.end_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.BLACK,'x1':530,'y1':200,'x2':960,'y2':265,'align':'left'}
-        self.message_params={'font_path':self.font_path_shippori_bold,'font_color':self.BLACK,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
-
-        # --- 新規追加 (START) ---
-        # 1000px 推定: normal_price_group (Y=360) の上。
-        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.SILVER, 'x1':0, 'y1':325, 'x2':1000, 'y2':385, 'align':'center'}
-        # --- 新規追加 (END) ---
-        
-        self.normal_price_group={
-            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':130,'font_color':self.SILVER,'x_origin':0,'x_end':self.width,'y_origin':360},
-            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.SILVER,'dy':65},
-            'suffix':{'text':'のところ','font_path':self.font_path_shippori_bold,'font_size':50,'font_color':self.SILVER,'dy':95}
-        }
-        self.discount_params={
-            'font_path':self.font_path_shippori_bold,
-            'font_color':self.GOLD,
-            'x1': 645, 'y1': 620, 'x2': 965, 'y2': 670,
-            'align':'center'
-        }
-        self.sale_price_group={
-            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':200,'font_color':self.GOLD,'x_origin':0,'x_end':self.width,'y_origin':650},
-            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.GOLD,'dy':145},
-            'suffix':{'text':'税込','font_path':self.font_path_shippori_bold,'font_size':30,'font_color':self.GOLD,'dy':115}
-        }
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        self._place_text(draw, {**self.start_datetime_params, 'text': self._format_datetime_jp(row_data.startDate)})
-        self._place_text(draw, {**self.end_datetime_params, 'text': self._format_datetime_jp(row_data.endDate)})
-        # -----------------------------------------
-        self._place_text(draw, {**self.message_params, 'text': row_data.saleText or ""})
-
-        # --- 新規追加 (START) ---
-        self._place_text(draw, {**self.price_type_params, 'text': row_data.priceType or ""})
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group['price']['text'] = self._format_price(row_data.regularPrice)
-        self.sale_price_group['price']['text'] = self._format_price(row_data.salePrice)
-        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
-        discount_display_text = ""
-        if discount_text_val:
-         discount_number = discount_text_val.replace('%', '').replace('円', '')
-         if '%' in discount_text_val:
-             discount_display_text = f"{discount_number}%OFF"
-         elif '円' in discount_text_val:
-             discount_display_text = f"{discount_number}円OFF"
-        self._place_text(draw, {**self.discount_params, 'text': discount_display_text})
-        self._place_price_group(draw, self.normal_price_group['price'], self.normal_price_group['unit'], self.normal_price_group['suffix'])
-        self._place_price_group(draw, self.sale_price_group['price'], self.sale_price_group['unit'], self.sale_price_group['suffix'])
-factory_registry.register_factory('E', FactoryTypeE)
-
-class FactoryTypeE2(FactoryTypeE):
-    def __init__(self):
-        super().__init__()
-        # --- 上書き (START) ---
-        # Yシフト +45 (コード 290+45 に基づく)
-        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.SILVER, 'x1':0, 'y1':290+45, 'x2':1000, 'y2':350+45, 'align':'center'}
-        # --- 上書き (END) ---
-    pass
-factory_registry.register_factory('E-2', FactoryTypeE2)
-
-class FactoryTypeF(BaseImageFactory):
-    def __init__(self):
-        super().__init__()
-        # ... (Factory F のパラメータは変更なし) ...
-        self.width, self.height = 1000, 1000
-        self.BLACK=(93, 95, 96); self.GOLD=(210, 172, 67)
-        self.start_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.GOLD,'x1':25,'y1':187,'x2':465,'y2':252,'align':'right'}
-        self.end_datetime_params={'font_path':self.font_path_shippori_bold,'font_color':self.GOLD,'x1':530,'y1':187,'x2':960,'y2':252,'align':'left'}
-        self.message_params={'font_path':self.font_path_shippori_bold,'font_color':self.GOLD,'x1':107,'y1':38,'x2':894,'y2':170,'align':'center'}
-        
-        # --- 新規追加 (START) ---
-        # 1000px 推定: normal_price_group (Y=360) の上。
-        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.BLACK, 'x1':0, 'y1':320, 'x2':1000, 'y2':370, 'align':'center'}
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group={
-            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':130,'font_color':self.BLACK,'x_origin':0,'x_end':self.width,'y_origin':360},
-            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.BLACK,'dy':65},
-            'suffix':{'text':'のところ','font_path':self.font_path_shippori_bold,'font_size':50,'font_color':self.BLACK,'dy':95}
-        }
-        self.discount_group={
-             'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':95,'font_color':self.WHITE,'x_origin':0,'x_end':self.width,'y_origin':530},
-             'unit':  {'text':'','font_path':self.font_path_shippori_bold,'font_size':60,'font_color':self.WHITE,'dy':40},
-             'suffix':{'text':'OFF','font_path':self.font_path_shippori_bold,'font_size':40,'font_color':self.WHITE,'dy':65}
-        }
-        self.sale_price_group={
-            'price': {'text':'','font_path':self.font_path_shippori_bold,'font_size':200,'font_color':self.GOLD,'x_origin':0,'x_end':self.width,'y_origin':650},
-            'unit':  {'text':'円','font_path':self.font_path_shippori_bold,'font_size':70,'font_color':self.GOLD,'dy':145},
-            'suffix':{'text':'税込','font_path':self.font_path_shippori_bold,'font_size':30,'font_color':self.GOLD,'dy':115}
-        }
-    def _draw_details(self, draw: ImageDraw, row_data: Tool03ProductRowInput):
-        self._place_text(draw, {**self.start_datetime_params, 'text': self._format_datetime_jp(row_data.startDate)})
-        self._place_text(draw, {**self.end_datetime_params, 'text': self._format_datetime_jp(row_data.endDate)})
-        # -----------------------------------------
-        self._place_text(draw, {**self.message_params, 'text': row_data.saleText or ""})
-
-        # --- 新規追加 (START) ---
-        self._place_text(draw, {**self.price_type_params, 'text': row_data.priceType or ""})
-        # --- 新規追加 (END) ---
-
-        self.normal_price_group['price']['text'] = self._format_price(row_data.regularPrice)
-        self.sale_price_group['price']['text'] = self._format_price(row_data.salePrice)
-        discount_text_val = self._calculate_discount_display(row_data.regularPrice, row_data.salePrice, row_data.discountType)
-        discount_number = discount_text_val.replace('%', '').replace('円', '')
-        discount_unit_text = '%' if '%' in discount_text_val else '円' if '円' in discount_text_val else ''
-        self.discount_group['price']['text'] = discount_number
-        self.discount_group['unit']['text'] = discount_unit_text
-        self._place_price_group(draw, self.normal_price_group['price'], self.normal_price_group['unit'], self.normal_price_group['suffix'])
-        self._place_price_group(draw, self.discount_group['price'], self.discount_group['unit'], self.discount_group['suffix'])
-        self._place_price_group(draw, self.sale_price_group['price'], self.sale_price_group['unit'], self.sale_price_group['suffix'])
-factory_registry.register_factory('F', FactoryTypeF)
-
-class FactoryTypeF2(FactoryTypeF):
-    def __init__(self):
-        super().__init__()
-        # --- 上書き (START) ---
-        # Yシフト +40 (コード 290+40, 350+40 に基づく)
-        self.price_type_params={'font_path':self.font_path_shippori_bold, 'font_color':self.BLACK, 'x1':0, 'y1':290+40, 'x2':1000, 'y2':350+40, 'align':'center'}
-        # --- 上書き (END) ---
-    pass
-factory_registry.register_factory('F-2', FactoryTypeF2)
 
 # === メインサービス (バックグラウンドタスク - POST) ===
-async def generate_images_background(job_id: str, product_rows: List[Tool03ProductRowInput]):
+def _initial_job_data(total: int, encoder: Tool03EncoderOptions, callback_url: Optional[str], company_id: Optional[str],
+                      status: str, start_time: float) -> Dict[str, Any]:
+    return {
+        "status": status, "progress": 0, "total": total,
+        "results": ResultTable(), "startTime": start_time, "endTime": None, "message": None,
+        "ftpUploadStatusGold": "idle", "ftpUploadErrorGold": None,
+        "ftpUploadStatusRcabinet": "idle", "ftpUploadErrorRcabinet": None,
+        "statusCounts": {**dict.fromkeys(RESULT_STATUS_CODES, 0), "Pending": total},  # 結果がまだ無い行は Pending
+        "renderCacheHits": 0, "renderCacheMisses": 0,
+        "rowFingerprints": {},  # row.id -> 最後に正常に描画した入力のハッシュ (PATCH の差分判定用)
+        "encoder": encoder.model_dump(),  # PATCH でも同じ設定で再生成する
+        "callbackUrl": callback_url,
+        "companyId": company_id,  # ジョブキューの公平性の単位 (PATCH でも同じ会社として登録する)
+    }
+
+def _stopped_status(control: JobControl) -> Optional[str]:
+    """描画ループが一時停止・キャンセルの要求で止まった場合のジョブのステータス (要求が取り消されていれば None)。"""
+    return {CONTROL_PAUSED: "Paused", CONTROL_CANCELLED: "Cancelled"}.get(control.state(refresh=True))
+
+def _remaining_rows(job_data: Dict[str, Any], rows: List[Tool03ProductRowInput]) -> List[Tool03ProductRowInput]:
+    """まだ結果 (Success / Error) が無い行。"""
+    return [row for row in rows if job_data["results"].status(row.id) not in ("Success", "Error")]
+
+async def generate_images_background(job_id: str, product_rows: List[Tool03ProductRowInput], encoder: Optional[Tool03EncoderOptions] = None,
+                                     callback_url: Optional[str] = None, company_id: Optional[str] = None) -> str:
+    """
+    ジョブの全行を描画します。最終的なステータスを返します (一時停止した場合は "Paused"、シャットダウンで中断した場合は "Processing")。
+    一時停止・中断の後に再実行された場合 (ジョブに行の結果が残っている場合) は、結果のある行を描画せずに続きから再開します。
+    """
     # ... (ジョブログic部分は変更なし) ...
     logging.info(f"[Job {job_id}] {len(product_rows)} 件の画像の処理を開始します。")
     job_dir = JOB_STORAGE_BASE_DIR / job_id
     job_dir.mkdir(exist_ok=True)
+    encoder = encoder or DEFAULT_ENCODER_OPTIONS
     start_time = time.time()
-    initial_job_data: Dict[str, Any] = {
-        "status": "Processing", "progress": 0, "total": len(product_rows),
-        "results": {}, "startTime": start_time, "endTime": None, "message": None,
-        "ftpUploadStatusGold": "idle", "ftpUploadErrorGold": None,
-        "ftpUploadStatusRcabinet": "idle", "ftpUploadErrorRcabinet": None,
-    }
-    job_tracker[job_id] = initial_job_data
-    error_count = 0
+    existing_job_data = job_store.get(job_id)
+    if existing_job_data and len(existing_job_data["results"]) > 0:
+        job_data = existing_job_data  # このタスク内のローカルコピー (変更はジョブストアにも書き込む)
+        _ensure_status_counts(job_data)
+        rows_to_render = _remaining_rows(job_data, product_rows)
+        job_data.update({"status": "Processing", "endTime": None})
+        job_store.update(job_id, {"status": "Processing", "endTime": None})
+        logging.info(f"[Job {job_id}] 前回の続きから再開します (残り {len(rows_to_render)}/{len(product_rows)} 件)。")
+    else:
+        job_data = _initial_job_data(len(product_rows), encoder, callback_url, company_id, "Processing", start_time)
+        if existing_job_data and existing_job_data.get("control"):
+            job_data["control"] = existing_job_data["control"]  # 開始前に受け付けた一時停止・キャンセルを引き継ぐ
+        job_store.create(job_id, job_data)
+        rows_to_render = product_rows
+    control = JobControl(job_id, TOOL03_JOB_CONTROL_INTERVAL)
     final_status = "Processing"
+
+    def on_start(index: int, row: Tool03ProductRowInput) -> bool:
+        logging.debug(f"[Job {job_id}] 画像 {index + 1}/{len(rows_to_render)} を処理中: {row.productCode}")
+        if not job_store.exists(job_id):
+            logging.warning(f"[Job {job_id}] 行 {index+1} の開始前に Job がトラッカーに存在しません")
+            return False
+        _write_row_result(job_id, job_data, row.id, Tool03ImageResult(status="Processing").model_dump())
+        return True
+
+    def on_done(index: int, row: Tool03ProductRowInput, result: Dict[str, Any]):
+        if job_store.exists(job_id):
+            _apply_row_result(job_id, job_data, row, result)
+            job_checkpoints.record_row(job_id, row.id, result, job_data["rowFingerprints"].get(row.id))
+        else:
+            logging.warning(f"[Job {job_id}] 行 {index+1} の処理完了時に Job がトラッカーに存在しません")
+
     try:
-        for index, row in enumerate(product_rows):
-            logging.debug(f"[Job {job_id}] 画像 {index + 1}/{len(product_rows)} を処理中: {row.productCode}")
-            row_id = row.id
-            current_result_dict = Tool03ImageResult(status="Pending").model_dump()
-            if job_id in job_tracker:
-                 job_tracker[job_id]["results"][row_id] = current_result_dict
-            else:
-                 logging.warning(f"[Job {job_id}] 行 {index+1} の開始前に Job がトラッカーに存在しません")
-                 return
-            template_name = row.template or "テンプレートA"
-            base_key = template_name.replace("テンプレート", "")
-            factory_key = base_key
-            has_mobile_data = bool(row.mobileStartDate and row.mobileEndDate)
-            potential_mobile_key = f"{base_key}-2"
-            if has_mobile_data and potential_mobile_key in factory_registry._factories:
-                factory_key = potential_mobile_key
-            logging.debug(f"[Job {job_id}] 行 {index+1} を処理中:")
-            logging.debug(f"  - 受信テンプレート名: '{row.template}'")
-            logging.debug(f"  - 計算された base_key: '{base_key}'")
-            logging.debug(f"  - 最終 factory_key: '{factory_key}'")
-            try:
-                 current_result_dict["status"] = "Processing"
-                 if job_id in job_tracker:
-                      job_tracker[job_id]["results"][row_id] = current_result_dict
-                 factory = factory_registry.get_factory(factory_key)
-                 img: Image.Image = factory.draw(row, factory_key)
-                 output_filename = f"{row.productCode}.jpg"
-                 output_path = job_dir / output_filename
-                 img.save(output_path, "JPEG", quality=95)
-                 current_result_dict["status"] = "Success"
-                 current_result_dict["filename"] = output_filename
-                 img.close()
-            except (FileNotFoundError, ValueError, NotImplementedError) as e:
-                logging.error(f"[Job {job_id}] 画像 {index + 1} ({row.productCode}, テンプレート '{factory_key}') の処理エラー: {e}")
-                current_result_dict["status"] = "Error"
-                current_result_dict["message"] = str(e)
-                error_count += 1
-            except Exception as draw_error:
-                logging.error(f"[Job {job_id}] 画像 {index + 1} ({row.productCode}, テンプレート '{factory_key}') の描画中に不明なエラー: {draw_error}", exc_info=True)
-                current_result_dict["status"] = "Error"
-                current_result_dict["message"] = "画像描画中に不明なエラーが発生しました。"
-                error_count += 1
-            finally:
-                if job_id in job_tracker:
-                    job_tracker[job_id]["results"][row_id] = current_result_dict
-                    job_tracker[job_id]["progress"] = len([
-                         res for res in job_tracker[job_id]["results"].values()
-                         if res.get("status") in ["Success", "Error"]
-                    ])
-                else:
-                    logging.warning(f"[Job {job_id}] 行 {index+1} の処理完了時に Job がトラッカーに存在しません")
-            await asyncio.sleep(0.01)
-        if job_id in job_tracker:
+        while not await run_render_rows(job_id, rows_to_render, job_dir, encoder, on_start, on_done, control) and job_store.exists(job_id):
+            stopped_status = _stopped_status(control)
+            if stopped_status:
+                final_status = stopped_status
+                logging.info(f"[Job {job_id}] 要求により描画を停止しました。ステータス: {final_status}。進捗: {job_data['progress']}/{len(product_rows)}。")
+                break
+            rows_to_render = _remaining_rows(job_data, rows_to_render)  # 停止要求が取り消された場合は続行
+        await asyncio.to_thread(render_cache.evict)
+        if job_store.exists(job_id) and final_status == "Processing":
+            error_count = job_data["statusCounts"].get("Error", 0)
             final_status = "Completed" if error_count == 0 else "Completed with errors"
             logging.info(f"[Job {job_id}] 処理完了。ステータス: {final_status}。エラー: {error_count}/{len(product_rows)}。")
     except Exception as e:
         final_status = "Failed"
         logging.error(f"[Job {job_id}] バックグラウンドタスクで重大なエラーが発生: {e}", exc_info=True)
-        if job_id in job_tracker:
-             job_tracker[job_id]["message"] = f"システムエラー: {e}"
+        job_store.update(job_id, {"message": f"システムエラー: {e}"})
     finally:
-        if job_id in job_tracker:
-            end_time = time.time()
-            job_tracker[job_id]["status"] = final_status
-            job_tracker[job_id]["endTime"] = end_time
-            logging.info(f"[Job {job_id}] 処理時間: {end_time - start_time:.2f} 秒。")
+        end_time = time.time()
+        # シャットダウンで中断した場合 (キューに戻して再実行) と一時停止 (再開を待つ) は完了として扱わない
+        if final_status == "Paused":
+            job_store.update(job_id, {"status": final_status})
+        elif final_status != "Processing":
+            job_store.update(job_id, {"status": final_status, "endTime": end_time})
+        job_store.flush()
+        if final_status not in ("Processing", "Paused"):
+            job_checkpoints.remove(job_id)  # 再開の必要が無くなったためチェックポイントを削除
+            notify_job_completed(job_id)
+        logging.info(f"[Job {job_id}] 処理時間: {end_time - start_time:.2f} 秒。")
+        log_image_cache_stats()
+    return final_status
 
 # === ジョブステータス取得関数 ===
-def get_job_status(job_id: str) -> Optional[Dict[str, Any]]:
-    return job_tracker.get(job_id)
+def get_job_status(job_id: str, since: Optional[int] = None, include_results: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    ステータス API 用のジョブ情報を返します (results は ResultTable)。
+    since を指定した場合は、ジョブのバージョンが since より後に変更された行のみ results に含めます。
+    """
+    return job_store.get_changes(job_id, since, include_results)
+
+def get_job_version(job_id: str) -> Optional[int]:
+    """ジョブの現在のバージョン (状態が変わる度に増加) を返します。ジョブが無い場合は None。"""
+    return job_store.get_version(job_id)
+
+# === 画像の ETag ===
+class ImageDigestCache:
+    """
+    画像ファイルの内容のハッシュ (結果の contentHash と同じ値) を (inode, 更新日時, サイズ) 毎に記憶する LRU キャッシュ。
+    画像は置き換え時に別の inode になるため、ファイルが変わらない限り画像のリクエスト毎に読み直しません。
+    """
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> tuple[os.stat_result, str]:
+        """(stat, 内容のハッシュ) を返します。ファイルが無い場合は FileNotFoundError。"""
+        stat = os.stat(path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        key = str(path)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == identity:
+                self._cache.move_to_end(key)
+                return stat, cached[1]
+        digest = file_content_hash(path)
+        with self._lock:
+            self._cache[key] = (identity, digest)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return stat, digest
+
+image_digests = ImageDigestCache()
+
+# === ファイル送信のプロキシへの委譲 (X-Accel-Redirect / X-Sendfile) ===
+# 画像と Zip アーカイブは storage ディレクトリ以下にあるため、プロキシには storage ディレクトリからの相対パスで指定します
+# nginx の例: location /_tool03_storage/ { internal; alias /app/storage/; }
+FILE_SERVING_ROOT = PROJECT_ROOT / "storage"
+FILE_SERVING_HEADERS = {"x-accel-redirect": "X-Accel-Redirect", "x-sendfile": "X-Sendfile"}
+if TOOL03_FILE_SERVING != "app" and TOOL03_FILE_SERVING not in FILE_SERVING_HEADERS:
+    logging.warning(f"TOOL03_FILE_SERVING '{TOOL03_FILE_SERVING}' は不明な値のため、アプリからファイルを送信します。")
+
+def file_offload_header(path: Path) -> Optional[tuple[str, str]]:
+    """
+    ファイルの送信をプロキシに任せる場合の (ヘッダー名, 値) を返します (アプリから送信する場合・storage 外のファイルは None)。
+    パスの検証は呼び出し側で済ませてください。
+    """
+    header_name = FILE_SERVING_HEADERS.get(TOOL03_FILE_SERVING)
+    if header_name is None:
+        return None
+    try:
+        relative_path = Path(path).resolve().relative_to(FILE_SERVING_ROOT.resolve()).as_posix()
+    except ValueError:
+        logging.warning(f"storage ディレクトリ外のファイルはプロキシに委譲できません: {path}")
+        return None
+    # ヘッダーには ASCII しか使えないため、ファイル名 (商品コード) はパーセントエンコードする (プロキシ側でデコードされる)
+    if header_name == "X-Accel-Redirect":
+        prefix = TOOL03_FILE_SERVING_PREFIX or "/_tool03_storage"
+    else:
+        prefix = TOOL03_FILE_SERVING_PREFIX or FILE_SERVING_ROOT.resolve().as_posix()
+    return header_name, f"{prefix.rstrip('/')}/{quote(relative_path)}"
+
+# === 描画直後の画像のメモリキャッシュ ===
+class ImageBytesCache:
+    """
+    描画直後の画像のエンコード済みバイト列を (ジョブ ID, ファイル名) 毎に保持する、合計バイト数で制限した LRU キャッシュ。
+    ジョブの完了直後に結果一覧が全画像を取得する際、ディスクから読まずにメモリから返します。
+    各エントリは書き込んだファイルの (inode, 更新日時, サイズ) を持ち、ファイルが置き換えられた (再生成・削除) 場合は使用しません。
+    キャッシュに無い画像 (削除された・別のプロセスで描画された) は呼び出し側でディスクから送信してください。
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max(0, max_bytes)
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def identity(stat: os.stat_result) -> tuple:
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def put(self, job_id: str, filename: str, identity: tuple, digest: str, data: bytes):
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        key = (job_id, filename)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= len(previous[2])
+            self._entries[key] = (identity, digest, data)
+            self.size_bytes += len(data)
+            while self.size_bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def get(self, job_id: str, filename: str, path: Path) -> Optional[tuple[os.stat_result, str, bytes]]:
+        """(stat, 内容のハッシュ, バイト列) を返します。キャッシュに無い場合は None、ファイルが無い場合は FileNotFoundError。"""
+        stat = os.stat(path)
+        key = (job_id, filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self.identity(stat):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return stat, entry[1], entry[2]
+            if entry is not None:
+                # ファイルが置き換えられた (古い内容は二度と使わない)
+                del self._entries[key]
+                self.size_bytes -= len(entry[2])
+            self.misses += 1
+        return None
+
+    def remove_job(self, job_id: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == job_id]:
+                self.size_bytes -= len(self._entries.pop(key)[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries), "bytes": self.size_bytes, "maxBytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            }
+
+# プロキシがファイルを送信する場合はアプリから画像を送らないため無効にする
+image_bytes = ImageBytesCache(TOOL03_IMAGE_MEMORY_CACHE_MAX_BYTES if FILE_SERVING_HEADERS.get(TOOL03_FILE_SERVING) is None else 0)
+
+def cache_rendered_image(job_id: str, result: Dict[str, Any]):
+    """
+    行の結果に含まれるエンコード済みのバイト列 ("encoded"、結果からは取り除きます) を image_bytes に保存します。
+    レンダーワーカープロセスで描画した行もバイト列を結果と一緒に受け取るため、API のプロセスのキャッシュに入ります。
+    """
+    encoded = result.pop("encoded", None)
+    if encoded is not None and result.get("status") == "Success":
+        identity, data = encoded
+        image_bytes.put(job_id, result["filename"], identity, result["contentHash"], data)
+
+def log_image_cache_stats():
+    """画像のメモリキャッシュの効果 (ヒット率・削除数) をログに出力します (ジョブの完了時と定期クリーンアップ時)。"""
+    if not image_bytes.enabled:
+        return
+    stats = image_bytes.stats()
+    lookups = stats["hits"] + stats["misses"]
+    hit_rate = f"{stats['hits'] / lookups * 100:.1f}%" if lookups else "-"
+    logging.info(
+        f"画像メモリキャッシュ: {stats['size']} 件 / {stats['bytes'] / 1024 / 1024:.1f} MiB "
+        f"(上限 {stats['maxBytes'] / 1024 / 1024:.0f} MiB), ヒット {stats['hits']}, ミス {stats['misses']} "
+        f"(ヒット率 {hit_rate}), 容量超過による削除 {stats['evictions']}"
+    )
+
+# === 完了コールバック (Webhook) ===
+def validate_callback_url(callback_url: str):
+    """callbackUrl が送信先として許可されているか確認します (許可されない場合は CallbackUrlError)。"""
+    webhook_sender.check_url(callback_url)
+
+def notify_job_completed(job_id: str):
+    """ジョブの描画 (POST / PATCH) が終了したことを callbackUrl に通知します。"""
+    job_data = job_store.get_changes(job_id, None, include_results=False)
+    if not job_data or not job_data.get("callbackUrl"):
+        return
+    webhook_sender.send(job_data["callbackUrl"], "job.completed", {
+        "jobId": job_id,
+        "status": job_data.get("status"),
+        "total": job_data.get("total", 0),
+        "progress": job_data.get("progress", 0),
+        "statusCounts": job_data.get("statusCounts") or {},
+        "message": job_data.get("message"),
+        "startTime": job_data.get("startTime"),
+        "endTime": job_data.get("endTime"),
+        "version": job_data.get("version", 0),
+    })
+
+def notify_ftp_completed(job_id: str, target: str, status: str, error: Optional[str]):
+    """FTP アップロード (ターゲット毎) が終了したことを callbackUrl に通知します。"""
+    job_data = job_store.get_changes(job_id, None, include_results=False)
+    if not job_data or not job_data.get("callbackUrl"):
+        return
+    webhook_sender.send(job_data["callbackUrl"], "ftp.completed", {
+        "jobId": job_id, "target": target, "status": status, "error": error,
+    })
+
+# === ジョブイベントストリーム (SSE) ===
+FTP_TARGETS = ("gold", "rcabinet")
+
+def _job_event_payload(job_id: str, job_data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "jobId": job_id, "status": job_data.get("status"), "message": job_data.get("message"),
+        "progress": job_data.get("progress", 0), "total": job_data.get("total", 0),
+        "statusCounts": job_data.get("statusCounts", {}), "version": job_data.get("version"),
+        "startTime": job_data.get("startTime"), "endTime": job_data.get("endTime"),
+    }
+
+async def iter_job_events(job_id: str, last_event_id: Optional[int] = None):
+    """
+    ジョブの変更を Server-Sent Events 形式の文字列として yield します。
+    変更がある度に次のイベントを送信します:
+      row      : 状態が変わった行 (rowId と Tool03ImageResult のフィールド)
+      job      : ジョブ全体のステータスが変わった時 (完了・失敗を含む)
+      ftp      : FTP アップロードのステータスが変わった時
+      progress : 上記の後に必ず送信。id はジョブのバージョンで、再接続時の Last-Event-ID になります
+    last_event_id を指定した場合はそのバージョンより後の変更から送信します (未指定の場合は最初に全行を送信)。
+    変更が無い間は TOOL03_SSE_HEARTBEAT_INTERVAL 秒毎にコメント行を送信します。ジョブが削除された場合は deleted を送信して終了します。
+    """
+    changed = job_events.subscribe(job_id)
+    # 他ワーカーの書き込みは通知されないため、共有ストアの場合はバージョンを定期的に確認する
+    wait_timeout = min(TOOL03_SSE_POLL_INTERVAL, TOOL03_SSE_HEARTBEAT_INTERVAL) if job_store.shared else TOOL03_SSE_HEARTBEAT_INTERVAL
+    since = last_event_id
+    last_job_status: Optional[str] = None
+    last_ftp_status: Dict[str, tuple] = {}
+    last_sent = time.monotonic()
+    try:
+        yield f"retry: {int(TOOL03_SSE_POLL_INTERVAL * 1000)}\n\n"
+        while True:
+            changed.clear()
+            version = job_store.get_version(job_id)
+            if version is None:
+                yield format_sse("deleted", {"jobId": job_id})
+                return
+            if since is None or since != version:
+                job_data = job_store.get_changes(job_id, since if since is not None and since < version else None)
+                if job_data is None:
+                    continue
+                for row_id, result in job_data.pop("results").to_dict().items():
+                    yield format_sse("row", {"rowId": row_id, **result})
+                if job_data.get("status") != last_job_status:
+                    last_job_status = job_data.get("status")
+                    yield format_sse("job", _job_event_payload(job_id, job_data))
+                for target in FTP_TARGETS:
+                    ftp_status = (job_data.get(f"ftpUploadStatus{target.capitalize()}"), job_data.get(f"ftpUploadError{target.capitalize()}"))
+                    if ftp_status != last_ftp_status.get(target):
+                        last_ftp_status[target] = ftp_status
+                        yield format_sse("ftp", {"jobId": job_id, "target": target, "status": ftp_status[0], "error": ftp_status[1]})
+                since = job_data["version"]
+                yield format_sse("progress", _job_event_payload(job_id, job_data), event_id=since)
+                last_sent = time.monotonic()
+                # 行毎の通知をまとめて送信する
+                await asyncio.sleep(TOOL03_SSE_MIN_INTERVAL)
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=wait_timeout)
+            except asyncio.TimeoutError:
+                pass
+            if not changed.is_set() and time.monotonic() - last_sent >= TOOL03_SSE_HEARTBEAT_INTERVAL:
+                yield ": heartbeat\n\n"
+                last_sent = time.monotonic()
+    finally:
+        job_events.unsubscribe(job_id, changed)
 
 # --- ZIP 作成関数 ---
-def create_job_zip_archive(job_id: str) -> Optional[str]:
+def list_job_zip_files(job_id: str) -> List[tuple[str, Path]]:
+    """
+    ZIP に含めるファイル (アーカイブ内の名前, パス) のリスト。ジョブの結果が Success の画像を行の順に返します
+    (ジョブストアにジョブが無い場合はディレクトリ内のファイル)。Job ディレクトリが無い場合は FileNotFoundError。
+    """
     job_dir = JOB_STORAGE_BASE_DIR / job_id
     if not job_dir.is_dir():
         logging.error(f"Job ディレクトリが存在しません: {job_dir}")
         raise FileNotFoundError("Job ディレクトリが見つかりません。")
-    temp_dir = tempfile.gettempdir()
-    zip_filename_base = f"tool03_images_{job_id}"
-    zip_output_path_base = os.path.join(temp_dir, zip_filename_base)
-    try:
-        zip_path = shutil.make_archive(
-            base_name=zip_output_path_base,
-            format='zip',
-            root_dir=str(job_dir)
-        )
-        logging.info(f"Zip ファイルの作成に成功: {zip_path}")
-        return zip_path
-    except Exception as e:
-        logging.error(f"Job {job_id} の Zip ファイル作成中にエラー: {e}", exc_info=True)
-        zip_file = f"{zip_output_path_base}.zip"
-        if os.path.exists(zip_file):
-            try: os.remove(zip_file)
-            except OSError as remove_e: logging.error(f"エラーが発生した一時 Zip ファイルを削除できません: {zip_file}, エラー: {remove_e}")
-        raise Exception("Zip ファイルの作成に失敗しました。") from e
+    job_data = job_store.get(job_id)
+    if job_data is not None:
+        filenames = list(dict.fromkeys(job_data["results"].filenames("Success")))
+    else:
+        filenames = sorted(path.name for path in job_dir.iterdir() if path.is_file() and not path.name.startswith("."))
+    return [(filename, job_dir / filename) for filename in filenames]
+
+def open_job_zip(job_id: str) -> Union[Path, Iterator[bytes]]:
+    """
+    ジョブの画像の無圧縮 ZIP を返します。終了したジョブはキャッシュしたアーカイブ (作成済みならそのパス、
+    作成中なら作成済みの範囲から送るイテレータ)、描画中のジョブはその場で生成するイテレータ (一時ファイルは作らない)。
+    レスポンスの送信開始前にエラーにできるよう、ファイルの一覧はこの関数の呼び出し時に作成します。
+    """
+    files = list_job_zip_files(job_id)
+    job_data = job_store.get_changes(job_id, None, include_results=False) or {}
+    if zip_artifacts.enabled and job_data.get("status") in FINISHED_STATUSES:
+        return zip_artifacts.open(job_id, files)
+    logging.info(f"[Job {job_id}] {len(files)} 件の画像の Zip ストリームを開始します。")
+    return iter_stored_zip(files)
 
 # === 画像再生成バックグラウンドタスク (PATCH) ===
-async def regenerate_specific_images_background(job_id: str, modified_rows: List[Tool03ProductRowInput]):
+async def regenerate_specific_images_background(job_id: str, modified_rows: List[Tool03ProductRowInput]) -> Optional[str]:
+    """
+    modified_rows を再描画し、最終的なステータスを返します (一時停止した場合は "Paused")。
+    一時停止・中断の後に再実行された場合は、既に再描画が済んだ行 (入力が描画済みのものと同じ行) をスキップします。
+    """
     logging.info(f"[Job {job_id}] {len(modified_rows)} 件の画像の再生成/追加を開始します。")
-    current_job_data = job_tracker.get(job_id)
+    current_job_data = job_store.get(job_id)  # このタスク内のローカルコピー (変更はジョブストアにも書き込む)
     if not current_job_data:
         logging.error(f"[Job {job_id}] 画像再生成のための Job が見つかりません (ロジックエラー?)。")
         return
     job_dir = JOB_STORAGE_BASE_DIR / job_id
     if not job_dir.is_dir():
          logging.error(f"[Job {job_id}] Job ディレクトリが存在しません: {job_dir}")
-         current_job_data["status"] = "Failed"
-         current_job_data["message"] = "画像ストレージディレクトリが失われました。"
-         return
-    current_total = current_job_data.get("total", 0)
+         job_store.update(job_id, {"status": "Failed", "message": "画像ストレージディレクトリが失われました。"})
+         job_store.flush()
+         return "Failed"
+    modified_rows, already_done_ids = split_changed_rows(job_id, modified_rows)
+    if already_done_ids:
+        logging.info(f"[Job {job_id}] 再生成済みの {len(already_done_ids)} 行をスキップします (前回の続きから再開)。")
+    status_counts = _ensure_status_counts(current_job_data)
     new_rows_count = 0
+    new_results: Dict[str, Dict[str, Any]] = {}
     for row in modified_rows:
         if row.id not in current_job_data["results"]:
             new_rows_count += 1
-            current_job_data["results"][row.id] = Tool03ImageResult(status="Pending").model_dump()
+            new_results[row.id] = Tool03ImageResult(status="Pending").model_dump()
     if new_rows_count > 0:
+        current_job_data["results"].update(new_results)
+        job_store.set_rows(job_id, "results", new_results)
         updated_total = len(current_job_data["results"])
+        status_counts["Pending"] += updated_total - current_job_data.get("total", 0)
         current_job_data["total"] = updated_total
         logging.info(f"[Job {job_id}] {new_rows_count} 件の新規行を検出。total を {updated_total} に更新しました。")
-    current_job_data["status"] = "Processing"
-    current_job_data["message"] = None
-    current_job_data["endTime"] = None
-    current_job_data["ftpUploadStatusGold"] = "idle"
-    current_job_data["ftpUploadErrorGold"] = None
-    current_job_data["ftpUploadStatusRcabinet"] = "idle"
-    current_job_data["ftpUploadErrorRcabinet"] = None
+    reset_fields = {
+        "total": current_job_data.get("total", 0),
+        "status": "Processing", "message": None, "endTime": None,
+        "ftpUploadStatusGold": "idle", "ftpUploadErrorGold": None,
+        "ftpUploadStatusRcabinet": "idle", "ftpUploadErrorRcabinet": None,
+    }
+    current_job_data.update(reset_fields)
+    job_store.update(job_id, {**reset_fields, "statusCounts": dict(status_counts)})
+    job_store.flush()
+    control = JobControl(job_id, TOOL03_JOB_CONTROL_INTERVAL)
     final_status = "Processing"
+
+    def on_start(index: int, row: Tool03ProductRowInput) -> bool:
+        logging.debug(f"[Job {job_id}] 画像 {index + 1}/{len(modified_rows)} を再生成/追加中 (Row ID: {row.id}, {row.productCode})")
+        current_result_dict = dict(current_job_data["results"].get(row.id) or Tool03ImageResult(status="Pending").model_dump())
+        current_result_dict["status"] = "Processing"
+        current_result_dict["message"] = None
+        current_result_dict["filename"] = None
+        current_result_dict["fileSize"] = None
+        current_result_dict["encodeTimeMs"] = None
+        current_result_dict["quality"] = None
+        current_result_dict["contentHash"] = None
+        current_job_data.setdefault("rowFingerprints", {}).pop(row.id, None)
+        _write_row_result(job_id, current_job_data, row.id, current_result_dict, rows={"rowFingerprints": {row.id: None}})
+        return True
+
+    def on_done(index: int, row: Tool03ProductRowInput, result: Dict[str, Any]):
+        if job_store.exists(job_id):
+            _apply_row_result(job_id, current_job_data, row, result)
+        else:
+            logging.warning(f"[Job {job_id}] 再生成 Row {row.id} の処理完了時に Job がトラッカーに存在しません")
+
     try:
-        for index, row in enumerate(modified_rows):
-            row_id = row.id
-            logging.debug(f"[Job {job_id}] 画像 {index + 1}/{len(modified_rows)} を再生成/追加中 (Row ID: {row_id}, {row.productCode})")
-            current_result_dict = current_job_data["results"].get(row_id, Tool03ImageResult(status="Pending").model_dump())
-            current_result_dict["status"] = "Processing"
-            current_result_dict["message"] = None
-            current_result_dict["filename"] = None
-            current_job_data["results"][row_id] = current_result_dict
-            template_name = row.template or "テンプレートA"
-            base_key = template_name.replace("テンプレート", "")
-            factory_key = base_key
-            has_mobile_data = bool(row.mobileStartDate and row.mobileEndDate)
-            potential_mobile_key = f"{base_key}-2"
-            if has_mobile_data and potential_mobile_key in factory_registry._factories:
-                factory_key = potential_mobile_key
-            try:
-                factory = factory_registry.get_factory(factory_key)
-                img: Image.Image = factory.draw(row, factory_key)
-                output_filename = f"{row.productCode}.jpg"
-                output_path = job_dir / output_filename
-                img.save(output_path, "JPEG", quality=95)
-                current_result_dict["status"] = "Success"
-                current_result_dict["filename"] = output_filename
-                img.close()
-            except (FileNotFoundError, ValueError, NotImplementedError) as e:
-                logging.error(f"[Job {job_id}] 画像の再生成/追加エラー ({row.productCode}, テンプレート '{factory_key}'): {e}")
-                current_result_dict["status"] = "Error"
-                current_result_dict["message"] = str(e)
-            except Exception as draw_error:
-                logging.error(f"[Job {job_id}] 画像の再生成/追加中に不明なエラー ({row.productCode}, テンプレート '{factory_key}'): {draw_error}", exc_info=True)
-                current_result_dict["status"] = "Error"
-                current_result_dict["message"] = "画像描画中に不明なエラーが発生しました。"
-            finally:
-                 if job_id in job_tracker:
-                     job_tracker[job_id]["results"][row_id] = current_result_dict
-                     job_tracker[job_id]["progress"] = len([
-                          res for res in job_tracker[job_id]["results"].values()
-                          if res.get("status") in ["Success", "Error"]
-                     ])
-                 else:
-                     logging.warning(f"[Job {job_id}] 再生成 Row {row_id} の処理完了時に Job がトラッカーに存在しません")
-            await asyncio.sleep(0.01)
-        if job_id in job_tracker:
-             completed_count = 0
-             has_errors = False
-             for res_dict in job_tracker[job_id]["results"].values():
-                  res = Tool03ImageResult(**res_dict)
-                  if res.status == "Error":
-                       has_errors = True
-                  if res.status in ["Success", "Error"]:
-                      completed_count += 1
-             job_tracker[job_id]["progress"] = completed_count
-             current_total = job_tracker[job_id]["total"]
+        rows_to_render = modified_rows
+        stopped_status = None
+        while not await run_render_rows(job_id, rows_to_render, job_dir, get_job_encoder(current_job_data), on_start, on_done, control) \
+                and job_store.exists(job_id):
+            stopped_status = _stopped_status(control)
+            if stopped_status:
+                logging.info(f"[Job {job_id}] 要求により再生成を停止しました。ステータス: {stopped_status}。")
+                break
+            rows_to_render, _ = split_changed_rows(job_id, rows_to_render)  # 停止要求が取り消された場合は未完了の行を続行
+        await asyncio.to_thread(render_cache.evict)
+        if stopped_status:
+            final_status = stopped_status
+        elif job_store.exists(job_id):
+             completed_count = current_job_data["progress"] = status_counts["Success"] + status_counts["Error"]
+             has_errors = status_counts["Error"] > 0
+             job_store.update(job_id, {"progress": completed_count, "statusCounts": dict(status_counts)})
+             current_total = current_job_data["total"]
              if completed_count == current_total:
                  if has_errors:
                       final_status = "Completed with errors"
@@ -871,13 +824,278 @@ async def regenerate_specific_images_background(job_id: str, modified_rows: List
     except Exception as e:
         final_status = "Failed"
         logging.error(f"[Job {job_id}] 画像の再生成/追加中に重大なエラーが発生: {e}", exc_info=True)
-        if job_id in job_tracker:
-            job_tracker[job_id]["message"] = f"画像の再生成/追加中にシステムエラー: {e}"
+        job_store.update(job_id, {"message": f"画像の再生成/追加中にシステムエラー: {e}"})
     finally:
-        if job_id in job_tracker and final_status != "Processing":
-            end_time = time.time()
-            job_tracker[job_id]["status"] = final_status
-            job_tracker[job_id]["endTime"] = end_time
+        if final_status == "Paused":
+            job_store.update(job_id, {"status": final_status})
+        elif final_status != "Processing":
+            job_store.update(job_id, {"status": final_status, "endTime": time.time()})
+        job_store.flush()
+        if final_status not in ("Processing", "Paused"):
+            notify_job_completed(job_id)
+        log_image_cache_stats()
+    return final_status
+
+# === ジョブキュー ===
+def max_rows_per_job() -> int:
+    """1 ジョブで受け付ける最大行数 (0 は無制限)。キュー内の行数の上限より大きいジョブは待っても登録できないため、それらの最小値。"""
+    limits = [limit for limit in (TOOL03_MAX_ROWS_PER_JOB, TOOL03_MAX_QUEUED_ROWS_PER_COMPANY, TOOL03_MAX_INFLIGHT_ROWS) if limit > 0]
+    return min(limits) if limits else 0
+
+def _retry_after_seconds(excess_rows: int) -> int:
+    # 超過分の行が全ワーカーで処理されるまでの目安
+    return min(3600, max(1, math.ceil(job_runner.estimate_seconds(excess_rows))))
+
+def check_job_admission(row_count: int, company_id: Optional[str] = None):
+    """キュー内の行数の上限 (会社毎・全体) を確認し、超える場合は QueueFullError を送出します。"""
+    load = job_queue.load(company_id)
+    if TOOL03_MAX_QUEUED_ROWS_PER_COMPANY > 0 and load.company_rows + row_count > TOOL03_MAX_QUEUED_ROWS_PER_COMPANY:
+        raise QueueFullError(
+            f"処理待ちの画像が多すぎます (この会社のキュー内: {load.company_rows} 行, 上限: {TOOL03_MAX_QUEUED_ROWS_PER_COMPANY} 行)。",
+            _retry_after_seconds(load.company_rows + row_count - TOOL03_MAX_QUEUED_ROWS_PER_COMPANY),
+        )
+    if TOOL03_MAX_INFLIGHT_ROWS > 0 and load.rows + row_count > TOOL03_MAX_INFLIGHT_ROWS:
+        raise QueueFullError(
+            f"サーバーが混雑しています (キュー内: {load.rows} 行, 上限: {TOOL03_MAX_INFLIGHT_ROWS} 行)。",
+            _retry_after_seconds(load.rows + row_count - TOOL03_MAX_INFLIGHT_ROWS),
+        )
+
+def enqueue_generation_job(job_id: str, product_rows: List[Tool03ProductRowInput], encoder: Optional[Tool03EncoderOptions] = None,
+                           callback_url: Optional[str] = None, company_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    描画ジョブをキューに登録し、キューの状況 (先に実行されるジョブ数・行数と開始/完了までの目安) を返します。
+    流入制限を超える場合は QueueFullError を送出します。実行されるまでジョブは Pending として参照できます。
+    """
+    check_job_admission(len(product_rows), company_id)
+    encoder = encoder or DEFAULT_ENCODER_OPTIONS
+    start_time = time.time()
+    job_store.create(job_id, _initial_job_data(len(product_rows), encoder, callback_url, company_id, "Pending", start_time))
+    payload = {
+        "rows": [row.model_dump() for row in product_rows],
+        "encoder": encoder.model_dump(),
+        "callbackUrl": callback_url,
+    }
+    job_checkpoints.save_input(job_id, {**payload, "companyId": company_id, "startTime": start_time})
+    entry_id = _enqueue_generate_payload(job_id, payload, company_id)
+    job_runner.start()
+    job_runner.wake()
+    ahead = job_queue.ahead(entry_id)
+    return {
+        "queueDepth": ahead.entries,
+        "rowsAhead": ahead.rows,
+        "estimatedStartSeconds": round(job_runner.estimate_seconds(ahead.rows), 1),
+        "estimatedCompletionSeconds": round(job_runner.estimate_seconds(ahead.rows, len(product_rows)), 1),
+    }
+
+def _enqueue_generate_payload(job_id: str, payload: Dict[str, Any], company_id: Optional[str]) -> int:
+    row_count = len(payload["rows"])
+    lane = LANE_HIGH if row_count <= TOOL03_JOB_QUEUE_PRIORITY_MAX_ROWS else LANE_NORMAL
+    return job_queue.enqueue(job_id, "generate", payload, lane, company_id, row_count)
+
+def enqueue_regeneration_job(job_id: str, modified_rows: List[Tool03ProductRowInput], company_id: Optional[str] = None):
+    """再生成 (PATCH) を高優先レーンに登録します。同じジョブの先行するエントリが終わってから実行されます。"""
+    job_data = job_store.get_changes(job_id, None, include_results=False) or {}
+    company_id = company_id or job_data.get("companyId")
+    if job_data.get("control") == CONTROL_PAUSED:
+        updates = {"endTime": None}  # 一時停止中のジョブは再開されるまで実行しない
+    else:
+        # 実行待ちの間に Completed のままだとポーリングが終わってしまうため Pending にする (キャンセル済みのジョブも再び実行可能にする)
+        updates = {"status": "Pending", "endTime": None, "control": None}
+    job_store.update(job_id, updates)
+    job_store.flush()
+    job_queue.enqueue(job_id, "regenerate", {"rows": [row.model_dump() for row in modified_rows]}, LANE_HIGH, company_id, len(modified_rows))
+    job_runner.start()
+    job_runner.wake()
+
+def _queue_outcome(final_status: Optional[str]) -> Optional[str]:
+    """ジョブの最終ステータスをキューの結果に変換します (一時停止した場合は PAUSED を返し、エントリを再開まで保留する)。"""
+    return PAUSED if final_status == "Paused" else final_status
+
+async def _run_generate_entry(entry: QueueEntry) -> Optional[str]:
+    payload = entry.payload
+    return _queue_outcome(await generate_images_background(
+        entry.job_id,
+        [Tool03ProductRowInput(**row) for row in payload["rows"]],
+        Tool03EncoderOptions(**payload["encoder"]) if payload.get("encoder") else None,
+        payload.get("callbackUrl"),
+        entry.company_id,
+    ))
+
+async def _run_regenerate_entry(entry: QueueEntry) -> Optional[str]:
+    return _queue_outcome(await regenerate_specific_images_background(
+        entry.job_id, [Tool03ProductRowInput(**row) for row in entry.payload["rows"]],
+    ))
+
+def _fail_dead_entry(entry: QueueEntry):
+    # ワーカーの異常終了が続いたジョブ (最大試行回数に到達)
+    if job_store.exists(entry.job_id):
+        job_store.update(entry.job_id, {"status": "Failed", "endTime": time.time(), "message": "ジョブの実行が繰り返し中断されたため中止しました。"})
+        job_store.flush()
+    if entry.kind == "generate":
+        job_checkpoints.remove(entry.job_id)
+        notify_job_completed(entry.job_id)
+
+def _on_entry_parked(entry: QueueEntry):
+    # 描画ループが停止してから park() するまでの間に再開・キャンセルされた場合の後始末
+    state = JobControl(entry.job_id).state(refresh=True)
+    if state is None:
+        job_queue.resume_job(entry.job_id)
+        job_store.update(entry.job_id, {"status": "Pending"})
+        job_store.flush()
+        job_runner.wake()
+    elif state == CONTROL_CANCELLED:
+        cancel_job(entry.job_id)
+
+job_runner = JobRunner(
+    job_queue, {"generate": _run_generate_entry, "regenerate": _run_regenerate_entry},
+    TOOL03_JOB_QUEUE_WORKERS, TOOL03_JOB_QUEUE_POLL_INTERVAL, on_dead=_fail_dead_entry,
+    rows_per_second=TOOL03_JOB_QUEUE_ROWS_PER_SECOND, on_parked=_on_entry_parked,
+)
+
+# === 一時停止・再開・キャンセル ===
+FINISHED_STATUSES = ("Completed", "Completed with errors", "Failed", "Cancelled")
+
+def _is_ftp_uploading(job_data: Dict[str, Any]) -> bool:
+    return any(job_data.get(f"ftpUploadStatus{target.capitalize()}") in ("uploading", "paused") for target in FTP_TARGETS)
+
+def pause_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    ジョブの描画 (キュー待ちを含む) と FTP アップロードを一時停止します。
+    実行中の描画は描画中の行を完了させてから停止し、ワーカーを解放します (描画済みの画像はそのまま利用可能)。
+    ジョブが無い場合は None、一時停止できる処理が無い場合は ValueError。
+    """
+    job_data = job_store.get_changes(job_id, None, include_results=False)
+    if job_data is None:
+        return None
+    status = job_data.get("status")
+    if job_data.get("control") == CONTROL_CANCELLED:
+        raise ValueError("キャンセル済みのジョブは一時停止できません。")
+    if status in FINISHED_STATUSES and not _is_ftp_uploading(job_data):
+        raise ValueError(f"ジョブは既に終了しています ({status})。")
+    updates: Dict[str, Any] = {"control": CONTROL_PAUSED}
+    if job_queue.pause_job(job_id) and status in ("Pending", "Paused"):
+        updates["status"] = "Paused"  # キュー待ちのジョブはすぐに Paused (実行中の場合は描画ループが停止した時点で Paused)
+    job_store.update(job_id, updates)
+    job_store.flush()
+    job_checkpoints.record_control(job_id, CONTROL_PAUSED)
+    logging.info(f"[Job {job_id}] 一時停止を受け付けました (ステータス: {status})。")
+    return {**job_data, **updates}
+
+def resume_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """一時停止したジョブを再開します (描画は完了済みの行を除いて続きから)。ジョブが無い場合は None、一時停止中でない場合は ValueError。"""
+    job_data = job_store.get_changes(job_id, None, include_results=False)
+    if job_data is None:
+        return None
+    if job_data.get("control") != CONTROL_PAUSED:
+        raise ValueError("ジョブは一時停止されていません。")
+    updates: Dict[str, Any] = {"control": None}
+    if job_data.get("status") == "Paused":
+        updates["status"] = "Pending"
+    job_store.update(job_id, updates)
+    job_store.flush()
+    job_checkpoints.record_control(job_id, None)
+    if job_queue.resume_job(job_id):
+        job_runner.start()
+        job_runner.wake()
+    logging.info(f"[Job {job_id}] 再開を受け付けました。")
+    return {**job_data, **updates}
+
+def cancel_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    ジョブの描画 (キュー待ち・一時停止中を含む) と FTP アップロードをキャンセルします。描画済みの画像と結果は残します。
+    ジョブが無い場合は None、既に終了している場合は ValueError。
+    """
+    job_data = job_store.get_changes(job_id, None, include_results=False)
+    if job_data is None:
+        return None
+    status = job_data.get("status")
+    if status in FINISHED_STATUSES and not _is_ftp_uploading(job_data):
+        raise ValueError(f"ジョブは既に終了しています ({status})。")
+    updates: Dict[str, Any] = {"control": CONTROL_CANCELLED}
+    job_store.update(job_id, updates)
+    if not job_queue.cancel_job(job_id) and status not in FINISHED_STATUSES:
+        # 実行中のワーカーが無い (キュー待ち・一時停止中) 場合はすぐに Cancelled (実行中の場合は描画ループが停止した時点で Cancelled)
+        updates.update({"status": "Cancelled", "endTime": time.time()})
+        job_store.update(job_id, updates)
+        job_store.flush()
+        job_checkpoints.remove(job_id)
+        notify_job_completed(job_id)
+    job_store.flush()
+    logging.info(f"[Job {job_id}] キャンセルを受け付けました (ステータス: {status})。")
+    return {**job_data, **updates}
+
+def _restore_checkpointed_job(checkpoint: JobCheckpoint, queued_job_ids: set):
+    """
+    前回の起動で未完了だったジョブをチェックポイントから復元し、キューに無ければ登録し直します。
+    ジョブストアにジョブが無い場合 (memory) は、完了済みの行 (画像ファイルが残っているもの) の結果も復元するため、
+    再実行時はその続きから描画します。一時停止中だったジョブは一時停止のまま復元します。
+    """
+    job_id, job_input = checkpoint.job_id, checkpoint.input
+    job_data = job_store.get_changes(job_id, None, include_results=False)
+    if job_data is not None and job_data.get("status") in FINISHED_STATUSES:
+        job_checkpoints.remove(job_id)  # 終了後、チェックポイントを削除する前に停止した場合
+        return
+    paused = checkpoint.control == CONTROL_PAUSED
+    if job_data is None:
+        encoder = Tool03EncoderOptions(**job_input["encoder"]) if job_input.get("encoder") else DEFAULT_ENCODER_OPTIONS
+        job_data = _initial_job_data(
+            len(job_input["rows"]), encoder, job_input.get("callbackUrl"), job_input.get("companyId"),
+            "Paused" if paused else "Pending", job_input.get("startTime") or time.time(),
+        )
+        job_dir = JOB_STORAGE_BASE_DIR / job_id
+        for row_id, result in checkpoint.results.items():
+            if result.get("status") == "Success" and not (job_dir / (result.get("filename") or "")).is_file():
+                continue  # 画像が残っていない行は描画し直す
+            _set_row_result(job_data, row_id, result)
+            if checkpoint.fingerprints.get(row_id):
+                job_data["rowFingerprints"][row_id] = checkpoint.fingerprints[row_id]
+        if paused:
+            job_data["control"] = CONTROL_PAUSED
+        job_store.create(job_id, job_data)
+        logging.info(f"[Job {job_id}] チェックポイントからジョブを復元しました (完了済み {job_data['progress']}/{job_data['total']} 件)。")
+    if job_id not in queued_job_ids:
+        payload = {key: job_input.get(key) for key in ("rows", "encoder", "callbackUrl")}
+        _enqueue_generate_payload(job_id, payload, job_input.get("companyId"))
+        if paused:
+            job_queue.pause_job(job_id)
+        else:
+            job_store.update(job_id, {"status": "Pending"})
+        job_store.flush()
+        logging.info(f"[Job {job_id}] 未完了のジョブをキューに登録し直しました。")
+
+def start_job_runner():
+    """
+    アプリ起動時にジョブランナーを起動します。キューに残っている (前回の起動で未完了の) ジョブも再開されます。
+    キューがプロセス内 (memory) の場合も、チェックポイントの残っているジョブはキューに登録し直して再開します。
+    """
+    queued_job_ids = {entry.job_id for entry in job_queue.entries("generate")}
+    for job_id in job_checkpoints.job_ids():
+        checkpoint = job_checkpoints.load(job_id)
+        if checkpoint is None:
+            continue
+        try:
+            _restore_checkpointed_job(checkpoint, queued_job_ids)
+        except Exception as e:
+            logging.error(f"[Job {job_id}] チェックポイントからの復元に失敗しました: {e}", exc_info=True)
+    for entry in job_queue.entries("generate"):
+        if not job_store.exists(entry.job_id):
+            # ジョブストアがプロセス内 (memory) の場合、再起動で失われた待機中のジョブを Pending として復元する
+            encoder = Tool03EncoderOptions(**entry.payload["encoder"]) if entry.payload.get("encoder") else DEFAULT_ENCODER_OPTIONS
+            job_store.create(entry.job_id, _initial_job_data(
+                len(entry.payload["rows"]), encoder, entry.payload.get("callbackUrl"), entry.company_id, "Pending", entry.enqueued_at,
+            ))
+    job_runner.start()
+
+async def stop_job_runner():
+    """実行中のジョブを中断してキューに戻し (次回の起動時に再実行)、レンダーワーカープールを停止して送信中のコールバックを待ちます。"""
+    await job_runner.stop()
+    shutdown_render_pool()
+    job_store.flush()
+    job_checkpoints.close()
+    try:
+        await asyncio.wait_for(webhook_sender.drain(), webhook_sender.timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"送信中のコールバック {webhook_sender.pending()} 件を待たずに終了します。")
 
 # === FTP アップロード関数 ===
 def upload_job_images_to_ftp(job_id: str, target: str):
@@ -895,29 +1113,33 @@ def upload_job_images_to_ftp(job_id: str, target: str):
     config = ftp_configs.get(target)
     if not config:
         logging.error(f"[Job {job_id}] ターゲット '{target}' の FTP 設定が見つかりません")
-        if job_id in job_tracker:
-            ftp_status_key = f"ftpUploadStatus{target.capitalize()}"
-            ftp_error_key = f"ftpUploadError{target.capitalize()}"
-            job_tracker[job_id][ftp_status_key] = "failed"
-            job_tracker[job_id][ftp_error_key] = f"FTP 設定 '{target}' が見つかりません。"
+        ftp_status_key = f"ftpUploadStatus{target.capitalize()}"
+        ftp_error_key = f"ftpUploadError{target.capitalize()}"
+        job_store.update(job_id, {ftp_status_key: "failed", ftp_error_key: f"FTP 設定 '{target}' が見つかりません。"})
+        job_store.flush()
+        notify_ftp_completed(job_id, target, "failed", f"FTP 設定 '{target}' が見つかりません。")
         return
     job_dir = JOB_STORAGE_BASE_DIR / job_id
     if not job_dir.is_dir():
         logging.error(f"[Job {job_id}] アップロード対象の Job ディレクトリが存在しません: {job_dir}")
-        if job_id in job_tracker:
-            ftp_status_key = f"ftpUploadStatus{target.capitalize()}"
-            ftp_error_key = f"ftpUploadError{target.capitalize()}"
-            job_tracker[job_id][ftp_status_key] = "failed"
-            job_tracker[job_id][ftp_error_key] = "画像を含むディレクトリが存在しません。"
+        ftp_status_key = f"ftpUploadStatus{target.capitalize()}"
+        ftp_error_key = f"ftpUploadError{target.capitalize()}"
+        job_store.update(job_id, {ftp_status_key: "failed", ftp_error_key: "画像を含むディレクトリが存在しません。"})
+        job_store.flush()
+        notify_ftp_completed(job_id, target, "failed", "画像を含むディレクトリが存在しません。")
         return
     logging.info(f"[Job {job_id}] FTP ターゲット '{target}' (ホスト: {config['host']}) へのアップロードを開始します。")
     ftp_status_key = f"ftpUploadStatus{target.capitalize()}"
     ftp_error_key = f"ftpUploadError{target.capitalize()}"
     upload_status = "failed"
     upload_error_msg = None
-    if job_id in job_tracker:
-         job_tracker[job_id][ftp_status_key] = "uploading"
-         job_tracker[job_id][ftp_error_key] = None
+    job_data = job_store.get(job_id)
+    if job_data:
+         upload_fields = {ftp_status_key: "uploading", ftp_error_key: None}
+         if job_data.get("control") == CONTROL_CANCELLED and job_data.get("status") in FINISHED_STATUSES:
+             upload_fields["control"] = None  # 以前のキャンセル要求で新しいアップロードが止まらないようにする
+         job_store.update(job_id, upload_fields)
+         job_store.flush()
     else:
          logging.warning(f"[Job {job_id}] FTP アップロード開始時に Job がトラッカーに存在しません。")
          return
@@ -955,19 +1177,30 @@ def upload_job_images_to_ftp(job_id: str, target: str):
                   upload_error_msg = f"FTP ディレクトリ '{config['remote_dir']}' へのアクセス権エラー: {e}"
                   logging.error(f"[Job {job_id}] {upload_error_msg}", exc_info=True)
                   raise
-        image_files_to_upload = []
-        if job_id in job_tracker and "results" in job_tracker[job_id]:
-             for result_data in job_tracker[job_id]["results"].values():
-                 res = Tool03ImageResult(**result_data)
-                 if res.status == "Success" and res.filename and (job_dir / res.filename).is_file():
-                     image_files_to_upload.append(res.filename)
+        image_files_to_upload = [
+             filename for filename in job_data["results"].filenames("Success")
+             if (job_dir / filename).is_file()
+        ]
         successful_uploads = 0
         total_to_upload = len(image_files_to_upload)
         upload_errors = []
+        cancelled = False
+        control = JobControl(job_id, TOOL03_JOB_CONTROL_INTERVAL)
         if not image_files_to_upload:
              logging.warning(f"[Job {job_id}] {target} にアップロードする正常な画像がありません。")
              upload_status = "success"
         for filename in image_files_to_upload:
+            # ファイル毎に一時停止・キャンセルを確認 (一時停止中は NOOP で FTP 接続を維持して再開を待つ)
+            if control.state() == CONTROL_PAUSED:
+                logging.info(f"[Job {job_id}] FTP アップロード ({target}) を一時停止します ({successful_uploads}/{total_to_upload} ファイル完了)。")
+                job_store.update(job_id, {ftp_status_key: "paused"})
+                job_store.flush()
+                if control.wait_while_paused(keepalive=lambda: ftp.voidcmd("NOOP")):
+                    job_store.update(job_id, {ftp_status_key: "uploading"})
+                    job_store.flush()
+            if control.state() == CONTROL_CANCELLED:
+                cancelled = True
+                break
             local_path = job_dir / filename
             remote_path = filename
             try:
@@ -979,7 +1212,11 @@ def upload_job_images_to_ftp(job_id: str, target: str):
                  err_msg = f"ファイル {filename} のアップロードエラー: {upload_e}"
                  logging.error(f"[Job {job_id}] {err_msg}", exc_info=True)
                  upload_errors.append(err_msg)
-        if successful_uploads == total_to_upload:
+        if cancelled:
+             upload_status = "cancelled"
+             upload_error_msg = f"キャンセルされました ({successful_uploads}/{total_to_upload} ファイルをアップロード済み)。"
+             logging.info(f"[Job {job_id}] FTP アップロード ({target}) をキャンセルしました。{upload_error_msg}")
+        elif successful_uploads == total_to_upload:
              upload_status = "success"
              logging.info(f"[Job {job_id}] アップロード完了。成功: {successful_uploads}/{total_to_upload} ファイル (ターゲット: {target})。")
         else:
@@ -995,33 +1232,38 @@ def upload_job_images_to_ftp(job_id: str, target: str):
         upload_error_msg = f"FTP アップロード中に不明なエラー ({target}): {e}"
         logging.error(f"[Job {job_id}] {upload_error_msg}", exc_info=True)
     finally:
-        if ftp:
+        if ftp and ftp.sock:  # 接続に失敗した場合は quit() できない
             try: ftp.quit()
             except ftplib.all_errors: pass
-        if job_id in job_tracker:
-            job_tracker[job_id][ftp_status_key] = upload_status
-            job_tracker[job_id][ftp_error_key] = upload_error_msg
+        if job_store.exists(job_id):
+            job_store.update(job_id, {ftp_status_key: upload_status, ftp_error_key: upload_error_msg})
+            job_store.flush()
             logging.info(f"[Job {job_id}] FTP ステータス '{target}' を '{upload_status}' に更新しました。")
+            notify_ftp_completed(job_id, target, upload_status, upload_error_msg)
 
 # === 古いジョブのクリーンアップ関数 ===
 async def cleanup_old_jobs():
      current_time = time.time()
      timeout = 3600
      jobs_to_delete = [
-          job_id for job_id, data in list(job_tracker.items())
-          if current_time - (data.get("endTime") or data.get("startTime", 0)) > timeout
+          job_id for job_id, data in job_store.list_job_fields(("startTime", "endTime")).items()
+          if current_time - (data.get("endTime") or data.get("startTime") or 0) > timeout
      ]
      if jobs_to_delete:
           logging.info(f"{len(jobs_to_delete)} 件の古いジョブのクリーンアップを準備中。")
           for job_id in jobs_to_delete:
                logging.info(f"古いジョブをクリーンアップ中: {job_id}")
                try:
-                    job_tracker.pop(job_id, None)
+                    job_store.delete(job_id)
+                    job_checkpoints.remove(job_id)
+                    zip_artifacts.remove(job_id)
+                    image_bytes.remove_job(job_id)
                     job_dir = JOB_STORAGE_BASE_DIR / job_id
                     if job_dir.exists():
                          shutil.rmtree(job_dir)
                except Exception as e:
                     logging.error(f"Job {job_id} のクリーンアップ中にエラー: {e}")
+     log_image_cache_stats()
      await asyncio.sleep(600)
      asyncio.create_task(cleanup_old_jobs())
 
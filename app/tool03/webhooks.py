@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import hmac
+import json
+import time
+import uuid
+import random
+import asyncio
+import socket
+import hashlib
+import logging
+import ipaddress
+from typing import Any, Dict, Iterable, Optional, Set
+from urllib.parse import urlsplit
+
+import anyio.from_thread
+import httpx
+
+# 再送する HTTP ステータス (これ以外の 4xx は受信側の設定誤りとみなし再送しない)
+RETRYABLE_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+class CallbackUrlError(ValueError):
+    """callbackUrl が送信先として許可されていない (または解決できない) 場合のエラー。"""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable  # DNS の一時的な失敗など、送信時であれば再送で解消し得る
+
+
+def _host_allowed(host: str, allowed_hosts: Iterable[str]) -> bool:
+    for entry in allowed_hosts:
+        if host == entry or (entry.startswith("*.") and host.endswith(entry[1:])):
+            return True
+    return False
+
+
+def _is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])  # IPv6 のスコープ ID を除く
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_callback_url(url: str, allowed_hosts: Iterable[str] = ()):
+    """
+    url にコールバックを送信してよいか確認します (許可されない場合は CallbackUrlError)。
+    allowed_hosts を指定した場合は、そのホスト ("*.example.com" 形式可) のみ許可し、アドレスは確認しません (社内の受信先用)。
+    指定しない場合は、ホストが解決される全てのアドレスがグローバルアドレスであることを確認し、
+    ループバック・プライベート・リンクローカル (169.254.169.254 のメタデータなど) への送信 (SSRF) を拒否します。
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower().rstrip(".")
+    if parts.scheme not in ("http", "https") or not host:
+        raise CallbackUrlError("callbackUrl には http(s) の URL を指定してください。")
+    allowed_hosts = tuple(allowed_hosts)
+    if allowed_hosts:
+        if not _host_allowed(host, allowed_hosts):
+            raise CallbackUrlError(f"callbackUrl のホスト {host} は送信先として許可されていません。")
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)}
+    except (OSError, UnicodeError, ValueError) as e:
+        raise CallbackUrlError(f"callbackUrl のホスト {host} を解決できません: {e}", retryable=True)
+    for address in sorted(addresses):
+        if not _is_public_address(address):
+            raise CallbackUrlError(f"callbackUrl のホスト {host} は内部アドレス ({address}) のため送信できません。")
+
+
+def sign_payload(secret: str, timestamp: int, body: bytes) -> str:
+    """"{timestamp}.{body}" の HMAC-SHA256 署名を "t=...,v1=..." 形式で返します。"""
+    digest = hmac.new(secret.encode("utf-8"), f"{timestamp}.".encode("ascii") + body, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+class WebhookSender:
+    """
+    ジョブ完了・FTP アップロード完了のコールバック (署名付き POST) を非同期に送信します。
+    送信はイベントループ上のタスクで行い、同時送信数を concurrency に制限し、
+    接続エラー・5xx・429 の場合は指数バックオフで max_attempts 回まで再送します。
+    送信先は試行毎に check_callback_url で確認します (登録後に DNS が内部アドレスに変わった場合も送信しない)。
+    リダイレクトには従いません。
+    send() は描画タスク (イベントループ) と FTP アップロード (スレッドプール) のどちらからでも呼び出せます。
+    """
+
+    def __init__(self, secret: str, concurrency: int = 4, max_attempts: int = 5, timeout: float = 10.0, backoff: float = 1.0,
+                 allowed_hosts: Iterable[str] = ()):
+        self.secret = secret
+        self.allowed_hosts = tuple(host.strip().lower() for host in allowed_hosts if host.strip())
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.timeout = timeout
+        self.backoff = backoff
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.delivered = 0
+        self.failed = 0
+        if not secret:
+            logging.warning("TOOL03_WEBHOOK_SECRET が設定されていないため、コールバックは署名なしで送信されます。")
+
+    def check_url(self, url: str):
+        """url が送信先として許可されているか確認します (許可されない場合は CallbackUrlError)。"""
+        check_callback_url(url, self.allowed_hosts)
+
+    def send(self, url: Optional[str], event: str, payload: Dict[str, Any]):
+        """url にイベントを送信するタスクを登録します (url が空の場合は何もしない)。"""
+        if not url:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                # スレッドプール (BackgroundTasks の同期関数) から呼ばれた場合はイベントループ側で登録する
+                anyio.from_thread.run_sync(self._schedule, url, event, payload)
+            except RuntimeError:
+                logging.error(f"イベントループ外から呼び出されたため、コールバック {event} を送信できません: {url}")
+            return
+        self._schedule(url, event, payload)
+
+    def _schedule(self, url: str, event: str, payload: Dict[str, Any]):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # httpx クライアントとセマフォはイベントループ毎に作り直す
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        task = loop.create_task(self._deliver(url, event, payload))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self):
+        """送信中・再送待ちのコールバックが全て終わるまで待ちます。"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def _deliver(self, url: str, event: str, payload: Dict[str, Any]):
+        delivery_id = str(uuid.uuid4())  # 再送でも同じ ID (受信側の重複排除用)
+        body = json.dumps({"event": event, "deliveryId": delivery_id, **payload}, ensure_ascii=False, default=str).encode("utf-8")
+        client, semaphore = self._client, self._semaphore
+        for attempt in range(1, self.max_attempts + 1):
+            timestamp = int(time.time())
+            headers = {
+                "Content-Type": "application/json",
+                "User-Agent": "EnpaPortal-Tool03-Webhook/1.0",
+                "X-Tool03-Event": event,
+                "X-Tool03-Delivery": delivery_id,
+                "X-Tool03-Attempt": str(attempt),
+            }
+            if self.secret:
+                headers["X-Tool03-Signature"] = sign_payload(self.secret, timestamp, body)
+            retry_after: Optional[float] = None
+            try:
+                await asyncio.to_thread(self.check_url, url)
+            except CallbackUrlError as e:
+                error = str(e)
+                if not e.retryable:
+                    break
+            else:
+                async with semaphore:
+                    try:
+                        response = await client.post(url, content=body, headers=headers)
+                    except httpx.HTTPError as e:
+                        error = f"{type(e).__name__}: {e}"
+                    else:
+                        if response.status_code < 300:
+                            self.delivered += 1
+                            logging.info(f"コールバック {event} を送信しました ({url}, 試行 {attempt} 回目, HTTP {response.status_code})")
+                            return
+                        error = f"HTTP {response.status_code}"
+                        if response.status_code not in RETRYABLE_STATUS_CODES:
+                            break
+                        retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+            if attempt < self.max_attempts:
+                delay = self.backoff * (2 ** (attempt - 1)) * (1 + random.random() * 0.25)
+                if retry_after is not None:
+                    delay = max(delay, min(retry_after, 300))
+                logging.warning(f"コールバック {event} の送信に失敗しました ({url}, {error})。{delay:.1f} 秒後に再送します ({attempt}/{self.max_attempts})")
+                await asyncio.sleep(delay)
+        self.failed += 1
+        logging.error(f"コールバック {event} の送信を断念しました ({url}, {error}, 試行 {attempt} 回)")
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None  # HTTP-date 形式は未対応 (通常のバックオフを使用)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from .zip_stream import ZIP_STREAM_CHUNK_SIZE, ZipEntry, central_directory, iter_file_entry, iter_stored_zip, local_header
+
+# 他のプロセスが作成中の .part がこの秒数更新されていなければ、異常終了したものとみなして作り直す
+_STALE_PART_SECONDS = 300
+# 前のバージョンからエントリをコピーする単位 (作成中のアーカイブを読むリクエストにこの単位で送る)
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class _ZipBuild:
+    """作成中のアーカイブ。同じバージョンを要求したリクエストは、作成済みの範囲を .part ファイルから読みながら待ちます。"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.cond = threading.Condition()
+        self.written = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+
+    def advance(self, size: int):
+        with self.cond:
+            self.written += size
+            self.cond.notify_all()
+
+    def iter_bytes(self, chunk_size: int) -> Iterator[bytes]:
+        with self.cond:
+            if self.error is not None:
+                raise RuntimeError("Zip アーカイブの作成に失敗しました。") from self.error
+            f = open(self.path, "rb")  # 作成完了時のリネームと競合しないようロック内で開く
+        with f:
+            pos = 0
+            while True:
+                with self.cond:
+                    while self.written - pos < chunk_size and not self.done and self.error is None:
+                        self.cond.wait()
+                    if self.error is not None:
+                        raise RuntimeError("Zip アーカイブの作成に失敗しました。") from self.error
+                    written, done = self.written, self.done
+                while pos < written:
+                    block = f.read(min(chunk_size, written - pos))
+                    if not block:
+                        break
+                    pos += len(block)
+                    yield block
+                if done and pos >= written:
+                    return
+
+
+class ZipArtifactCache:
+    """
+    ジョブの画像の無圧縮 ZIP をジョブ・バージョン毎に保存し、ダウンロードで再利用するキャッシュ。
+    バージョンは各画像の (名前, inode, 更新日時, サイズ) のハッシュのため、再生成で置き換えられた画像があると別のバージョンになります。
+    新しいバージョンは前のバージョンのアーカイブから変更の無いエントリ (ヘッダー + データ) をそのままコピーし、
+    変更・追加された画像のみ読み込んで CRC を計算します。
+    同じバージョンの作成中に届いたリクエストは同じ作成処理を共有し、作成済みの範囲から順に送信します (先頭のバイトはすぐに届く)。
+    他のプロセスが同じバージョンを作成中の場合は、キャッシュせずにその場でストリームします。
+    合計サイズが max_bytes を超えた場合は最終利用日時の古いアーカイブから削除します。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, chunk_size: int = ZIP_STREAM_CHUNK_SIZE):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._builds: Dict[Tuple[str, str], _ZipBuild] = {}
+        self.hits = 0
+        self.builds = 0
+        self.shared = 0
+        self.reused_entries = 0
+        self.written_entries = 0
+        if self.enabled:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def open(self, job_id: str, files: Iterable[Tuple[str, Path]]) -> Union[Path, Iterator[bytes]]:
+        """
+        files (アーカイブ内の名前, ファイルパス) の ZIP を返します。
+        作成済みの場合はアーカイブのパス、作成中・未作成の場合はアーカイブのバイト列のイテレータ。
+        """
+        entries = []
+        for name, path in files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # 削除・置き換え中のファイル
+            entries.append((name, Path(path), (stat.st_ino, stat.st_mtime_ns, stat.st_size)))
+        version = hashlib.sha256(
+            json.dumps([(name, identity) for name, _, identity in entries], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()[:32]
+        job_dir = self.cache_dir / job_id
+        archive_path = job_dir / f"{version}.zip"
+        with self._lock:
+            build = self._builds.get((job_id, version))
+            if build is not None:
+                self.shared += 1
+                return build.iter_bytes(self.chunk_size)
+            if archive_path.is_file():
+                self.hits += 1
+                try:
+                    os.utime(archive_path)  # 削除の順序 (最終利用日時) を更新
+                except OSError:
+                    pass
+                return archive_path
+            job_dir.mkdir(parents=True, exist_ok=True)
+            part_path = job_dir / f"{version}.zip.part"
+            fd = self._create_part(part_path)
+            if fd is None:
+                logging.info(f"[Job {job_id}] Zip アーカイブは他のプロセスで作成中のため、キャッシュせずに送信します。")
+                return iter_stored_zip([(name, path) for name, path, _ in entries], self.chunk_size)
+            build = _ZipBuild(part_path)
+            self._builds[(job_id, version)] = build
+            self.builds += 1
+        threading.Thread(
+            target=self._build, args=(job_id, version, entries, fd, build), name=f"tool03-zip-{job_id[:8]}", daemon=True,
+        ).start()
+        return build.iter_bytes(self.chunk_size)
+
+    @staticmethod
+    def _create_part(part_path: Path) -> Optional[int]:
+        for _ in range(2):
+            try:
+                return os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+            except FileExistsError:
+                try:
+                    if time.time() - part_path.stat().st_mtime < _STALE_PART_SECONDS:
+                        return None
+                    part_path.unlink()
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def _previous(self, job_id: str, version: str) -> Tuple[Optional[Path], Dict[tuple, list]]:
+        """最後に作成された別のバージョンのアーカイブと、その (名前, inode, 更新日時, サイズ) -> エントリ情報。"""
+        manifests = sorted(
+            (path for path in (self.cache_dir / job_id).glob("*.json") if path.stem != version),
+            key=lambda path: path.stat().st_mtime, reverse=True,
+        )
+        for manifest_path in manifests:
+            archive_path = manifest_path.with_suffix(".zip")
+            try:
+                with open(manifest_path, encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if archive_path.stat().st_size != manifest["size"]:
+                    continue
+            except (OSError, ValueError, KeyError):
+                continue
+            return archive_path, {tuple(item[:4]): item for item in manifest["entries"]}
+        return None, {}
+
+    def _build(self, job_id: str, version: str, entries: List[Tuple[str, Path, tuple]], fd: int, build: _ZipBuild):
+        started = time.monotonic()
+        job_dir = self.cache_dir / job_id
+        archive_path = job_dir / f"{version}.zip"
+        src_fd = None
+        reused = written = 0
+        try:
+            previous_path, previous_entries = self._previous(job_id, version)
+            if previous_path is not None:
+                try:
+                    src_fd = os.open(previous_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                except OSError:
+                    previous_entries = {}
+            zip_entries: List[ZipEntry] = []
+            manifest_entries = []
+            copy_start = copy_length = 0  # 連続する再利用エントリはまとめてコピーする
+            offset = 0
+            for name, path, identity in entries:
+                previous = previous_entries.get((name, *identity))
+                if previous is not None:
+                    _, _, _, size, previous_offset, header_size, crc, mtime = previous
+                    if copy_length and copy_start + copy_length == previous_offset:
+                        copy_length += header_size + size
+                    else:
+                        self._copy(src_fd, fd, copy_start, copy_length, build)
+                        copy_start, copy_length = previous_offset, header_size + size
+                    entry = ZipEntry(name, size, crc, mtime, offset)
+                    reused += 1
+                else:
+                    self._copy(src_fd, fd, copy_start, copy_length, build)
+                    copy_length = 0
+                    try:
+                        f = open(path, "rb")
+                    except OSError:
+                        continue
+                    with f:
+                        for entry, chunk in iter_file_entry(name, f, self.chunk_size):
+                            _write_all(fd, chunk)
+                            build.advance(len(chunk))
+                    entry.offset = offset
+                    header_size = len(local_header(entry))
+                    written += 1
+                zip_entries.append(entry)
+                manifest_entries.append([name, *identity, entry.offset, header_size, entry.crc, entry.mtime])
+                offset += header_size + entry.size
+            self._copy(src_fd, fd, copy_start, copy_length, build)
+            central = central_directory(zip_entries, offset)
+            _write_all(fd, central)
+            os.close(fd)
+            fd = None
+            manifest_path = job_dir / f"{version}.json"
+            tmp_path = job_dir / f".{version}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": version, "size": offset + len(central), "entries": manifest_entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, manifest_path)
+            with build.cond:
+                os.replace(build.path, archive_path)
+                build.path = archive_path
+                build.written += len(central)
+                build.done = True
+                build.cond.notify_all()
+            with self._lock:
+                self.reused_entries += reused
+                self.written_entries += written
+            logging.info(
+                f"[Job {job_id}] Zip アーカイブ {version[:8]} を作成しました ({len(zip_entries)} 件, 再利用 {reused} 件, "
+                f"新規 {written} 件, {offset + len(central)} バイト, {time.monotonic() - started:.2f} 秒)。"
+            )
+            self._remove_other_versions(job_id, version)
+            self.evict()
+        except BaseException as e:
+            logging.error(f"[Job {job_id}] Zip アーカイブの作成中にエラーが発生しました: {e}", exc_info=True)
+            with build.cond:
+                build.error = e
+                build.cond.notify_all()
+            try:
+                build.path.unlink()
+            except OSError:
+                pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+            if src_fd is not None:
+                os.close(src_fd)
+            with self._lock:
+                self._builds.pop((job_id, version), None)
+
+    @staticmethod
+    def _copy(src_fd: Optional[int], dst_fd: int, start: int, length: int, build: _ZipBuild):
+        """前のバージョンのアーカイブの [start, start + length) を書き込み先の末尾にコピーします (可能ならカーネル内でコピー)。"""
+        position = start
+        end = start + length
+        while position < end:
+            count = min(_COPY_CHUNK_SIZE, end - position)
+            copied = 0
+            if hasattr(os, "copy_file_range"):
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, count, position)
+                except OSError:
+                    copied = 0
+            if copied <= 0:
+                data = os.pread(src_fd, count, position)
+                if not data:
+                    raise OSError(f"前のバージョンの Zip アーカイブが途中で終わっています (位置 {position})。")
+                _write_all(dst_fd, data)
+                copied = len(data)
+            position += copied
+            build.advance(copied)
+
+    def _remove_other_versions(self, job_id: str, version: str):
+        for path in (self.cache_dir / job_id).glob("*"):
+            if path.stem != version and path.suffix in (".zip", ".json"):
+                try:
+                    path.unlink()  # 送信中のリクエストは開いたファイルから読み続ける
+                except OSError:
+                    pass
+
+    def remove(self, job_id: str):
+        shutil.rmtree(self.cache_dir / job_id, ignore_errors=True)
+
+    def evict(self):
+        """合計サイズが max_bytes 以下になるまで、最終利用日時の古いアーカイブから削除します。"""
+        archives = []
+        total = 0
+        for path in self.cache_dir.glob("*/*.zip"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            archives.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(archives):
+            if total <= self.max_bytes:
+                break
+            for stale_path in (path, path.with_suffix(".json")):
+                try:
+                    stale_path.unlink()
+                except OSError:
+                    pass
+            total -= size
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
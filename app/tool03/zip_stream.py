@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import zlib
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+# 画像 (JPEG / WebP) は既に圧縮済みのため、ZIP は無圧縮 (STORED) で作成します
+ZIP_STREAM_CHUNK_SIZE = 64 * 1024
+# このサイズ以下のファイルは 1 回で読み込んで CRC を計算する (それより大きいファイルは 2 回読む)
+_SINGLE_READ_MAX_BYTES = 4 * 1024 * 1024
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_OF_CENTRAL_DIR = struct.Struct("<IHHHHIIH")
+_ZIP64_END_OF_CENTRAL_DIR = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_LOCATOR = struct.Struct("<IIQI")
+_ZIP32_MAX = 0xFFFFFFFF
+_ZIP16_MAX = 0xFFFF
+_FLAG_UTF8 = 0x0800
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_VERSION_MADE_BY = (3 << 8) | _VERSION_ZIP64  # UNIX
+
+
+@dataclass
+class ZipEntry:
+    """書き込んだエントリの情報 (中央ディレクトリの作成用)。offset はローカルヘッダーの位置。"""
+    name: str
+    size: int
+    crc: int
+    mtime: float
+    offset: int = 0
+
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _name_and_flags(name: str) -> Tuple[bytes, int]:
+    encoded_name = name.encode("utf-8")
+    return encoded_name, 0 if encoded_name.isascii() else _FLAG_UTF8
+
+
+def local_header(entry: ZipEntry) -> bytes:
+    """エントリのローカルヘッダー (CRC とサイズを含むため、データディスクリプタは使わない)。"""
+    encoded_name, flags = _name_and_flags(entry.name)
+    dos_time, dos_date = _dos_datetime(entry.mtime)
+    zip64 = entry.size >= _ZIP32_MAX
+    extra = struct.pack("<HHQQ", 0x0001, 16, entry.size, entry.size) if zip64 else b""
+    return _LOCAL_HEADER.pack(
+        0x04034B50, _VERSION_ZIP64 if zip64 else _VERSION_DEFAULT, flags, 0, dos_time, dos_date, entry.crc,
+        _ZIP32_MAX if zip64 else entry.size, _ZIP32_MAX if zip64 else entry.size, len(encoded_name), len(extra),
+    ) + encoded_name + extra
+
+
+def central_directory(entries: List[ZipEntry], offset: int) -> bytes:
+    """offset の位置から書き込む中央ディレクトリと終端レコード (必要な場合は ZIP64)。"""
+    parts = []
+    for entry in entries:
+        encoded_name, flags = _name_and_flags(entry.name)
+        dos_time, dos_date = _dos_datetime(entry.mtime)
+        # ZIP64 拡張フィールドには 0xFFFFFFFF にした項目のみ含める
+        zip64_fields = []
+        if entry.size >= _ZIP32_MAX:
+            zip64_fields += [entry.size, entry.size]
+        if entry.offset >= _ZIP32_MAX:
+            zip64_fields.append(entry.offset)
+        extra = struct.pack(f"<HH{len(zip64_fields)}Q", 0x0001, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b""
+        parts.append(_CENTRAL_HEADER.pack(
+            0x02014B50, _VERSION_MADE_BY, _VERSION_ZIP64 if zip64_fields else _VERSION_DEFAULT, flags, 0, dos_time, dos_date,
+            entry.crc, min(entry.size, _ZIP32_MAX), min(entry.size, _ZIP32_MAX), len(encoded_name), len(extra), 0, 0, 0,
+            (0o100644 << 16), min(entry.offset, _ZIP32_MAX),
+        ) + encoded_name + extra)
+    central = b"".join(parts)
+    count = len(entries)
+    if count >= _ZIP16_MAX or offset >= _ZIP32_MAX or len(central) >= _ZIP32_MAX:
+        zip64_end_offset = offset + len(central)
+        central += _ZIP64_END_OF_CENTRAL_DIR.pack(
+            0x06064B50, _ZIP64_END_OF_CENTRAL_DIR.size - 12, _VERSION_MADE_BY, _VERSION_ZIP64, 0, 0,
+            count, count, len(central), offset,
+        ) + _ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end_offset, 1)
+        central_size = zip64_end_offset - offset
+    else:
+        central_size = len(central)
+    return central + _END_OF_CENTRAL_DIR.pack(
+        0x06054B50, 0, 0, min(count, _ZIP16_MAX), min(count, _ZIP16_MAX),
+        min(central_size, _ZIP32_MAX), min(offset, _ZIP32_MAX), 0,
+    )
+
+
+def iter_file_entry(name: str, f: BinaryIO, chunk_size: int = ZIP_STREAM_CHUNK_SIZE) -> Iterator[Tuple[ZipEntry, bytes]]:
+    """
+    開いたファイルを 1 エントリ分 (ローカルヘッダー + データ) のチャンクとして生成します。
+    各チャンクと一緒に (CRC・サイズの確定した) エントリ情報を返します (offset は呼び出し側で設定)。
+    """
+    stat = os.fstat(f.fileno())
+    if stat.st_size <= _SINGLE_READ_MAX_BYTES:
+        data = f.read()
+        entry = ZipEntry(name, len(data), zlib.crc32(data), stat.st_mtime)
+        yield entry, local_header(entry) + data
+        return
+    crc = 0
+    size = 0
+    while block := f.read(chunk_size):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+    f.seek(0)
+    entry = ZipEntry(name, size, crc, stat.st_mtime)
+    yield entry, local_header(entry)
+    remaining = size
+    while remaining > 0 and (block := f.read(min(chunk_size, remaining))):
+        remaining -= len(block)
+        yield entry, block
+
+
+def iter_stored_zip(files: Iterable[Tuple[str, Path]], chunk_size: int = ZIP_STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    (アーカイブ内の名前, ファイルパス) のリストから無圧縮 (STORED) の ZIP を chunk_size 程度のチャンクで生成します。
+    一時ファイルを作らず、メモリ使用量はファイル数に比例する中央ディレクトリ分のみです。
+    各ファイルの CRC とサイズはローカルヘッダーに書くため (データディスクリプタを使わない)、ストリームで読むツールでも展開できます。
+    4 GiB・65535 ファイルを超える場合は ZIP64 形式で書き込みます。読み込めなくなったファイルは含めません。
+    """
+    entries: List[ZipEntry] = []
+    buffer = bytearray()  # 小さな書き込み (ヘッダーなど) をまとめて送る
+    offset = 0
+    for name, path in files:
+        try:
+            f = open(path, "rb")
+        except OSError:
+            continue  # 削除・置き換え中のファイル
+        with f:
+            entry = None
+            for entry, chunk in iter_file_entry(name, f, chunk_size):
+                buffer += chunk
+                if len(buffer) >= chunk_size:
+                    yield bytes(buffer)
+                    buffer.clear()
+            entry.offset = offset
+            offset += len(local_header(entry)) + entry.size
+            entries.append(entry)
+    buffer += central_directory(entries, offset)
+    yield bytes(buffer)
@@ -14,7 +14,13 @@ from app.domain.entities.SampleEntity import SampleEntity
 from app.domain.entities.ParameterEntity import ParameterEntity
 from app.domain.entities.StoreEntity import StoreEntity
 from app.domain.entities.ProvisionalRegistrationEntity import ProvisionalRegistrationEntity
+# Bảng lưu trạng thái job của Tool 03 (khi TOOL03_JOB_STORE=database)
+from app.tool03.job_store import metadata as tool03_job_store_metadata
+# Hàng đợi job của Tool 03 (khi TOOL03_JOB_QUEUE=database)
+from app.tool03.job_queue import metadata as tool03_job_queue_metadata
 
 # Tạo bảng
 Base.metadata.create_all(bind=engine)
+tool03_job_store_metadata.create_all(bind=engine)
+tool03_job_queue_metadata.create_all(bind=engine)
 print("✅ Tables created successfully.")
\ No newline at end of file
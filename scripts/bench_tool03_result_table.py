@@ -0,0 +1,58 @@
+import sys
+import os
+import time
+import hashlib
+import tracemalloc
+
+# プロジェクトルートを sys.path に追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.tool03.schemas import Tool03ImageResult
+from app.tool03.result_table import ResultTable
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+ERROR_EVERY = 50  # 50 行に 1 行はエラー
+
+
+def make_result(index: int) -> dict:
+    # 描画ループが返す結果と同じ形 (ファイル名・数値は行毎に新しく生成されるオブジェクト)
+    if index % ERROR_EVERY == 0:
+        return Tool03ImageResult(status="Error", message=f"テンプレート 'テンプレートZ' が見つかりません ({index})").model_dump()
+    return Tool03ImageResult(
+        status="Success", filename=f"item-{index:06d}.jpg",
+        fileSize=150000 + index, encodeTimeMs=round(12.5 + index % 7, 2), quality=95,
+        contentHash=hashlib.sha256(str(index).encode()).hexdigest()[:32],
+    ).model_dump()
+
+
+def measure(label: str, build):
+    row_ids = [f"row-{index}" for index in range(ROWS)]  # row.id はどちらの方式でも共通のため計測対象外
+    tracemalloc.start()
+    start = time.perf_counter()
+    results = build(row_ids)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}\n    {current / ROWS:8.1f} bytes/行  合計 {current / 1024 / 1024:6.2f} MiB  構築 {elapsed * 1000:7.1f} ms")
+    return results
+
+
+def build_dicts(row_ids):
+    return {row_id: make_result(index) for index, row_id in enumerate(row_ids)}
+
+
+def build_table(row_ids):
+    table = ResultTable()
+    for index, row_id in enumerate(row_ids):
+        table[row_id] = make_result(index)
+    return table
+
+
+if __name__ == "__main__":
+    print(f"行数: {ROWS} (エラー行: {ROWS // ERROR_EVERY})")
+    dicts = measure("dict (Tool03ImageResult.model_dump() を 1 行 1 dict で保持)", build_dicts)
+    table = measure("ResultTable", build_table)
+    if table.to_dict() != dicts:
+        print("❌ 内容が一致しません")
+        sys.exit(1)
+    print("✅ 両方式の内容は一致しました")
@@ -0,0 +1,61 @@
+import sys
+import os
+import time
+import logging
+
+# プロジェクトルートを sys.path に追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.tool03 import renderer as tool03_renderer
+
+# テンプレートの日本語フォント (NotoSansJP-Black / ShipporiMinchoB1-Bold) はリポジトリに含まれないため、
+# 無い場合は日本語のグリフを持つ ZenMaruGothic-Medium で代用します
+FALLBACK_FONT = tool03_renderer.FONTS_DIR / "ZenMaruGothic-Medium.ttf"
+
+
+def template_font(name: str):
+    font_path = tool03_renderer.FONTS_DIR / name
+    return font_path if font_path.exists() else FALLBACK_FONT
+
+
+# Tool 03 の各テンプレートで実際に使われるテキスト・フォント・ボックス (x2 - x1, y2 - y1)
+CASES = [
+    ("スーパーSALE", template_font("NotoSansJP-Black.ttf"), 787, 110),       # FactoryTypeB message
+    ("1月2日10:00", template_font("NotoSansJP-Black.ttf"), 440, 69),         # FactoryTypeB 開始/終了日時
+    ("12月31日23:59", template_font("NotoSansJP-Black.ttf"), 501, 45),       # FactoryTypeA 開始/終了日時
+    ("当店通常価格", template_font("NotoSansJP-Black.ttf"), 1000, 50),       # FactoryTypeB priceType
+    ("99%OFF", template_font("ShipporiMinchoB1-Bold.ttf"), 320, 50),         # FactoryTypeE 割引
+]
+ROUNDS = 20
+
+
+def run(label: str, func, clear_fonts: bool):
+    tool03_renderer.font_cache.clear()
+    tool03_renderer.text_fit_engine.clear()
+    results = []
+    font_loads = 0
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        if clear_fonts:
+            font_loads += tool03_renderer.font_cache.stats()["misses"]
+            tool03_renderer.font_cache.clear()
+            tool03_renderer.text_fit_engine.clear()
+        results = [func(text, font_path, w, h) for text, font_path, w, h in CASES]
+    elapsed = time.perf_counter() - start
+    font_loads += tool03_renderer.font_cache.stats()["misses"]
+    per_call_ms = elapsed / (ROUNDS * len(CASES)) * 1000
+    print(f"{label}\n    {per_call_ms:8.3f} ms/回  フォント読込 {font_loads:5d} 回  結果 {results}")
+    return results
+
+
+if __name__ == "__main__":
+    logging.disable(logging.CRITICAL)
+    print(f"ケース数: {len(CASES)} / 繰り返し: {ROUNDS}")
+    linear_cold = run("線形スキャン (キャッシュなし)", tool03_renderer.calculate_font_size_linear, True)
+    engine_cold = run("TextFitEngine (キャッシュなし)", tool03_renderer.calculate_font_size, True)
+    run("線形スキャン (フォントキャッシュ共有)", tool03_renderer.calculate_font_size_linear, False)
+    engine_warm = run("TextFitEngine (メモ化)", tool03_renderer.calculate_font_size, False)
+    if linear_cold != engine_cold or linear_cold != engine_warm:
+        print("❌ 結果が一致しません")
+        sys.exit(1)
+    print("✅ 両方式の結果は一致しました")